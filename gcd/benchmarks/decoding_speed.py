@@ -0,0 +1,302 @@
+"""
+Measures the decoding speed of the beam search strategies without any trained
+weights, so that regressions in the hot paths can be measured on a CPU-only box.
+
+Every configuration of the sweep (beam size, vocabulary size, max_steps and
+sentence length) is decoded with each strategy, either with a synthetic step
+function (a small random RNN) or with a randomly initialized `ParsingModel`.
+The results are written as a JSON list with one entry per configuration and
+strategy. Run it from the root of the repository:
+
+    python -m gcd.benchmarks.decoding_speed --beam-sizes 1 10 --lengths 10 20
+
+The reported numbers are:
+    sentences_per_second: decoded sentences over the wall time of the search
+    step_latency_ms: percentiles of the time between consecutive calls to the
+        step function, i.e. one full iteration of the beam search including the
+        constraint masks and the automata updates
+    compile_seconds: the time to build the constraint automata for one sentence
+        with all of the in-process caches cleared
+    max_rss_mb: the peak resident memory of the process so far
+    peak_traced_mb: the peak Python allocation during the configuration (only
+        with --trace-memory, which makes everything slower)
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import time
+import tracemalloc
+import numpy as np
+import torch
+from allennlp.common.util import START_SYMBOL, END_SYMBOL
+from allennlp.data import Vocabulary
+from allennlp.modules.text_field_embedders import BasicTextFieldEmbedder
+from allennlp.modules.token_embedders import Embedding
+from typing import Any, Dict, List
+
+from gcd.inference.beam_search.active_set import ActiveSetBeamSearch
+from gcd.inference.beam_search.full_intersection import FullIntersectionBeamSearch
+from gcd.inference.beam_search.post_hoc import PostHocBeamSearch
+from gcd.inference.beam_search.unconstrained import UnconstrainedBeamSearch
+from gcd.inference.constraints import ConstraintSet, disk_cache
+from gcd.inference.constraints.parsing import BalancedParenthesesConstraint, MaxLengthConstraint, \
+    NonEmptyPhraseConstraint, NumTokensConstraint
+from gcd.models.parsing import ParsingModel
+from gcd.modules.matrix_attention.mlp import MLPAttention
+
+
+STRATEGIES = {
+    'unconstrained': UnconstrainedBeamSearch,
+    'post_hoc': PostHocBeamSearch,
+    'active_set': ActiveSetBeamSearch,
+    'full_intersection': FullIntersectionBeamSearch,
+}
+
+NAMESPACE = 'nonterminals'
+NUM_WORDS = 100
+
+
+class SyntheticDecoder(torch.nn.Module):
+    """A tiny randomly initialized RNN which stands in for a trained decoder."""
+    def __init__(self, vocab_size: int, hidden_size: int) -> None:
+        super().__init__()
+        self._embedder = torch.nn.Embedding(vocab_size, hidden_size)
+        self._hidden_layer = torch.nn.Linear(hidden_size, hidden_size)
+        self._output_layer = torch.nn.Linear(hidden_size, vocab_size)
+
+    def step(self, last_predictions: torch.Tensor, state: Dict[str, torch.Tensor]):
+        hidden = torch.tanh(self._hidden_layer(state['hidden']) + self._embedder(last_predictions))
+        log_probs = torch.log_softmax(self._output_layer(hidden), dim=1)
+        return log_probs, {'hidden': hidden}
+
+
+class StepTimer:
+    """
+    Wraps a step function and records the time between consecutive calls. The
+    timer is reset at the start of every `_search` so that the time between two
+    passes of the active set method is not counted as a step.
+    """
+    def __init__(self, step) -> None:
+        self.step = step
+        self.latencies: List[float] = []
+        self._last_call = None
+
+    def reset(self) -> None:
+        self._last_call = None
+
+    def __call__(self, *args, **kwargs):
+        now = time.perf_counter()
+        if self._last_call is not None:
+            self.latencies.append(now - self._last_call)
+        self._last_call = now
+        return self.step(*args, **kwargs)
+
+
+def build_vocab(vocab_size: int) -> Vocabulary:
+    """
+    Builds a nonterminal vocabulary of `vocab_size` tokens (including padding
+    and OOV) which looks like the linearized PTB trees: opening labels, a merged
+    closing parenthesis and the "XX" preterminal.
+    """
+    vocab = Vocabulary()
+    nonterminals = [START_SYMBOL, END_SYMBOL, ')', 'XX']
+    num_labels = vocab_size - vocab.get_vocab_size(NAMESPACE) - len(nonterminals)
+    if num_labels < 1:
+        raise ValueError(f'The vocabulary size must be at least {vocab_size - num_labels + 1}')
+    nonterminals.extend(f'(L{i}' for i in range(num_labels))
+    for token in nonterminals:
+        vocab.add_token_to_namespace(token, NAMESPACE)
+    for i in range(NUM_WORDS):
+        vocab.add_token_to_namespace(f'w{i}', 'tokens')
+    return vocab
+
+
+def build_constraint_set(vocab: Vocabulary, max_steps: int, lazy_intersection: bool) -> ConstraintSet:
+    # The same constraints as in the parsing experiments
+    constraints = [NumTokensConstraint(), NonEmptyPhraseConstraint(), BalancedParenthesesConstraint(max_steps)]
+    return ConstraintSet(constraints, vocab, NAMESPACE, lazy_intersection=lazy_intersection)
+
+
+def clear_automata_caches() -> None:
+    for constraint_type in [NumTokensConstraint, NonEmptyPhraseConstraint,
+                            BalancedParenthesesConstraint, MaxLengthConstraint]:
+        constraint_type.cache.clear()
+    ConstraintSet.intersection_cache.clear()
+
+
+def build_parsing_model(vocab: Vocabulary,
+                        constraint_set: ConstraintSet,
+                        hidden_size: int) -> ParsingModel:
+    token_embedder = BasicTextFieldEmbedder({
+        'tokens': Embedding(vocab.get_vocab_size('tokens'), hidden_size)
+    })
+    nonterminal_embedder = Embedding(vocab.get_vocab_size(NAMESPACE), hidden_size)
+    attention = MLPAttention(hidden_size, hidden_size, hidden_size)
+    beam_search = UnconstrainedBeamSearch(vocab, 1, NAMESPACE)
+    model = ParsingModel(vocab, token_embedder, nonterminal_embedder, 1, attention,
+                         constraint_set, beam_search, hidden_size=hidden_size)
+    model.eval()
+    return model
+
+
+def get_percentiles(latencies: List[float]) -> Dict[str, float]:
+    if len(latencies) == 0:
+        return {}
+    latencies = np.array(latencies) * 1000
+    return {
+        'mean': float(latencies.mean()),
+        'p50': float(np.percentile(latencies, 50)),
+        'p90': float(np.percentile(latencies, 90)),
+        'p99': float(np.percentile(latencies, 99)),
+    }
+
+
+def get_max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_strategy(args: argparse.Namespace,
+                 strategy_name: str,
+                 vocab: Vocabulary,
+                 constraint_set: ConstraintSet,
+                 beam_size: int,
+                 max_steps: int,
+                 length: int) -> Dict[str, Any]:
+    beam_search = STRATEGIES[strategy_name](vocab, beam_size, NAMESPACE, max_steps=max_steps)
+
+    vocab_size = vocab.get_vocab_size(NAMESPACE)
+    start_index = vocab.get_token_index(START_SYMBOL, NAMESPACE)
+    if args.model == 'synthetic':
+        decoder = SyntheticDecoder(vocab_size, args.hidden_size)
+        step_timer = StepTimer(decoder.step)
+    else:
+        model = build_parsing_model(vocab, constraint_set, args.hidden_size)
+        model.beam_search = beam_search
+        step_timer = StepTimer(model._decoder_step)
+        model._decoder_step = step_timer
+
+    # Reset the timer whenever a new pass of the beam search starts
+    search = beam_search._search
+    def timed_search(*search_args, **search_kwargs):
+        step_timer.reset()
+        return search(*search_args, **search_kwargs)
+    beam_search._search = timed_search
+
+    elapsed = 0.0
+    num_sentences = 0
+    while num_sentences < args.num_sentences:
+        batch_size = min(args.batch_size, args.num_sentences - num_sentences)
+        # The words are never padding or OOV. The constraints only look at the length
+        tokens = torch.randint(2, vocab.get_vocab_size('tokens'), (batch_size, length + 2), dtype=torch.long)
+
+        with torch.no_grad():
+            if args.model == 'synthetic':
+                constraint_sets = []
+                for instance_tokens in tokens:
+                    instance_constraint_set = constraint_set.spawn()
+                    instance_constraint_set.setup(instance_tokens.unsqueeze(0))
+                    constraint_sets.append(instance_constraint_set)
+                start_predictions = tokens.new_full((batch_size,), start_index)
+                start_state = {'hidden': torch.zeros(batch_size, args.hidden_size)}
+
+                start = time.perf_counter()
+                beam_search.search(start_predictions, start_state, step_timer, constraint_sets)
+                elapsed += time.perf_counter() - start
+            else:
+                # The constraint sets are setup inside of the model, but the
+                # automata are already cached at this point
+                start = time.perf_counter()
+                model.forward({'tokens': tokens})
+                elapsed += time.perf_counter() - start
+        num_sentences += batch_size
+
+    return {
+        'sentences_per_second': num_sentences / elapsed,
+        'step_latency_ms': get_percentiles(step_timer.latencies),
+        'num_steps': len(step_timer.latencies),
+    }
+
+
+def main(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if not args.use_disk_cache:
+        os.environ[disk_cache.CACHE_DIR_ENV] = ''
+
+    results = []
+    for vocab_size in args.vocab_sizes:
+        vocab = build_vocab(vocab_size)
+        for max_steps in args.max_steps:
+            for length in args.lengths:
+                if args.trace_memory:
+                    tracemalloc.start()
+
+                # Build the automata once from scratch to measure the compile time.
+                # All of the other instances hit the in-process caches
+                clear_automata_caches()
+                constraint_set = build_constraint_set(vocab, max_steps, args.lazy_intersection)
+                start = time.perf_counter()
+                constraint_set.spawn().setup(torch.zeros(1, length + 2, dtype=torch.long))
+                compile_seconds = time.perf_counter() - start
+
+                for beam_size in args.beam_sizes:
+                    for strategy_name in args.strategies:
+                        result = {
+                            'model': args.model,
+                            'strategy': strategy_name,
+                            'beam_size': beam_size,
+                            'vocab_size': vocab_size,
+                            'max_steps': max_steps,
+                            'length': length,
+                            'batch_size': args.batch_size,
+                            'num_sentences': args.num_sentences,
+                            'compile_seconds': compile_seconds,
+                        }
+                        result.update(run_strategy(args, strategy_name, vocab, constraint_set,
+                                                   beam_size, max_steps, length))
+                        result['max_rss_mb'] = get_max_rss_mb()
+                        if args.trace_memory:
+                            result['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                        results.append(result)
+
+                if args.trace_memory:
+                    tracemalloc.stop()
+
+    if args.output_file:
+        dirname = os.path.dirname(args.output_file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(args.output_file, 'w') as out:
+            json.dump(results, out, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+def build_argument_parser() -> argparse.ArgumentParser:
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--model', choices=['synthetic', 'parsing'], default='synthetic',
+                      help='Decode with a synthetic step function or a randomly initialized ParsingModel')
+    argp.add_argument('--strategies', nargs='+', choices=list(STRATEGIES.keys()), default=list(STRATEGIES.keys()))
+    argp.add_argument('--beam-sizes', nargs='+', type=int, default=[1, 10])
+    argp.add_argument('--vocab-sizes', nargs='+', type=int, default=[32, 128])
+    argp.add_argument('--max-steps', nargs='+', type=int, default=[200])
+    argp.add_argument('--lengths', nargs='+', type=int, default=[10, 25])
+    argp.add_argument('--num-sentences', type=int, default=10, help='The number of sentences per configuration')
+    argp.add_argument('--batch-size', type=int, default=1)
+    argp.add_argument('--hidden-size', type=int, default=64)
+    argp.add_argument('--lazy-intersection', action='store_true')
+    argp.add_argument('--use-disk-cache', action='store_true',
+                      help='Load the automata from the on-disk cache instead of compiling them')
+    argp.add_argument('--trace-memory', action='store_true', help='Also measure the peak Python allocation')
+    argp.add_argument('--output-file', help='Where to write the JSON results (stdout if not set)')
+    argp.add_argument('--seed', type=int, default=4)
+    return argp
+
+
+if __name__ == '__main__':
+    args = build_argument_parser().parse_args()
+    main(args)
@@ -1,12 +1,18 @@
+import logging
 import torch
 from allennlp.common.util import END_SYMBOL
 from allennlp.data import Vocabulary
 from typing import Callable, Dict, List, Tuple
 
 from gcd.inference.beam_search import ConstrainedBeamSearch, util
+from gcd.inference.beam_search.history import SearchHistory
+from gcd.inference.beam_search.violation_tracker import ViolationTracker
 from gcd.inference.constraints import ConstraintSet
+from rayuela.base import profiling
 
 
+logger = logging.getLogger(__name__)
+
 StateType = Dict[str, torch.Tensor]  # pylint: disable=invalid-name
 StepFunctionType = Callable[[torch.Tensor, StateType], Tuple[torch.Tensor, StateType]]  # pylint: disable=invalid-name
 
@@ -19,33 +25,101 @@ class ActiveSetBeamSearch(ConstrainedBeamSearch):
                  namespace: str = 'tokens',
                  end_symbol: str = None,
                  max_steps: int = 500,
-                 per_node_beam_size: int = None) -> None:
+                 per_node_beam_size: int = None,
+                 resume: bool = True,
+                 early_violation_detection: bool = False) -> None:
+        """
+        args:
+            resume: if True, every pass after the first replays the decoder outputs
+                of the previous pass up to the first step where its selections change,
+                instead of decoding from scratch. The outputs are the same either way.
+            early_violation_detection: if True, the non-working set constraints are
+                tracked alongside the beams, and a pass stops decoding an instance
+                as soon as its top beam violates one of them (see `ViolationTracker`).
+                This avoids decoding the rest of a pass which is known to fail, but
+                it may add constraints that a full pass would not have needed, so
+                the outputs can differ.
+        """
         self.beam_size = beam_size
         end_symbol = end_symbol or END_SYMBOL
         self._end_index = vocab.get_token_index(end_symbol, namespace)
         self.max_steps = max_steps
         self.per_node_beam_size = per_node_beam_size or beam_size
+        self.resume = resume
+        self.early_violation_detection = early_violation_detection
+        # The number of decoder steps which were replayed instead of computed
+        # during the last call to `search`
+        self.num_saved_steps = 0
+        # The number of passes which were stopped early during the last call to `search`
+        self.num_early_violations = 0
 
     def search(self,
                start_predictions: torch.Tensor,
                start_state: StateType,
                step: StepFunctionType,
-               constraint_sets: List[ConstraintSet]):
-        while True:
-            predictions, log_probs = self._search(start_predictions, start_state, step, constraint_sets)
-            top_predictions = [util.ensure_one_end_index(prediction[0].tolist(), self._end_index) for prediction in predictions]
-
-            all_valid = True
-            for batch, (prediction, constraint_set) in enumerate(zip(top_predictions, constraint_sets)):
-                violated_constraint = constraint_set.get_violated_constraint(prediction)
+               constraint_sets: List[ConstraintSet],
+               static_state_keys: List[str] = None,
+               valid_actions_mask_key: str = None):
+        batch_size = start_predictions.size(0)
+        top_predictions = [None] * batch_size
+        log_probs = None
+
+        # The instances whose top prediction still violates a constraint. Only
+        # these are decoded again after the first pass.
+        remaining = list(range(batch_size))
+        # The history of the previous pass, which has one entry per instance in
+        # `remaining`. Log-probabilities which are restricted to the valid
+        # actions depend on the working set, so they are never replayed
+        history = SearchHistory() if self.resume and valid_actions_mask_key is None else None
+        self.num_saved_steps = 0
+        self.num_early_violations = 0
+        while len(remaining) > 0:
+            profiling.count('active_set_passes')
+            pass_constraint_sets = [constraint_sets[batch] for batch in remaining]
+            tracker = ViolationTracker(pass_constraint_sets, self._end_index) if self.early_violation_detection else None
+            if len(remaining) == batch_size:
+                predictions, pass_log_probs = self._search(start_predictions, start_state, step, constraint_sets,
+                                                           history, tracker, static_state_keys,
+                                                           valid_actions_mask_key)
+                log_probs = pass_log_probs
+            else:
+                index = torch.tensor(remaining, dtype=torch.long, device=start_predictions.device)
+                pass_start_state = {key: state_tensor.index_select(0, index)
+                                    for key, state_tensor in start_state.items()}
+                predictions, pass_log_probs = self._search(start_predictions.index_select(0, index),
+                                                           pass_start_state, step, pass_constraint_sets,
+                                                           history, tracker, static_state_keys,
+                                                           valid_actions_mask_key)
+                log_probs = log_probs.index_copy(0, index, pass_log_probs)
+            if history is not None:
+                self.num_saved_steps += history.num_replayed_steps
+
+            next_remaining = []
+            pass_top_predictions = util.ensure_one_end_index_batch(predictions[:, 0], self._end_index)
+            for i, (batch, top_prediction) in enumerate(zip(remaining, pass_top_predictions)):
+                constraint_set = constraint_sets[batch]
+                if tracker is not None and tracker.violations[i] is not None:
+                    # The prediction is incomplete, and it is decoded again anyway
+                    violated_constraint = tracker.violations[i]
+                    self.num_early_violations += 1
+                else:
+                    top_predictions[batch] = top_prediction
+                    violated_constraint = constraint_set.get_violated_constraint(top_prediction)
                 if violated_constraint is not None:
+                    profiling.count('active_set_restarts')
                     constraint_set.add_contraint_to_working_set(violated_constraint)
-                    all_valid = False
+                    next_remaining.append(batch)
+            if history is not None and len(next_remaining) > 0:
+                positions = [remaining.index(batch) for batch in next_remaining]
+                history = history.index_select(torch.tensor(positions, dtype=torch.long,
+                                                            device=start_predictions.device))
+            remaining = next_remaining
 
-            if all_valid:
-                break
+        if self.num_saved_steps > 0:
+            logger.info('Resumed the active set search, saving %d decoder steps', self.num_saved_steps)
+        if self.num_early_violations > 0:
+            logger.info('Stopped %d active set passes early', self.num_early_violations)
 
-        batch_size = start_predictions.size(0)
         working_sets = [constraint_set.get_working_set() for constraint_set in constraint_sets]
         violated_constraints = [[] for _ in range(batch_size)]
 
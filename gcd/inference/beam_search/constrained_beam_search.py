@@ -4,9 +4,12 @@ from allennlp.common import Registrable
 from allennlp.common.checks import ConfigurationError
 from allennlp.common.util import END_SYMBOL
 from allennlp.data import Vocabulary
-from typing import Callable, Dict, List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
+from gcd.inference.beam_search.history import SearchHistory
+from gcd.inference.beam_search.violation_tracker import ViolationTracker
 from gcd.inference.constraints import ConstraintSet
+from rayuela.base import profiling
 
 
 StateType = Dict[str, torch.Tensor]  # pylint: disable=invalid-name
@@ -14,6 +17,10 @@ StepFunctionType = Callable[[torch.Tensor, StateType], Tuple[torch.Tensor, State
 
 
 class ConstrainedBeamSearch(Registrable):
+    # Whether to skip the decoder when the valid actions are passed to it (see
+    # `_search`) and every beam which has not ended can only end
+    skip_forced_steps = True
+
     def __init__(self,
                  vocab: Vocabulary,
                  beam_size: int,
@@ -27,16 +34,59 @@ class ConstrainedBeamSearch(Registrable):
         self.max_steps = max_steps
         self.per_node_beam_size = per_node_beam_size or beam_size
 
+    @profiling.timed('apply_constraints')
     def _apply_constraints(self,
                            constraint_sets: List[ConstraintSet],
                            log_probs: torch.Tensor,
-                           states: List[List[int]],
-                           stacks: List[List[int]]) -> None:
+                           states: torch.Tensor,
+                           stacks: torch.Tensor,
+                           masks: torch.Tensor = None) -> None:
+        """
+        Applys the constraints by zeroing out invalid actions. The mask for all of
+        the beams of an instance is looked up from the constraint set's mask cache
+        and added to the log-probabilities in one operation. `masks` are the
+        masks from `_get_valid_actions_masks` if they have already been computed.
+        """
+        if masks is not None:
+            log_probs += masks.view(log_probs.size())
+            return
+        for batch, constraint_set in enumerate(constraint_sets):
+            mask = constraint_set.get_valid_actions_mask(states[batch], stacks[batch], log_probs)
+            if mask is not None:
+                log_probs[batch] += mask
+
+    def _get_valid_actions_masks(self,
+                                 constraint_sets: List[ConstraintSet],
+                                 states: torch.Tensor,
+                                 stacks: torch.Tensor,
+                                 template: torch.Tensor) -> Optional[torch.Tensor]:
+        """
+        Returns the (batch_size * num_beams, vocab_size) additive masks of the
+        valid actions of every beam, or None if no instance is constrained.
+        `template` is only used for the vocabulary size, dtype and device.
         """
-        Applys the constraints by zeroing out invalid actions.
+        batch_size, num_beams = states.size()
+        masks = None
+        for batch, constraint_set in enumerate(constraint_sets):
+            mask = constraint_set.get_valid_actions_mask(states[batch], stacks[batch], template)
+            if mask is not None:
+                if masks is None:
+                    masks = template.new_zeros(batch_size, num_beams, template.size(-1))
+                masks[batch] = mask
+        return None if masks is None else masks.view(batch_size * num_beams, -1)
+
+    def _apply_constraints_reference(self,
+                                     constraint_sets: List[ConstraintSet],
+                                     log_probs: torch.Tensor,
+                                     states: torch.Tensor,
+                                     stacks: torch.Tensor) -> None:
+        """
+        The per-action version of `_apply_constraints`. It is much slower, but it
+        is kept as a reference implementation to test the masks against.
         """
         batch_size, beam_size, vocab_size = log_probs.size()
         all_actions = set(list(range(vocab_size)))
+        states, stacks = states.tolist(), stacks.tolist()
 
         for batch, constraint_set in enumerate(constraint_sets):
             for beam in range(beam_size):
@@ -47,39 +97,63 @@ class ConstrainedBeamSearch(Registrable):
                 for action in all_actions - valid_actions:  # ! maybe all actions are invalid
                     log_probs[batch, beam, action] = float('-inf')
 
+    @profiling.timed('update_states_and_stacks')
     def _update_states_and_stacks(self,
                                   constraint_sets: List[ConstraintSet],
                                   actions: torch.Tensor,
-                                  states: List[List[int]],
-                                  stacks: List[List[int]]):
+                                  states: torch.Tensor,
+                                  stacks: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         """
-        Given the selected actions, update the new states and stacks.
+        Given the (batch_size, beam_size) selected actions, update the new states and stacks.
         """
-        batch_size, beam_size = actions.size()
-        next_states = [[] for _ in range(batch_size)]
-        next_stacks = [[] for _ in range(batch_size)]
+        # We make a special exception if the <end> action was taken. We assume
+        # that once you end the sequence, you cannot emit anything else. The special
+        # handling is necessary here because the constraints may not have self loops
+        # at the end for the end symbol, so those beams are not stepped at all
+        live = actions != self._end_index
+        next_states, next_stacks = [], []
         for batch, constraint_set in enumerate(constraint_sets):
-            for beam, (state, stack) in enumerate(zip(states[batch], stacks[batch])):
-                # We make a special exception if the <end> action was taken. We assume
-                # that once you end the sequence, you cannot emit anything else. The special
-                # handling is necessary here because the constraints may not have self loops
-                # at the end for the end symbol
-                action = actions[batch, beam].item()
-                if action == self._end_index:
-                    next_state, next_stack = state, stack
-                else:
-                    next_state, next_stack = constraint_set.step(state, stack, action)
-                next_states[batch].append(next_state)
-                next_stacks[batch].append(next_stack)
-
-        return next_states, next_stacks
+            next_state, next_stack = constraint_set.step_batch(states[batch], stacks[batch], actions[batch],
+                                                               live[batch])
+            next_states.append(next_state)
+            next_stacks.append(next_stack)
+        return torch.stack(next_states), torch.stack(next_stacks)
 
     def _search(self,
                 start_predictions: torch.Tensor,
                 start_state: StateType,
                 step: StepFunctionType,
-                constraint_sets: List[ConstraintSet]) -> Tuple[torch.Tensor, torch.Tensor]:
+                constraint_sets: List[ConstraintSet],
+                history: SearchHistory = None,
+                tracker: ViolationTracker = None,
+                static_state_keys: List[str] = None,
+                valid_actions_mask_key: str = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        args:
+            history: if given, the decoder outputs and selections of this search
+                are recorded into it, and the ones it already holds are replayed
+                for as long as the selections do not change (see `SearchHistory`).
+            tracker: if given, it is updated with the selections of every step,
+                and the search stops early once it has flagged every instance.
+                The predictions of the flagged instances are then incomplete.
+            static_state_keys: the keys of the state tensors which are the same
+                for every beam of an instance, like the encoder outputs. They
+                stay (batch_size, *) instead of being copied to every beam and
+                reordered at every step, so `step` has to broadcast them over the
+                (batch_size * beam_size) beams.
+            valid_actions_mask_key: if given, the additive masks of the valid actions
+                of the beams are put in the state under this key before every step,
+                and `step` has to normalize its log-probabilities over them. An
+                action which is the only valid one then has a log-probability of 0,
+                so when every beam which has not ended can only end, the decoder
+                is not called at all.
+        """
         batch_size = start_predictions.size(0)
+        static_state_keys = set(static_state_keys or [])
+        if valid_actions_mask_key is not None:
+            # The masks are replaced before every step, so they are never reordered
+            static_state_keys.add(valid_actions_mask_key)
+            template = start_predictions.new_zeros(1, len(constraint_sets[0].token_to_key), dtype=torch.float)
 
         # List of (batch_size, beam_size) tensors. One for each time step.
         predictions: List[torch.Tensor] = []
@@ -90,15 +164,18 @@ class ConstrainedBeamSearch(Registrable):
         backpointers: List[torch.Tensor] = []
 
         # `constraint_states` and `constraint_stacks` maintain the state of the decoding through
-        # the automata. Both are indexed by [batch][beam]
-        constraint_states: List[List[int]] = [[] for _ in range(batch_size)]
-        constraint_stacks: List[List[int]] = [[] for _ in range(batch_size)]
+        # the automata. Both are (batch_size, 1) int64 tensors until the first
+        # step, and (batch_size, beam_size) afterwards
+        constraint_states = start_predictions.new_zeros(batch_size, 1)
+        constraint_stacks = start_predictions.new_zeros(batch_size, 1)
         for batch, constraint_set in enumerate(constraint_sets):
             constraint_start_state = constraint_set.get_start()
-            start_index = start_predictions[batch].item()
-            constraint_first_state, constraint_first_stack = constraint_set.step(constraint_start_state, 0, start_index)
-            constraint_states[batch].append(constraint_first_state)
-            constraint_stacks[batch].append(constraint_first_stack)
+            if constraint_start_state is not None:
+                constraint_states[batch, 0] = constraint_start_state
+        constraint_states, constraint_stacks = \
+            self._update_states_and_stacks(constraint_sets, start_predictions.unsqueeze(1), constraint_states, constraint_stacks)
+        if tracker is not None:
+            tracker.update(start_predictions.unsqueeze(1))
 
         # Calculate the first timestep. This is done outside the main loop
         # because we are going from a single decoder input (the output from the
@@ -107,10 +184,19 @@ class ConstrainedBeamSearch(Registrable):
         # beam to `beam_size`^2 candidates from which we will select the top
         # `beam_size` elements for the next iteration.
         # shape: (batch_size, num_classes)
-        start_class_log_probabilities, state = step(start_predictions, start_state)
+        masks = None
+        if valid_actions_mask_key is not None:
+            masks = self._get_valid_actions_masks(constraint_sets, constraint_states, constraint_stacks, template)
+            start_state = self._set_valid_actions_masks(start_state, valid_actions_mask_key, masks)
+        with profiling.timer('decoder_step'):
+            if history is None:
+                start_class_log_probabilities, state = step(start_predictions, start_state)
+            else:
+                start_class_log_probabilities, state = history.step(0, step, start_predictions, start_state)
 
         start_class_log_probabilities = start_class_log_probabilities.unsqueeze(1)
-        self._apply_constraints(constraint_sets, start_class_log_probabilities, constraint_states, constraint_stacks)
+        self._apply_constraints(constraint_sets, start_class_log_probabilities, constraint_states, constraint_stacks,
+                                masks)
         start_class_log_probabilities = start_class_log_probabilities.squeeze(1)
 
         num_classes = start_class_log_probabilities.size()[1]
@@ -122,8 +208,9 @@ class ConstrainedBeamSearch(Registrable):
                                      f"Please decrease beam_size or per_node_beam_size.")
 
         # shape: (batch_size, beam_size), (batch_size, beam_size)
-        start_top_log_probabilities, start_predicted_classes = \
-                start_class_log_probabilities.topk(self.beam_size)
+        with profiling.timer('topk'):
+            start_top_log_probabilities, start_predicted_classes = \
+                    start_class_log_probabilities.topk(self.beam_size)
         if self.beam_size == 1 and (start_predicted_classes == self._end_index).all():
             warnings.warn("Empty sequences predicted. You may want to increase the beam size or ensure "
                           "your step function is working properly.",
@@ -136,7 +223,14 @@ class ConstrainedBeamSearch(Registrable):
 
         # shape: [(batch_size, beam_size)]
         predictions.append(start_predicted_classes)
-
+        if history is not None:
+            history.select(0, start_predicted_classes, None)
+        if tracker is not None:
+            tracker.update(start_predicted_classes)
+
+        # Every beam starts from the same constraint state, and then reads its own first prediction
+        constraint_states = constraint_states.expand(batch_size, self.beam_size)
+        constraint_stacks = constraint_stacks.expand(batch_size, self.beam_size)
         constraint_states, constraint_stacks = \
             self._update_states_and_stacks(constraint_sets, start_predicted_classes, constraint_states, constraint_stacks)
 
@@ -150,6 +244,8 @@ class ConstrainedBeamSearch(Registrable):
 
         # Set the same state for each element in the beam.
         for key, state_tensor in state.items():
+            if key in static_state_keys:
+                continue
             _, *last_dims = state_tensor.size()
             # shape: (batch_size * beam_size, *)
             state[key] = state_tensor.\
@@ -157,16 +253,6 @@ class ConstrainedBeamSearch(Registrable):
                     expand(batch_size, self.beam_size, *last_dims).\
                     reshape(batch_size * self.beam_size, *last_dims)
 
-        # Repeat the constraint state
-        repeated_states = [[] for _ in range(batch_size)]
-        repeated_stacks = [[] for _ in range(batch_size)]
-        for batch in range(batch_size):
-            for beam in range(self.beam_size):
-                repeated_states[batch].append(constraint_states[batch][0])
-                repeated_stacks[batch].append(constraint_stacks[batch][0])
-        constraint_states = repeated_states
-        constraint_stacks = repeated_stacks
-
         for timestep in range(self.max_steps - 1):
             # shape: (batch_size * beam_size,)
             last_predictions = predictions[-1].reshape(batch_size * self.beam_size)
@@ -175,14 +261,32 @@ class ConstrainedBeamSearch(Registrable):
             # then we can stop early.
             if (last_predictions == self._end_index).all():
                 break
+            # Or if every instance is known to violate a constraint
+            if tracker is not None and tracker.all_violated():
+                break
 
             # Take a step. This get the predicted log probs of the next classes
             # and updates the state.
             # shape: (batch_size * beam_size, num_classes)
-            class_log_probabilities, state = step(last_predictions, state)
+            if valid_actions_mask_key is not None:
+                masks = self._get_valid_actions_masks(constraint_sets, constraint_states, constraint_stacks, template)
+                state = self._set_valid_actions_masks(state, valid_actions_mask_key, masks)
+            if masks is not None and history is None and self.skip_forced_steps \
+                    and self._is_forced_to_end(masks, last_predictions):
+                # The decoder would return the masks themselves, and its state
+                # is not needed anymore since every beam ends
+                profiling.count('skipped_decoder_steps')
+                class_log_probabilities = masks.clone()
+            else:
+                with profiling.timer('decoder_step'):
+                    if history is None:
+                        class_log_probabilities, state = step(last_predictions, state)
+                    else:
+                        class_log_probabilities, state = history.step(timestep + 1, step, last_predictions, state)
 
             class_log_probabilities = class_log_probabilities.view(batch_size, self.beam_size, -1)
-            self._apply_constraints(constraint_sets, class_log_probabilities, constraint_states, constraint_stacks)
+            self._apply_constraints(constraint_sets, class_log_probabilities, constraint_states, constraint_stacks,
+                                    masks)
             # assert not torch.isinf(class_log_probabilities).all(), f"All actions are invalid in beam search step {timestep}"
             class_log_probabilities = class_log_probabilities.view(batch_size * self.beam_size, -1)
 
@@ -205,8 +309,9 @@ class ConstrainedBeamSearch(Registrable):
             )
 
             # shape (both): (batch_size * beam_size, per_node_beam_size)
-            top_log_probabilities, predicted_classes = \
-                cleaned_log_probabilities.topk(self.per_node_beam_size)
+            with profiling.timer('topk'):
+                top_log_probabilities, predicted_classes = \
+                    cleaned_log_probabilities.topk(self.per_node_beam_size)
 
             # Here we expand the last log probabilities to (batch_size * beam_size, per_node_beam_size)
             # so that we can add them to the current log probs for this timestep.
@@ -230,7 +335,8 @@ class ConstrainedBeamSearch(Registrable):
 
             # Keep only the top `beam_size` beam indices.
             # shape: (batch_size, beam_size), (batch_size, beam_size)
-            restricted_beam_log_probs, restricted_beam_indices = reshaped_summed.topk(self.beam_size)
+            with profiling.timer('topk'):
+                restricted_beam_log_probs, restricted_beam_indices = reshaped_summed.topk(self.beam_size)
 
             # Use the beam indices to extract the corresponding classes.
             # shape: (batch_size, beam_size)
@@ -249,10 +355,16 @@ class ConstrainedBeamSearch(Registrable):
             backpointer = (restricted_beam_indices / self.per_node_beam_size).type(torch.int64)
 
             backpointers.append(backpointer)
+            if history is not None:
+                history.select(timestep + 1, restricted_predicted_classes, backpointer)
+            if tracker is not None:
+                tracker.update(restricted_predicted_classes, backpointer)
 
             # Keep only the pieces of the state tensors corresponding to the
             # ancestors created this iteration.
             for key, state_tensor in state.items():
+                if key in static_state_keys:
+                    continue
                 _, *last_dims = state_tensor.size()
                 # shape: (batch_size, beam_size, *)
                 expanded_backpointer = backpointer.\
@@ -265,15 +377,9 @@ class ConstrainedBeamSearch(Registrable):
                         gather(1, expanded_backpointer).\
                         reshape(batch_size * self.beam_size, *last_dims)
 
-            next_constraint_states = [[] for _ in range(batch_size)]
-            next_constraint_stacks = [[] for _ in range(batch_size)]
-            for batch in range(batch_size):
-                for beam in range(self.beam_size):
-                    index = backpointer[batch][beam].item()
-                    next_constraint_states[batch].append(constraint_states[batch][index])
-                    next_constraint_stacks[batch].append(constraint_stacks[batch][index])
-            constraint_states = next_constraint_states
-            constraint_stacks = next_constraint_stacks
+            # Keep the constraint states of the ancestors
+            constraint_states = constraint_states.gather(1, backpointer)
+            constraint_stacks = constraint_stacks.gather(1, backpointer)
 
             constraint_states, constraint_stacks = \
                 self._update_states_and_stacks(constraint_sets, restricted_predicted_classes, constraint_states, constraint_stacks)
@@ -288,22 +394,24 @@ class ConstrainedBeamSearch(Registrable):
         # shape: [(batch_size, beam_size, 1)]
         reconstructed_predictions = [predictions[-1].unsqueeze(2)]
 
-        # shape: (batch_size, beam_size)
-        cur_backpointers = backpointers[-1]
+        # The search may have stopped right after the first step
+        if len(backpointers) > 0:
+            # shape: (batch_size, beam_size)
+            cur_backpointers = backpointers[-1]
 
-        for timestep in range(len(predictions) - 2, 0, -1):
-            # shape: (batch_size, beam_size, 1)
-            cur_preds = predictions[timestep].gather(1, cur_backpointers).unsqueeze(2)
+            for timestep in range(len(predictions) - 2, 0, -1):
+                # shape: (batch_size, beam_size, 1)
+                cur_preds = predictions[timestep].gather(1, cur_backpointers).unsqueeze(2)
 
-            reconstructed_predictions.append(cur_preds)
+                reconstructed_predictions.append(cur_preds)
 
-            # shape: (batch_size, beam_size)
-            cur_backpointers = backpointers[timestep - 1].gather(1, cur_backpointers)
+                # shape: (batch_size, beam_size)
+                cur_backpointers = backpointers[timestep - 1].gather(1, cur_backpointers)
 
-        # shape: (batch_size, beam_size, 1)
-        final_preds = predictions[0].gather(1, cur_backpointers).unsqueeze(2)
+            # shape: (batch_size, beam_size, 1)
+            final_preds = predictions[0].gather(1, cur_backpointers).unsqueeze(2)
 
-        reconstructed_predictions.append(final_preds)
+            reconstructed_predictions.append(final_preds)
 
         # Add the starting token
         reconstructed_predictions.append(start_predictions.unsqueeze(1).unsqueeze(2).expand(-1, self.beam_size, -1))
@@ -313,9 +421,32 @@ class ConstrainedBeamSearch(Registrable):
 
         return all_predictions, last_log_probabilities
 
+    def _is_forced_to_end(self, masks: torch.Tensor, last_predictions: torch.Tensor) -> bool:
+        """
+        Whether every beam which has not ended either has no valid action or can
+        only end. The masks of the beams which have ended are those of their
+        state before the end, so they are ignored.
+        """
+        is_valid = masks == 0
+        num_valid = is_valid.long().sum(dim=1)
+        can_only_end = (num_valid == 1) & is_valid[:, self._end_index]
+        ended = last_predictions == self._end_index
+        return bool(((num_valid == 0) | can_only_end | ended).all())
+
+    @staticmethod
+    def _set_valid_actions_masks(state: StateType, key: str, masks: Optional[torch.Tensor]) -> StateType:
+        state = dict(state)
+        if masks is None:
+            state.pop(key, None)
+        else:
+            state[key] = masks
+        return state
+
     def search(self,
                start_predictions: torch.Tensor,
                start_state: StateType,
                step: StepFunctionType,
-               constraint_sets: List[ConstraintSet]):
+               constraint_sets: List[ConstraintSet],
+               static_state_keys: List[str] = None,
+               valid_actions_mask_key: str = None):
         raise NotImplementedError
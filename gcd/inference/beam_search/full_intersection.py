@@ -30,12 +30,16 @@ class FullIntersectionBeamSearch(ConstrainedBeamSearch):
                start_predictions: torch.Tensor,
                start_state: StateType,
                step: StepFunctionType,
-               constraint_sets: List[ConstraintSet]):
+               constraint_sets: List[ConstraintSet],
+               static_state_keys: List[str] = None,
+               valid_actions_mask_key: str = None):
         for constraint_set in constraint_sets:
             constraint_set.force_full_intersection()
 
-        predictions, log_probs = self._search(start_predictions, start_state, step, constraint_sets)
-        top_predictions = [util.ensure_one_end_index(prediction[0].tolist(), self._end_index) for prediction in predictions]
+        predictions, log_probs = self._search(start_predictions, start_state, step, constraint_sets,
+                                              static_state_keys=static_state_keys,
+                                              valid_actions_mask_key=valid_actions_mask_key)
+        top_predictions = util.ensure_one_end_index_batch(predictions[:, 0], self._end_index)
 
         # All of the constraints are in the working set by definition
         batch_size = start_predictions.size(0)
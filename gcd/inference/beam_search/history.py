@@ -0,0 +1,103 @@
+import torch
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+StateType = Dict[str, torch.Tensor]  # pylint: disable=invalid-name
+StepFunctionType = Callable[[torch.Tensor, StateType], Tuple[torch.Tensor, StateType]]  # pylint: disable=invalid-name
+
+
+class SearchHistory:
+    """
+    Records the decoder outputs and the selected predictions of every step of a
+    beam search, so that a later search over the same instances can replay them
+    instead of calling the decoder again.
+
+    The decoder output of a step only depends on the prefix, so a replayed
+    search can reuse the cached outputs for as long as it selects exactly the
+    same predictions and backpointers as the recorded one. The first step where
+    the selection differs still reuses its cached output, and every step after
+    that calls the decoder (and is recorded for the next search).
+
+    Step 0 is the step from the start predictions, whose log-probabilities and
+    state tensors are (batch_size, *). The following steps have
+    (batch_size * beam_size, *) log-probabilities and state tensors.
+    """
+    def __init__(self) -> None:
+        # The raw (unconstrained) log-probabilities and the state returned by
+        # the decoder for every step
+        self.log_probs: List[torch.Tensor] = []
+        self.states: List[StateType] = []
+        # The (batch_size, beam_size) predictions and backpointers selected at
+        # every step. The backpointer of step 0 is None
+        self.predictions: List[torch.Tensor] = []
+        self.backpointers: List[Optional[torch.Tensor]] = []
+
+        self.replaying = True
+        self.num_replayed_steps = 0
+
+    def step(self,
+             timestep: int,
+             step: StepFunctionType,
+             last_predictions: torch.Tensor,
+             state: StateType) -> Tuple[torch.Tensor, StateType]:
+        """Returns the cached decoder output for `timestep` if possible, otherwise calls `step`."""
+        if self.replaying and timestep < len(self.log_probs):
+            self.num_replayed_steps += 1
+            # The search modifies both in place
+            return self.log_probs[timestep].clone(), dict(self.states[timestep])
+
+        self.replaying = False
+        del self.log_probs[timestep:]
+        del self.states[timestep:]
+        log_probs, state = step(last_predictions, state)
+        self.log_probs.append(log_probs.clone())
+        self.states.append(dict(state))
+        return log_probs, state
+
+    def select(self,
+               timestep: int,
+               predictions: torch.Tensor,
+               backpointer: Optional[torch.Tensor]) -> None:
+        """Records the selection of `timestep` and stops replaying if it differs from the cached one."""
+        if self.replaying and timestep < len(self.predictions):
+            cached_backpointer = self.backpointers[timestep]
+            if torch.equal(predictions, self.predictions[timestep]) and \
+                    (backpointer is None or torch.equal(backpointer, cached_backpointer)):
+                return
+            self.replaying = False
+
+        del self.predictions[timestep:]
+        del self.backpointers[timestep:]
+        # The decoder output of the next step depends on this selection
+        del self.log_probs[timestep + 1:]
+        del self.states[timestep + 1:]
+        self.predictions.append(predictions)
+        self.backpointers.append(backpointer)
+
+    def index_select(self, index: torch.Tensor) -> 'SearchHistory':
+        """Returns the history of the instances in `index`, ready to be replayed."""
+        history = SearchHistory()
+        if len(self.log_probs) == 0:
+            return history
+
+        batch_size = self.log_probs[0].size(0)
+        for timestep, (log_probs, state) in enumerate(zip(self.log_probs, self.states)):
+            history.log_probs.append(SearchHistory._select_instances(log_probs, index, batch_size, timestep))
+            history.states.append({key: SearchHistory._select_instances(state_tensor, index, batch_size, timestep)
+                                   for key, state_tensor in state.items()})
+        for predictions, backpointer in zip(self.predictions, self.backpointers):
+            history.predictions.append(predictions.index_select(0, index))
+            history.backpointers.append(None if backpointer is None else backpointer.index_select(0, index))
+        return history
+
+    @staticmethod
+    def _select_instances(state_tensor: torch.Tensor,
+                          index: torch.Tensor,
+                          batch_size: int,
+                          timestep: int) -> torch.Tensor:
+        if timestep == 0:
+            return state_tensor.index_select(0, index)
+        # shape: (batch_size, beam_size, *)
+        _, *last_dims = state_tensor.size()
+        state_tensor = state_tensor.reshape(batch_size, -1, *last_dims).index_select(0, index)
+        return state_tensor.reshape(-1, *last_dims)
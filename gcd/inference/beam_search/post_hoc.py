@@ -31,23 +31,26 @@ class PostHocBeamSearch(UnconstrainedBeamSearch):
                start_predictions: torch.Tensor,
                start_state: StateType,
                step: StepFunctionType,
-               constraint_sets: List[ConstraintSet]):
-        predictions, log_probs = self._search(start_predictions, start_state, step, None)
+               constraint_sets: List[ConstraintSet],
+               static_state_keys: List[str] = None,
+               valid_actions_mask_key: str = None):
+        predictions, log_probs = self._search(start_predictions, start_state, step, None, static_state_keys)
 
         # Select the output predictions by taking the first one which does not
         # violate any constraints OR the most probable
-        batch_size, beam_size, _ = predictions.size()
+        batch_size, beam_size, num_steps = predictions.size()
+        all_predictions = util.ensure_one_end_index_batch(predictions.reshape(-1, num_steps), self._end_index)
         best_predictions = []
         for batch, constraint_set in enumerate(constraint_sets):
+            beam_predictions = all_predictions[batch * beam_size:(batch + 1) * beam_size]
             best = None
-            for beam in range(beam_size):
-                prediction = util.ensure_one_end_index(predictions[batch, beam].tolist(), self._end_index)
+            for prediction in beam_predictions:
                 if constraint_set.get_violated_constraint(prediction) is None:
                     best = prediction
                     break
 
             if best is None:
-                best = util.ensure_one_end_index(predictions[batch, 0].tolist(), self._end_index)
+                best = beam_predictions[0]
             best_predictions.append(best)
 
         # The working set is empty by definition
@@ -34,8 +34,10 @@ class UnconstrainedBeamSearch(ConstrainedBeamSearch):
                 start_predictions: torch.Tensor,
                 start_state: StateType,
                 step: StepFunctionType,
-                constraint_sets: List[ConstraintSet]) -> Tuple[torch.Tensor, torch.Tensor]:
+                constraint_sets: List[ConstraintSet],
+                static_state_keys: List[str] = None) -> Tuple[torch.Tensor, torch.Tensor]:
         batch_size = start_predictions.size(0)
+        static_state_keys = set(static_state_keys or [])
 
         # List of (batch_size, beam_size) tensors. One for each time step. Does not
         # include the start symbols, which are implicit.
@@ -89,6 +91,8 @@ class UnconstrainedBeamSearch(ConstrainedBeamSearch):
 
         # Set the same state for each element in the beam.
         for key, state_tensor in state.items():
+            if key in static_state_keys:
+                continue
             _, *last_dims = state_tensor.size()
             # shape: (batch_size * beam_size, *)
             state[key] = state_tensor.\
@@ -176,6 +180,8 @@ class UnconstrainedBeamSearch(ConstrainedBeamSearch):
             # Keep only the pieces of the state tensors corresponding to the
             # ancestors created this iteration.
             for key, state_tensor in state.items():
+                if key in static_state_keys:
+                    continue
                 _, *last_dims = state_tensor.size()
                 # shape: (batch_size, beam_size, *)
                 expanded_backpointer = backpointer.\
@@ -227,9 +233,11 @@ class UnconstrainedBeamSearch(ConstrainedBeamSearch):
                start_predictions: torch.Tensor,
                start_state: StateType,
                step: StepFunctionType,
-               constraint_sets: List[ConstraintSet]):
-        predictions, log_probs = self._search(start_predictions, start_state, step, None)
-        top_predictions = [util.ensure_one_end_index(prediction[0].tolist(), self._end_index) for prediction in predictions]
+               constraint_sets: List[ConstraintSet],
+               static_state_keys: List[str] = None,
+               valid_actions_mask_key: str = None):
+        predictions, log_probs = self._search(start_predictions, start_state, step, None, static_state_keys)
+        top_predictions = util.ensure_one_end_index_batch(predictions[:, 0], self._end_index)
 
         # The working set is empty by definition
         batch_size = start_predictions.size(0)
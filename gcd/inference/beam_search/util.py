@@ -1,4 +1,5 @@
-from typing import List
+import torch
+from typing import List, Tuple
 
 
 def ensure_one_end_index(sequence: List[int], end_index: int):
@@ -14,3 +15,25 @@ def ensure_one_end_index(sequence: List[int], end_index: int):
         stripped.append(end_index)
 
     return stripped
+
+
+def truncate_at_end_index(predictions: torch.Tensor, end_index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    The vectorized version of `ensure_one_end_index` for (num_rows, num_steps)
+    predictions. Returns the (num_rows, num_steps + 1) predictions with an
+    `end_index` column appended, so that every row has one, and the (num_rows,)
+    lengths of the rows up to and including their first `end_index`.
+    """
+    end_column = predictions.new_full((predictions.size(0), 1), end_index)
+    tokens = torch.cat([predictions, end_column], dim=1)
+    # The number of tokens before the first end index. This does not rely on
+    # `argmax` returning the first of several maxima
+    lengths = (tokens.eq(end_index).long().cumsum(dim=1) == 0).long().sum(dim=1) + 1
+    return tokens, lengths
+
+
+def ensure_one_end_index_batch(predictions: torch.Tensor, end_index: int) -> List[List[int]]:
+    """ `ensure_one_end_index` of every row of the (num_rows, num_steps) predictions """
+    tokens, lengths = truncate_at_end_index(predictions, end_index)
+    # A single transfer instead of one per row
+    return [row[:length] for row, length in zip(tokens.tolist(), lengths.tolist())]
@@ -0,0 +1,100 @@
+import numpy as np
+import torch
+from typing import List, Optional
+
+from gcd.inference.constraints import ConstraintSet
+from rayuela.fsa.dfsa import DFSA
+
+
+class ViolationTracker:
+    """
+    Steps the automata of the non-working set constraints alongside the beams of
+    a search, without using them to mask anything, so that a violation can be
+    detected before the search is over.
+
+    An instance is flagged as soon as the top beam takes an action which is not
+    valid for one of its non-working constraints. No continuation of that beam
+    can satisfy the constraint, so the active set method can stop decoding the
+    instance, add the constraint to the working set and start again.
+
+    Only the top beam is checked, so the flagged constraint may not be the one
+    that the completed top prediction would have violated (or a lower beam may
+    have overtaken the top one). The constraints are still only ever added when
+    a prediction violates them, so the final predictions satisfy all of them.
+    """
+    def __init__(self, constraint_sets: List[ConstraintSet], end_index: int) -> None:
+        self._end_index = end_index
+        # The non-working constraints and their automata for every instance
+        self.constraint_indices: List[List[int]] = []
+        self.automata = []
+        for constraint_set in constraint_sets:
+            indices = sorted(constraint_set.non_working_set)
+            automata = [constraint_set.automata[index] for index in indices]
+            self.constraint_indices.append(indices)
+            # The array-backed form is much faster to step through
+            self.automata.append([automaton.dense() if isinstance(automaton, DFSA) else automaton
+                                  for automaton in automata])
+
+        # The index of the violated constraint of every instance, or None
+        self.violations: List[Optional[int]] = [None] * len(constraint_sets)
+        # The (num_beams,) states and stacks of every automaton of every instance,
+        # and whether each beam has already taken an invalid action. The states
+        # of those beams are not stepped anymore
+        self.states: List[List[np.ndarray]] = []
+        self.stacks: List[List[np.ndarray]] = []
+        self.dead: List[List[np.ndarray]] = []
+        for automata in self.automata:
+            self.states.append([np.array([automaton.get_start()], dtype=np.int64) for automaton in automata])
+            self.stacks.append([np.zeros(1, dtype=np.int64) for _ in automata])
+            self.dead.append([np.zeros(1, dtype=bool) for _ in automata])
+        # The (batch_size, num_beams) previous predictions, which are used to
+        # skip the beams which have already ended
+        self._last_predictions: np.ndarray = None
+
+    def update(self, predictions: torch.Tensor, backpointer: Optional[torch.Tensor] = None) -> None:
+        """
+        Steps the automata of every beam with the (batch_size, num_beams)
+        `predictions`, after reordering them with `backpointer` if given, and
+        flags the instances whose top beam is dead for one of the constraints.
+        """
+        predictions = predictions.cpu().numpy()
+        if backpointer is not None:
+            backpointer = backpointer.cpu().numpy()
+
+        if self._last_predictions is None:
+            ended = np.zeros(predictions.shape, dtype=bool)
+        else:
+            last_predictions = self._last_predictions
+            if backpointer is not None:
+                last_predictions = np.take_along_axis(last_predictions, backpointer, axis=1)
+            ended = last_predictions == self._end_index
+        self._last_predictions = predictions
+
+        for batch, automata in enumerate(self.automata):
+            if self.violations[batch] is not None:
+                continue
+            actions = predictions[batch]
+            for i, automaton in enumerate(automata):
+                states, stacks, dead = self.states[batch][i], self.stacks[batch][i], self.dead[batch][i]
+                if backpointer is not None:
+                    index = backpointer[batch]
+                else:
+                    # Every beam starts from the same state
+                    index = np.zeros(len(actions), dtype=np.int64)
+                states, stacks, dead = states[index], stacks[index], dead[index]
+
+                # Like the working set automata, the beams which have ended keep their states
+                live = np.flatnonzero(~dead & ~ended[batch])
+                valid = automaton.is_valid_batch(states[live], stacks[live], actions[live])
+                dead[live[~valid]] = True
+                live = live[valid]
+                if len(live) > 0:
+                    states[live], stacks[live] = automaton.step_batch(states[live], stacks[live], actions[live])
+                self.states[batch][i], self.stacks[batch][i], self.dead[batch][i] = states, stacks, dead
+
+                if dead[0]:
+                    self.violations[batch] = self.constraint_indices[batch][i]
+                    break
+
+    def all_violated(self) -> bool:
+        return all(violation is not None for violation in self.violations)
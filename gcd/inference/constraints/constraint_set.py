@@ -1,23 +1,52 @@
+import copy
+import numpy as np
 import torch
 from allennlp.common.from_params import FromParams
 from allennlp.data import Vocabulary
+from collections import Counter, OrderedDict
 from typing import Dict, List, Optional, Tuple
 
 from gcd.inference.constraints import Constraint
 from gcd.inference.constraints.parsing.util import hash_dict
+from rayuela.base import events, profiling
 from rayuela.base.automaton import Automaton
+from rayuela.fsa.dfsa import DFSA, DenseDFSA
+from rayuela.fsa.transformer import Transformer
 
 
 class ConstraintSet(FromParams):
+    # Bounded LRU cache of the intersections of working set automata, keyed by
+    # whether the intersection is lazy and the ids of the component automata (in
+    # constraint order). The components are stored next to the product so that
+    # their ids cannot be reused while the entry exists. Products of automata
+    # which are built per sentence are never hit again, and lazy products keep
+    # growing as they are decoded, so only the most recently used are kept.
+    intersection_cache: OrderedDict = OrderedDict()
+    max_intersection_cache_size = 128
+
     def __init__(self,
                  constraints: List[Constraint],
                  vocab: Vocabulary,
-                 namespace: str) -> None:
+                 namespace: str,
+                 lazy_intersection: bool = False) -> None:
+        """
+        args:
+            lazy_intersection: if True, the working set automata are intersected
+                with a `ProductAutomaton`, which only expands the product states
+                that decoding visits, instead of building the full product.
+        """
         self.constraints = constraints
+        self.lazy_intersection = lazy_intersection
         self.automata: List[Automaton] = []
         self.constraint_automaton: Automaton = None
+        # The automaton which is actually stepped during decoding. This is the
+        # array-backed form of `constraint_automaton` when it is a DFSA
+        self.decoding_automaton: Automaton = None
         self.working_set = set()
         self.non_working_set = set(range(len(constraints)))
+        # The counts of the events (see `rayuela.base.events`) recorded while
+        # setting up, intersecting and stepping the automata of this set
+        self.events: Counter = Counter()
 
         self.vocab = vocab
         self.namespace = namespace
@@ -26,13 +55,39 @@ class ConstraintSet(FromParams):
         self.token_to_key: Dict[str, int] = vocab.get_token_to_index_vocabulary(namespace)
         self.all_indices = list(self.token_to_key.values())
 
+        # Additive masks (0 for valid actions, -inf otherwise), one row per
+        # automaton (state, stack) seen so far. `_mask_rows` maps the pair
+        # to the row in `_masks`. Both are reset whenever the automaton changes.
+        self._mask_rows: Dict[Tuple[int, int], int] = {}
+        self._masks: torch.Tensor = None
+        # For a dense DFSA, the whole (num_states, vocab_size) additive mask and
+        # transition tables are built at once, so no state has to leave the device
+        self._mask_table: torch.Tensor = None
+        self._transition_table: torch.Tensor = None
+
+    def spawn(self) -> 'ConstraintSet':
+        """
+        Returns a new constraint set with the same constraints and vocabulary but
+        its own automata and working set, so that every instance in a batch can
+        be set up and searched independently.
+        """
+        constraint_set = copy.copy(self)
+        constraint_set.automata = []
+        constraint_set._set_constraint_automaton(None)
+        constraint_set.working_set = set()
+        constraint_set.non_working_set = set(range(len(self.constraints)))
+        constraint_set.events = Counter()
+        return constraint_set
+
     def setup(self, input_tokens: torch.Tensor, *args, **kwargs) -> None:
         dhash = hash_dict(self.token_to_key)
         self.automata = []
+        self.events = Counter()
         for constraint in self.constraints:
-            automaton = constraint.build(input_tokens, self.token_to_key, dhash, *args, **kwargs)
+            with profiling.timer(f'build.{constraint.get_name()}'), events.scope(self.events):
+                automaton = constraint.build(input_tokens, self.token_to_key, dhash, *args, **kwargs)
             self.automata.append(automaton)
-        self.constraint_automaton = None
+        self._set_constraint_automaton(None)
         self.working_set = set()
         self.non_working_set = set(range(len(self.constraints)))
 
@@ -44,25 +99,128 @@ class ConstraintSet(FromParams):
         return all(automaton.accepts(tokens) for automaton in self.automata)
 
     def get_start(self) -> int:
-        if self.constraint_automaton is None:
+        if self.decoding_automaton is None:
             return None
-        start = self.constraint_automaton.get_start()
+        start = self.decoding_automaton.get_start()
         # print(f'Getting start {start}')
         return start
 
     def step(self, state: int, stack: int, action: int) -> Tuple[int, int]:
-        if self.constraint_automaton is None:
+        if self.decoding_automaton is None:
             return None, None
         # print(f'Step with state {state}, stack {stack} and action {action}')
-        return self.constraint_automaton.step(state, stack, action)
+        with events.scope(self.events):
+            return self.decoding_automaton.step(state, stack, action)
 
     def get_valid_actions(self, state: int, stack: int) -> List[int]:
-        if self.constraint_automaton is None:
+        if self.decoding_automaton is None:
             return self.all_indices
-        actions = self.constraint_automaton.get_valid_actions(state, stack)
+        actions = self.decoding_automaton.get_valid_actions(state, stack)
         # print(f'Get valid actions with state {state}, stack {stack} and actions {actions}')
         return actions
 
+    def step_batch(self,
+                   states: torch.Tensor,
+                   stacks: torch.Tensor,
+                   actions: torch.Tensor,
+                   live: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Steps the (num_beams,) int64 tensors of states and stacks with the matching
+        actions. A dense DFSA is a lookup into its transition table, any other
+        automaton goes through its (numpy) `step_batch`. An invalid action leaves
+        the state unchanged and is counted as a stuck step.
+
+        args:
+            live: an optional (num_beams,) bool tensor of the beams which are
+                stepped. The other beams (e.g. the ones which have ended) keep
+                their states, and their actions are not counted as stuck.
+        """
+        if self.decoding_automaton is None:
+            return states, stacks
+
+        if isinstance(self.decoding_automaton, DenseDFSA):
+            if self._transition_table is None or self._transition_table.device != states.device:
+                table = self.decoding_automaton.get_transition_table(len(self.token_to_key))
+                self._transition_table = torch.from_numpy(table).to(states.device)
+            next_states = self._transition_table[states, actions]
+            # A missing arc leaves the state unchanged, like `DenseDFSA.step`
+            stuck = next_states == DenseDFSA.NO_STATE
+            if live is not None:
+                next_states = torch.where(live, next_states, states)
+                stuck = stuck & live
+            num_stuck = int(stuck.long().sum())
+            if num_stuck > 0:
+                with events.scope(self.events):
+                    events.record(events.STUCK_STEP, "DFSA step stuck", n=num_stuck)
+            next_states = torch.where(stuck, states, next_states)
+            return next_states, stacks
+
+        states_array, stacks_array, actions_array = states.cpu().numpy(), stacks.cpu().numpy(), actions.cpu().numpy()
+        if live is None:
+            with events.scope(self.events):
+                next_states, next_stacks = self.decoding_automaton.step_batch(states_array, stacks_array, actions_array)
+        else:
+            rows = np.flatnonzero(live.cpu().numpy())
+            next_states, next_stacks = states_array.copy(), stacks_array.copy()
+            if len(rows) > 0:
+                with events.scope(self.events):
+                    next_states[rows], next_stacks[rows] = \
+                        self.decoding_automaton.step_batch(states_array[rows], stacks_array[rows], actions_array[rows])
+        return torch.from_numpy(next_states).to(states.device), torch.from_numpy(next_stacks).to(stacks.device)
+
+    def get_valid_actions_mask(self,
+                               states: torch.Tensor,
+                               stacks: torch.Tensor,
+                               log_probs: torch.Tensor) -> Optional[torch.Tensor]:
+        """
+        Returns a (num_beams, vocab_size) additive mask which is 0 for the valid
+        actions of each (state, stack) and -inf otherwise, or None if there is
+        nothing to constrain. `log_probs` is only used for its size, dtype and device.
+        """
+        if self.decoding_automaton is None:
+            return None
+
+        if isinstance(self.decoding_automaton, DenseDFSA):
+            if self._mask_table is None or self._mask_table.device != log_probs.device \
+                    or self._mask_table.dtype != log_probs.dtype:
+                valid = self.decoding_automaton.get_valid_actions_mask(log_probs.size(-1))
+                mask_table = torch.from_numpy(np.where(valid, 0., float('-inf')))
+                self._mask_table = mask_table.to(device=log_probs.device, dtype=log_probs.dtype)
+            return self._mask_table.index_select(0, states)
+
+        rows = []
+        new_masks = []
+        for key in zip(states.tolist(), stacks.tolist()):
+            row = self._mask_rows.get(key)
+            if row is None:
+                row = len(self._mask_rows)
+                self._mask_rows[key] = row
+                new_masks.append(self._build_mask(key[0], key[1], log_probs))
+            rows.append(row)
+
+        if len(new_masks) > 0:
+            new_masks = torch.stack(new_masks)
+            if self._masks is None:
+                self._masks = new_masks
+            else:
+                self._masks = torch.cat([self._masks, new_masks], dim=0)
+
+        rows = torch.tensor(rows, dtype=torch.long, device=self._masks.device)
+        return self._masks.index_select(0, rows)
+
+    def _build_mask(self, state: int, stack: int, log_probs: torch.Tensor) -> torch.Tensor:
+        mask = log_probs.new_full((log_probs.size(-1),), float('-inf'))
+        valid_actions = list(self.get_valid_actions(state, stack))
+        if len(valid_actions) > 0:
+            mask[torch.tensor(valid_actions, dtype=torch.long, device=mask.device)] = 0.
+        return mask
+
+    def _reset_masks(self) -> None:
+        self._mask_rows = {}
+        self._masks = None
+        self._mask_table = None
+        self._transition_table = None
+
     def get_violated_constraint(self, tokens: List[int]) -> Optional[int]:
         """Returns the index of the constraint in the non-working set which is violated."""
         if len(self.non_working_set) == 0:
@@ -79,13 +237,44 @@ class ConstraintSet(FromParams):
         return [i for i, automaton in enumerate(self.automata) if not automaton.accept(tokens)]
 
     def add_contraint_to_working_set(self, index: int) -> None:
-        print(f'Adding {self.constraints[index].get_name()} to the working set')
+        with events.scope(self.events):
+            events.record(events.WORKING_SET_ADDITION, 'Adding %s to the working set',
+                          self.constraints[index].get_name())
+            self._add_contraint_to_working_set(index)
+
+    def _add_contraint_to_working_set(self, index: int) -> None:
+        profiling.count('working_set_additions')
         self.working_set.add(index)
         self.non_working_set.remove(index)
         if self.constraint_automaton is None:
-            self.constraint_automaton = self.automata[index]
+            self._set_constraint_automaton(self.automata[index])
+            return
+
+        components = [self.automata[i] for i in sorted(self.working_set)]
+        key = (self.lazy_intersection,) + tuple(id(automaton) for automaton in components)
+        cached = self.intersection_cache.get(key)
+        if cached is None:
+            with profiling.timer('intersect'):
+                if self.lazy_intersection:
+                    automaton = Transformer.lazy_intersect(self.constraint_automaton, self.automata[index])
+                else:
+                    automaton = self.constraint_automaton.intersect(self.automata[index])
+            self.intersection_cache[key] = (components, automaton)
+            if len(self.intersection_cache) > self.max_intersection_cache_size:
+                self.intersection_cache.popitem(last=False)
+        else:
+            profiling.count('intersection_cache_hits')
+            self.intersection_cache.move_to_end(key)
+            _, automaton = cached
+        self._set_constraint_automaton(automaton)
+
+    def _set_constraint_automaton(self, automaton: Optional[Automaton]) -> None:
+        self.constraint_automaton = automaton
+        if isinstance(automaton, DFSA):
+            self.decoding_automaton = automaton.dense()
         else:
-            self.constraint_automaton = self.constraint_automaton.intersect(self.automata[index])
+            self.decoding_automaton = automaton
+        self._reset_masks()
 
     def add_all_constraints_to_working_set(self) -> None:
         """Adds all of the constraints in the non-working set to the working set."""
@@ -0,0 +1,87 @@
+"""
+A content-addressed on-disk cache of compiled constraint automata. The entries
+are keyed by the constraint name, its parameters and the hash of the vocabulary,
+so they can be shared by any process that uses the same vocabulary. Each entry is
+a directory of raw .npy arrays (see `DenseDFSA.save`), which are memory-mapped
+when they are loaded. The dict-backed form of a loaded machine is only rebuilt
+if something needs it, e.g. an eager intersection.
+
+The cache lives in `~/.cache/gcd/automata` unless the `GCD_AUTOMATA_CACHE`
+environment variable says otherwise. Setting it to an empty string disables it.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Any, Dict, Optional
+
+from rayuela.base.automaton import Automaton
+from rayuela.fsa.dfsa import DFSA, DenseDFSA
+
+
+CACHE_DIR_ENV = 'GCD_AUTOMATA_CACHE'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gcd', 'automata')
+
+# Bump this whenever the construction or the format of any cached automaton changes.
+# 2: compiled machines are trimmed and minimized with Hopcroft's algorithm
+FORMAT_VERSION = 2
+
+
+def get_cache_dir() -> Optional[str]:
+    cache_dir = os.environ.get(CACHE_DIR_ENV, DEFAULT_CACHE_DIR)
+    return cache_dir or None
+
+
+def get_key(name: str, params: Dict[str, Any], dict_hash: str) -> str:
+    key = {'name': name, 'params': params, 'vocab': dict_hash, 'version': FORMAT_VERSION}
+    encoded = json.dumps(key, sort_keys=True).encode()
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def load(key: str) -> Optional[DFSA]:
+    """Returns the cached automaton for `key` or None if it is not in the cache."""
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['type'] != 'dfsa':
+            return None
+        return DFSA.from_dense(DenseDFSA.load(os.path.join(path, 'dfsa')), lazy=True)
+    except (OSError, ValueError, KeyError):
+        # A broken entry is treated like a missing one and gets rebuilt
+        return None
+
+
+def save(key: str, automaton: Automaton) -> None:
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return
+    path = os.path.join(cache_dir, key)
+    if os.path.isdir(path):
+        return
+
+    # Only the compiled machines are worth caching. The PDAs and the counters
+    # are built from the vocabulary alone
+    if not isinstance(automaton, DFSA):
+        return
+    meta, dfsa = {'type': 'dfsa'}, automaton
+
+    # Write everything into a temporary directory and then move it into place
+    # so that concurrent workers never see a partially written entry
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    try:
+        dfsa.dense().save(os.path.join(tmp_path, 'dfsa'))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process won the race (or the disk is not writable)
+        shutil.rmtree(tmp_path, ignore_errors=True)
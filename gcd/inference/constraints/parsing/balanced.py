@@ -1,7 +1,9 @@
 from collections import defaultdict
+import logging
 import torch
-from typing import Dict
+from typing import Dict, Optional, Tuple
 from gcd.inference.constraints.parsing import util
+from rayuela.base import events
 from rayuela.base.automaton import Automaton
 
 from rayuela.fsa.pda import PDA
@@ -10,30 +12,34 @@ from gcd.inference.constraints import Constraint
 
 @Constraint.register('balanced-parens')
 class BalancedParenthesesConstraint(Constraint):
-    cache: Dict[str, Dict[int, PDA]] = defaultdict(lambda: {})
-    def __init__(self, max_length: int) -> None:
+    # Keyed by (max_length, max_depth) and then by the vocabulary hash
+    cache: Dict[Tuple[int, Optional[int]], Dict[str, PDA]] = defaultdict(lambda: {})
+    def __init__(self, max_length: int, max_depth: Optional[int] = None) -> None:
+        """
+        args:
+            max_depth: if given, the maximum number of nested open phrases
+        """
         # max_length = 80
         self.max_length = max_length
-        from gcd.inference.constraints.parsing import MaxLengthConstraint
-        self.max_length_constraint = MaxLengthConstraint(max_length)
+        self.max_depth = max_depth
 
     def build(self,
               input_tokens: torch.Tensor,
               token_to_key: Dict[str, int],
               dict_hash: str = None, *args, **kwargs) -> Automaton:
         if dict_hash is None: dict_hash = util.hash_dict(token_to_key)
-        pda = self.cache[self.max_length].get(dict_hash)
+        pda = self.cache[self.max_length, self.max_depth].get(dict_hash)
         if pda is None:
-            print(f'Compiling a BalancedParenthesesConstraint with size {len(token_to_key)} vocab...')
-            # pda = PDA(token_to_key, max_length=self.max_length)
-            pda = PDA(token_to_key)
-            # For now, we don't allow PDAs with unbounded stacks, so we have
-            # to intersect this constraint with a maximum length constraint. This does
-            # not change the expressibility of the model
-            max_length_constraint = self.max_length_constraint.build(input_tokens, token_to_key, dict_hash)
-            pda = pda.intersect(max_length_constraint)
-            self.cache[self.max_length][dict_hash] = pda
-            
+            events.record(events.COMPILE, 'Compiling a BalancedParenthesesConstraint with size %d vocab...', len(token_to_key),
+                          level=logging.INFO)
+            # For now, we don't allow PDAs with unbounded stacks, so the PDA
+            # has a maximum length. This does not change the expressibility of
+            # the model. The length is part of the PDA state, so there is no
+            # need to intersect with a separate maximum length automaton
+            max_depth = float('inf') if self.max_depth is None else self.max_depth
+            pda = PDA(token_to_key, max_length=self.max_length, max_depth=max_depth)
+            self.cache[self.max_length, self.max_depth][dict_hash] = pda
+
         return pda
 
     def get_name(self) -> str:
@@ -1,11 +1,13 @@
+import logging
 import torch
 from allennlp.common.util import START_SYMBOL, END_SYMBOL
 from typing import Dict
 
+from rayuela.base import events
 from rayuela.base.automaton import Automaton
 from rayuela.fsa.dfsa import DFSA
 from rayuela.fsa.fsa import FSA, State
-from gcd.inference.constraints import Constraint
+from gcd.inference.constraints import Constraint, disk_cache
 from gcd.inference.constraints.parsing import util
 
 
@@ -22,7 +24,13 @@ class NonEmptyPhraseConstraint(Constraint):
         if dict_hash is None: dict_hash = util.hash_dict(token_to_key)
         dfsa = self.cache.get(dict_hash)
         if dfsa is None:
-            print(f'Compiling a NonEmptyPhraseConstraint with size {len(token_to_key)} vocab...')
+            cache_key = disk_cache.get_key(self.get_name(), {}, dict_hash)
+            dfsa = disk_cache.load(cache_key)
+            if dfsa is not None:
+                self.cache[dict_hash] = dfsa
+        if dfsa is None:
+            events.record(events.COMPILE, 'Compiling a NonEmptyPhraseConstraint with size %d vocab...', len(token_to_key),
+                          level=logging.INFO)
             fsa = FSA()
 
             # To write this automaton, we will first write an automaton
@@ -63,6 +71,7 @@ class NonEmptyPhraseConstraint(Constraint):
             # Finalize
             dfsa = fsa.compile()
             self.cache[dict_hash] = dfsa
+            disk_cache.save(cache_key, dfsa)
         
         return dfsa
 
@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 from allennlp.common.util import START_SYMBOL, END_SYMBOL
 from allennlp.data import Vocabulary
@@ -12,6 +13,14 @@ from typing import Dict, Optional, Tuple
 from gcd.inference.beam_search import ConstrainedBeamSearch
 from gcd.inference.constraints import ConstraintSet
 from gcd.models import util
+from gcd.modules.matrix_attention.mlp import MLPAttention
+from rayuela.base import profiling
+
+
+# The decoding state tensors which are the same for every beam of a sentence
+STATIC_STATE_KEYS = ['tokens_encoding', 'tokens_mask', 'tokens_projection']
+# The key of the additive masks of the valid actions in the decoding state
+VALID_ACTIONS_MASK_KEY = 'valid_actions_mask'
 
 
 @Model.register('parsing')
@@ -33,7 +42,16 @@ class ParsingModel(Model):
                  transformer_hidden_size: int = 2048,
                  transformer_dropout: float = 0.1,
                  initializer: InitializerApplicator = InitializerApplicator(),
-                 regularizer: Optional[RegularizerApplicator] = None) -> None:
+                 regularizer: Optional[RegularizerApplicator] = None,
+                 restrict_to_valid_actions: bool = False) -> None:
+        """
+        args:
+            restrict_to_valid_actions: if True, the beam search passes the valid
+                actions of the constraints to every decoder step, which normalizes
+                the distribution over them only. The output layer is only computed
+                for the valid actions, and not at all when there is only one. This
+                changes the scores of the beams, so the predictions can differ.
+        """
         super().__init__(vocab, regularizer)
         self.constraint_set = constraint_set
         self._token_embedder = token_embedder
@@ -70,6 +88,11 @@ class ParsingModel(Model):
         self._loss = torch.nn.CrossEntropyLoss(ignore_index=0)
 
         self.beam_search = beam_search
+        self.restrict_to_valid_actions = restrict_to_valid_actions
+        # The string of every nonterminal index, built by `decode` when it is first needed
+        self._nonterminal_strings: np.ndarray = None
+        # The scratch tensors of `_inference_step`, which are reused by every step
+        self._inference_buffers: Dict[str, torch.Tensor] = {}
 
         if dropout > 0:
             self.dropout = torch.nn.Dropout(dropout)
@@ -80,6 +103,8 @@ class ParsingModel(Model):
                       nonterminals: torch.Tensor,
                       state: Dict[str, torch.Tensor]):
         is_inference = nonterminals.dim() == 1
+        if is_inference and not self.training and self._decoder.num_layers == 1:
+            return self._inference_step(nonterminals, state)
         if is_inference:
             # shape: (group_size, 1)
             nonterminals = nonterminals.unsqueeze(-1)
@@ -95,22 +120,147 @@ class ParsingModel(Model):
         nonterminal_encoding, hidden = self._decoder(nonterminal_embedding, (hidden, memory))
         hidden = (self.dropout(hidden[0]), self.dropout(hidden[1]))
 
-        affinities = self._attention(nonterminal_encoding, tokens_encoding)
+        # The tokens tensors are not copied to every beam during inference
+        # (see `STATIC_STATE_KEYS`), so the beams of an instance attend to its
+        # tokens together, as if they were more decoder steps
+        group_size, num_steps, _ = nonterminal_encoding.size()
+        batch_size = tokens_encoding.size(0)
+        # shape: (batch_size, num_beams * num_steps, hidden_size)
+        decoder_outputs = nonterminal_encoding.reshape(batch_size, -1, nonterminal_encoding.size(2))
+
+        tokens_projection = state.get('tokens_projection')
+        if tokens_projection is None:
+            affinities = self._attention(decoder_outputs, tokens_encoding)
+        else:
+            affinities = self._attention(decoder_outputs, tokens_encoding, tokens_projection)
         attention = masked_softmax(affinities, tokens_mask)
 
-        context = attention.bmm(tokens_encoding)
+        context = attention.bmm(tokens_encoding).reshape(group_size, num_steps, -1)
         concat = torch.cat([nonterminal_encoding, context], dim=2)
         preoutput = self.dropout(torch.tanh(self._attention_layer(concat)))
         scores = self._output_layer(preoutput)
 
         if is_inference:
-            scores = torch.log_softmax(scores, dim=2).squeeze(1)
+            scores = scores.squeeze(1)
+            valid_actions_mask = state.get(VALID_ACTIONS_MASK_KEY)
+            if valid_actions_mask is not None:
+                scores = scores + self._get_renormalization_mask(valid_actions_mask)
+            scores = torch.log_softmax(scores, dim=1)
 
         output_state = dict(state)
         output_state['hidden'] = hidden[0].squeeze(0)
         output_state['memory'] = hidden[1].squeeze(0)
         return scores, output_state
 
+    def _inference_step(self,
+                        nonterminals: torch.Tensor,
+                        state: Dict[str, torch.Tensor]):
+        """
+        The same as `_decoder_step` for one step of a single layer decoder in
+        evaluation mode, without the overhead of the general path. The LSTM cell
+        is computed directly from the decoder weights with the gates updated
+        in place, the attention and output layers are applied without
+        concatenating their inputs, and there is no dropout.
+
+        The gates and the attention layer output are written into scratch
+        buffers which are reused by every step. The new hidden state and memory
+        are not: they are returned in the state, which the beam search reorders
+        and `SearchHistory` keeps around to replay later passes, so they cannot
+        be overwritten by the next step.
+        """
+        with torch.no_grad():
+            tokens_encoding = state['tokens_encoding']
+            hidden = state['hidden']
+            memory = state['memory']
+            group_size, hidden_size = hidden.size()
+
+            # shape: (group_size, embedding_dim)
+            nonterminal_embedding = self._nonterminal_embedder(nonterminals.unsqueeze(-1)).squeeze(1)
+
+            # The gates are in the order of `torch.nn.LSTM`: input, forget, cell and output
+            decoder = self._decoder
+            gates = self._get_inference_buffer('gates', hidden, group_size, 4 * hidden_size)
+            torch.addmm(decoder.bias_ih_l0, nonterminal_embedding, decoder.weight_ih_l0.t(), out=gates)
+            gates.add_(decoder.bias_hh_l0).addmm_(hidden, decoder.weight_hh_l0.t())
+            input_gate, forget_gate, cell_gate, output_gate = gates.chunk(4, dim=1)
+            input_gate.sigmoid_()
+            forget_gate.sigmoid_()
+            cell_gate.tanh_()
+            output_gate.sigmoid_()
+            memory = torch.mul(forget_gate, memory).addcmul_(input_gate, cell_gate)
+            hidden = torch.tanh(memory).mul_(output_gate)
+
+            # shape: (batch_size, num_beams, hidden_size)
+            decoder_outputs = hidden.view(tokens_encoding.size(0), -1, hidden_size)
+            tokens_projection = state.get('tokens_projection')
+            if tokens_projection is None:
+                affinities = self._attention(decoder_outputs, tokens_encoding)
+            else:
+                affinities = self._attention(decoder_outputs, tokens_encoding, tokens_projection)
+            attention = masked_softmax(affinities, state['tokens_mask'])
+            # shape: (group_size, hidden_size)
+            context = attention.bmm(tokens_encoding).view(group_size, -1)
+
+            # The attention layer is applied to the concatenation of the hidden
+            # state and the context, which is the sum of their projections
+            weight = self._attention_layer.weight
+            preoutput = self._get_inference_buffer('preoutput', hidden, group_size, hidden_size)
+            torch.addmm(self._attention_layer.bias, hidden, weight[:, :hidden_size].t(), out=preoutput)
+            preoutput.addmm_(context, weight[:, hidden_size:].t()).tanh_()
+            valid_actions_mask = state.get(VALID_ACTIONS_MASK_KEY)
+            if valid_actions_mask is None:
+                log_probs = torch.addmm(self._output_layer.bias, preoutput, self._output_layer.weight.t())
+                log_probs -= log_probs.logsumexp(dim=1, keepdim=True)
+            else:
+                log_probs = self._restricted_log_probs(preoutput, valid_actions_mask)
+
+        output_state = dict(state)
+        output_state['hidden'] = hidden
+        output_state['memory'] = memory
+        return log_probs, output_state
+
+    def _get_inference_buffer(self, name: str, like: torch.Tensor, *size: int) -> torch.Tensor:
+        """
+        The scratch tensor `name` of `_inference_step`, resized to `size`. Its
+        storage only grows, so the group sizes of the different steps share it.
+        """
+        buffer = self._inference_buffers.get(name)
+        if buffer is None or buffer.device != like.device or buffer.dtype != like.dtype:
+            buffer = like.new_empty(size)
+            self._inference_buffers[name] = buffer
+        return buffer.resize_(*size)
+
+    @staticmethod
+    def _get_renormalization_mask(valid_actions_mask: torch.Tensor) -> torch.Tensor:
+        """
+        The additive mask of the valid actions, except for the rows without any,
+        which are left unmasked so that they do not become NaN. The beam search
+        masks them afterwards anyway.
+        """
+        no_valid_actions = (valid_actions_mask == 0).long().sum(dim=1, keepdim=True) == 0
+        return valid_actions_mask.masked_fill(no_valid_actions, 0.)
+
+    def _restricted_log_probs(self, preoutput: torch.Tensor, valid_actions_mask: torch.Tensor) -> torch.Tensor:
+        """
+        The log-probabilities of the (group_size, vocab_size) output layer
+        normalized over the valid actions of every row. Only the columns of the
+        output layer which are valid for some row are computed.
+        """
+        is_valid = (valid_actions_mask == 0).long()
+        num_valid = is_valid.sum(dim=1)
+        if (num_valid == 1).all():
+            # The only valid action of every row has a probability of 1
+            return valid_actions_mask.to(dtype=preoutput.dtype, copy=True)
+
+        columns = is_valid.sum(dim=0).nonzero().squeeze(1)
+        scores = torch.addmm(self._output_layer.bias.index_select(0, columns),
+                             preoutput,
+                             self._output_layer.weight.index_select(0, columns).t())
+        scores += self._get_renormalization_mask(valid_actions_mask.index_select(1, columns))
+        scores -= scores.logsumexp(dim=1, keepdim=True)
+        log_probs = scores.new_full(valid_actions_mask.size(), float('-inf'))
+        return log_probs.index_copy_(1, columns, scores)
+
     def _compute_loss(self,
                       initial_decoding_state: Dict[str, torch.Tensor],
                       parses: Dict[str, torch.Tensor]) -> torch.Tensor:
@@ -124,6 +274,7 @@ class ParsingModel(Model):
 
     def _run_inference(self,
                        tokens: torch.Tensor,
+                       tokens_mask: torch.Tensor,
                        initial_decoding_state: Dict[str, torch.Tensor]) -> torch.Tensor:
         # Pull out a tensor to get the device and batch_size
         hidden = initial_decoding_state['hidden']
@@ -133,18 +284,32 @@ class ParsingModel(Model):
         initial_predictions = hidden.new_empty(batch_size, dtype=torch.long)
         initial_predictions.fill_(start_index)
 
-        # Setup the constraints for each instance. For now, we can only handle
-        # batch size 1 during inference. Cloning the constraint set is not
-        # implemented.
-        assert batch_size == 1
-        constraint_sets = [self.constraint_set]
-        constraint_sets[0].setup(tokens)
+        if isinstance(self._attention, MLPAttention):
+            # The encoder half of the attention is the same at every step, so
+            # it is computed once and carried in the decoding state
+            initial_decoding_state = dict(initial_decoding_state)
+            initial_decoding_state['tokens_projection'] = \
+                self._attention.project_encoder(initial_decoding_state['tokens_encoding'])
+
+        # Setup the constraints for each instance. Each instance gets its own
+        # copy of the constraint set because the automata are built from the
+        # (unpadded) input and the working set changes during the search.
+        lengths = tokens_mask.long().sum(dim=1).tolist()
+        constraint_sets = []
+        for instance_tokens, length in zip(tokens, lengths):
+            constraint_set = self.constraint_set.spawn()
+            constraint_set.setup(instance_tokens[:length].unsqueeze(0))
+            constraint_sets.append(constraint_set)
 
         # shape: (batch_size, beam_size, max_output_length)
         # shape: (batch_size, beam_size)
         predictions, _, working_sets, violated_constraints = \
-            self.beam_search.search(initial_predictions, initial_decoding_state, self._decoder_step, constraint_sets)
-        return predictions, working_sets, violated_constraints
+            self.beam_search.search(initial_predictions, initial_decoding_state, self._decoder_step, constraint_sets,
+                                    STATIC_STATE_KEYS,
+                                    VALID_ACTIONS_MASK_KEY if self.restrict_to_valid_actions else None)
+        # The stuck steps, compiles and working set additions of every sentence
+        events = [dict(constraint_set.events) for constraint_set in constraint_sets]
+        return predictions, working_sets, violated_constraints, events
 
     def _remap_hidden(self, hidden: Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
         # The hidden state from the RNN is
@@ -214,10 +379,20 @@ class ParsingModel(Model):
         if parses is not None:
             output_dict['loss'] = self._compute_loss(initial_decoding_state, parses)
         else:
-            predictions, working_sets, violated_constraints = self._run_inference(tokens['tokens'], initial_decoding_state)
+            profile_before = profiling.snapshot() if profiling.is_enabled() else None
+            predictions, working_sets, violated_constraints, events = \
+                self._run_inference(tokens['tokens'], tokens_mask, initial_decoding_state)
             output_dict['prediction'] = predictions
             output_dict['working_set'] = working_sets
             output_dict['violated_constraints'] = violated_constraints
+            output_dict['events'] = events
+            if profile_before is not None:
+                # The timers cover the whole batch and cannot be split between
+                # its sentences, so the totals of the batch are only attached to
+                # its first sentence. Summing them over the outputs gives the
+                # totals of the whole run
+                batch_profile = profiling.difference(profile_before, profiling.snapshot())
+                output_dict['batch_profile'] = [batch_profile] + [None] * (len(predictions) - 1)
         return output_dict
 
     @overrides
@@ -225,15 +400,10 @@ class ParsingModel(Model):
         start_index = self.vocab.get_token_index(START_SYMBOL, 'nonterminals')
         end_index = self.vocab.get_token_index(END_SYMBOL, 'nonterminals')
 
-        predictions = []
-        for prediction in output_dict['prediction']:
-            strings = []
-            for y in prediction:
-                if y == start_index:
-                    continue
-                if y == end_index:
-                    break
-                strings.append(self.vocab.get_token_from_index(y, 'nonterminals'))
-            predictions.append(' '.join(strings))
-        output_dict['prediction'] = predictions
+        if self._nonterminal_strings is None:
+            index_to_token = self.vocab.get_index_to_token_vocabulary('nonterminals')
+            self._nonterminal_strings = np.array([index_to_token[index] for index in range(len(index_to_token))],
+                                                 dtype=object)
+        output_dict['prediction'] = util.decode_predictions(output_dict['prediction'], self._nonterminal_strings,
+                                                            start_index, end_index)
         return output_dict
@@ -1,4 +1,6 @@
+import numpy as np
 import torch
+from itertools import chain
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from typing import List
 
@@ -48,3 +50,24 @@ def masked_topk(tensor: torch.Tensor, mask: torch.ByteTensor, k: int) -> List[in
     top_scores, top_indices = torch.topk(tensor[mask], k=k)
     top_indices = [nonzero[index] for index in top_indices]
     return top_scores, top_indices
+
+
+def decode_predictions(predictions: List[List[int]],
+                       strings: np.ndarray,
+                       start_index: int,
+                       end_index: int) -> List[str]:
+    """
+    Joins the strings of the tokens of every prediction, skipping the start
+    tokens and stopping at the first end token. `strings` is the array of the
+    token strings indexed by key, so every token is looked up at once.
+    """
+    lengths = [len(prediction) for prediction in predictions]
+    offsets = np.cumsum([0] + lengths)
+    flat = np.fromiter(chain.from_iterable(predictions), dtype=np.int64, count=offsets[-1])
+
+    # Every prediction stops at the first end token after its offset, if any
+    end_positions = np.append(np.flatnonzero(flat == end_index), len(flat))
+    stops = np.minimum(end_positions[np.searchsorted(end_positions, offsets[:-1])], offsets[1:])
+    words = strings[flat]
+    keep = flat != start_index
+    return [' '.join(words[start:stop][keep[start:stop]]) for start, stop in zip(offsets[:-1], stops)]
@@ -10,22 +10,36 @@ class MLPAttention(MatrixAttention):
                  decoder_dim: int,
                  attention_dim: int) -> None:
         super().__init__()
+        self.decoder_dim = decoder_dim
+        # W is applied to the concatenation of the decoder and encoder outputs,
+        # which is the same as the sum of their separate projections. The
+        # columns of the weight are split instead of having two layers so that
+        # trained models can still be loaded
         self.W = torch.nn.Linear(encoder_dim + decoder_dim, attention_dim)
         self.v = torch.nn.Linear(attention_dim, 1, bias=False)
 
+    def project_encoder(self, encoder_outputs: torch.Tensor) -> torch.Tensor:
+        """
+        The encoder half of W (with the bias) applied to the (batch_size,
+        num_encoder_tokens, encoder_dim) encoder outputs. It does not depend on
+        the decoder, so it can be computed once per sentence and passed to
+        every call to `forward`.
+        """
+        return torch.nn.functional.linear(encoder_outputs, self.W.weight[:, self.decoder_dim:], self.W.bias)
+
+    def project_decoder(self, decoder_outputs: torch.Tensor) -> torch.Tensor:
+        return torch.nn.functional.linear(decoder_outputs, self.W.weight[:, :self.decoder_dim])
+
     @overrides
     def forward(self,
                 decoder_outputs: torch.Tensor,
-                encoder_outputs: torch.Tensor) -> torch.Tensor:
-        num_decoder_tokens = decoder_outputs.size(1)
-        num_encoder_tokens = encoder_outputs.size(1)
-
-        decoder_outputs = decoder_outputs.unsqueeze(2)
-        encoder_outputs = encoder_outputs.unsqueeze(1)
-
-        decoder_outputs = decoder_outputs.expand(-1, -1, num_encoder_tokens, -1)
-        encoder_outputs = encoder_outputs.expand(-1, num_decoder_tokens, -1, -1)
+                encoder_outputs: torch.Tensor,
+                encoder_projection: torch.Tensor = None) -> torch.Tensor:
+        if encoder_projection is None:
+            encoder_projection = self.project_encoder(encoder_outputs)
+        decoder_projection = self.project_decoder(decoder_outputs)
 
-        concat = torch.cat([decoder_outputs, encoder_outputs], dim=-1)
-        affinities = self.v(torch.tanh(self.W(concat))).squeeze(-1)
+        # shape: (batch_size, num_decoder_tokens, num_encoder_tokens, attention_dim)
+        hidden = torch.tanh(decoder_projection.unsqueeze(2) + encoder_projection.unsqueeze(1))
+        affinities = self.v(hidden).squeeze(-1)
         return affinities
@@ -0,0 +1,41 @@
+import json
+import os
+import tempfile
+import unittest
+
+from gcd.benchmarks import decoding_speed
+from gcd.inference.constraints import disk_cache
+
+
+class TestDecodingSpeed(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        # The benchmark disables the disk cache through the environment
+        self.old_cache_dir = os.environ.get(disk_cache.CACHE_DIR_ENV)
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            os.environ.pop(disk_cache.CACHE_DIR_ENV, None)
+        else:
+            os.environ[disk_cache.CACHE_DIR_ENV] = self.old_cache_dir
+        self.tmp_dir.cleanup()
+
+    def test_synthetic(self):
+        output_file = os.path.join(self.tmp_dir.name, 'results.json')
+        args = decoding_speed.build_argument_parser().parse_args([
+            '--beam-sizes', '2',
+            '--vocab-sizes', '16',
+            '--max-steps', '20',
+            '--lengths', '3',
+            '--num-sentences', '2',
+            '--hidden-size', '8',
+            '--output-file', output_file,
+        ])
+        decoding_speed.main(args)
+
+        with open(output_file, 'r') as f:
+            results = json.load(f)
+        assert [result['strategy'] for result in results] == list(decoding_speed.STRATEGIES.keys())
+        for result in results:
+            assert result['sentences_per_second'] > 0
+            assert result['num_steps'] > 0
@@ -0,0 +1,17 @@
+import os
+import pytest
+
+from gcd.inference.constraints import disk_cache
+
+
+@pytest.fixture(autouse=True, scope='session')
+def disable_disk_cache():
+    # The tests must neither write into nor load from the cache in the home
+    # directory. The tests of the cache itself point it at a temporary directory
+    old_cache_dir = os.environ.get(disk_cache.CACHE_DIR_ENV)
+    os.environ[disk_cache.CACHE_DIR_ENV] = ''
+    yield
+    if old_cache_dir is None:
+        del os.environ[disk_cache.CACHE_DIR_ENV]
+    else:
+        os.environ[disk_cache.CACHE_DIR_ENV] = old_cache_dir
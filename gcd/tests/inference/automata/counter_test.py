@@ -0,0 +1,91 @@
+import numpy as np
+import unittest
+from allennlp.common.util import START_SYMBOL, END_SYMBOL
+
+from rayuela.fsa import counter
+from rayuela.fsa.counter import CounterAutomaton
+from rayuela.fsa.fsa import FSA
+from rayuela.fsa.pda import PDA
+from rayuela.fsa.product import ProductAutomaton
+from rayuela.fsa.state import State
+
+
+class TestCounterAutomaton(unittest.TestCase):
+    def setUp(self):
+        # 1 is the start, 2 the end, 3 is counted, 4 is ignored and 5 is invalid
+        self.start, self.end, self.counted, self.ignored, self.invalid = 1, 2, 3, 4, 5
+        key_to_class = {
+            1: counter.START,
+            2: counter.END,
+            3: counter.COUNTED,
+            4: counter.IGNORED,
+        }
+        # Between 1 and 2 counted tokens
+        self.counter = CounterAutomaton(key_to_class, 1, 2)
+
+    def test_accept(self):
+        s, e, c, i, x = self.start, self.end, self.counted, self.ignored, self.invalid
+        automaton = self.counter
+        assert automaton.accept([s, c, e])
+        assert automaton.accept([s, i, c, i, c, i, e])
+        assert not automaton.accept([s, e])
+        assert not automaton.accept([s, c, c, c, e])
+        assert not automaton.accept([s, c, x, e])
+        assert not automaton.accept([c, e])
+        assert not automaton.accept([s, c])
+        assert not automaton.accept([s, c, e, e])
+
+    def test_valid_actions(self):
+        s, e, c, i = self.start, self.end, self.counted, self.ignored
+        automaton = self.counter
+        state = automaton.get_start()
+        assert automaton.get_valid_actions(state, 0) == [s]
+        state, _ = automaton.step(state, 0, s)
+        assert automaton.get_valid_actions(state, 0) == [c, i]
+        state, _ = automaton.step(state, 0, c)
+        assert automaton.get_valid_actions(state, 0) == [e, c, i]
+        state, _ = automaton.step(state, 0, c)
+        assert automaton.get_valid_actions(state, 0) == [e, i]
+        state, _ = automaton.step(state, 0, e)
+        assert automaton.get_valid_actions(state, 0) == []
+        assert automaton.num_states == 9
+
+    def test_step_batch(self):
+        automaton = self.counter
+        for tokens in [[1, 3, 4, 3, 2], [1, 4, 4, 3, 2], [1, 3, 3, 3, 5]]:
+            state, stack = automaton.get_start(), 0
+            states = np.array([state], dtype=np.int64)
+            stacks = np.array([stack], dtype=np.int64)
+            for token in tokens:
+                valid = automaton.is_valid_batch(states, stacks, np.array([token]))
+                assert valid.tolist() == [token in automaton.get_valid_actions(state, stack)]
+                state, stack = automaton.step(state, stack, token)
+                states, stacks = automaton.step_batch(states, stacks, np.array([token]))
+                assert (states.tolist(), stacks.tolist()) == ([state], [stack])
+
+    def test_intersect(self):
+        # Accepts strings which do not contain a 4
+        fsa = FSA()
+        q = State(0)
+        fsa.set_I(q)
+        fsa.set_F(q)
+        for a in [1, 2, 3, 5, 6, 7]:
+            fsa.add_arc(q, a, q)
+        dfsa = fsa.compile()
+
+        intersection = self.counter.intersect(dfsa)
+        assert isinstance(intersection, ProductAutomaton)
+        assert intersection.accept([1, 3, 2])
+        assert not intersection.accept([1, 3, 4, 2])
+        assert not intersection.accept([1, 2])
+
+        # A PDA over a counter keeps it as is
+        token_to_key = {START_SYMBOL: 1, END_SYMBOL: 2, 'XX': 3, '(S': 6, ')': 7}
+        key_to_class = {1: counter.START, 2: counter.END, 3: counter.COUNTED, 6: counter.IGNORED, 7: counter.IGNORED}
+        pda = PDA(token_to_key, CounterAutomaton(key_to_class, 1, 1))
+        assert pda.accept([1, 6, 3, 7, 2])
+        assert not pda.accept([1, 6, 3, 3, 7, 2])
+        intersection = pda.intersect(dfsa)
+        assert isinstance(intersection, PDA)
+        assert isinstance(intersection.dfsa, ProductAutomaton)
+        assert intersection.accept([1, 6, 3, 7, 2])
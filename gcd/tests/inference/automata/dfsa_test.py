@@ -0,0 +1,211 @@
+import numpy as np
+import tempfile
+import unittest
+
+from rayuela.base.partitions import PartitionRefinement
+from rayuela.fsa.dfsa import DFSA, DenseDFSA
+from rayuela.fsa.fsa import FSA
+from rayuela.fsa.state import State
+
+
+class TestCompile(unittest.TestCase):
+    def test_deterministic(self):
+        fsa = FSA()
+        s = [State(i) for i in range(4)]
+        fsa.add_states(s)
+        fsa.set_I(s[0])
+        fsa.set_F(s[3])
+        fsa.add_arc(s[0], 1, s[1])
+        fsa.add_arc(s[1], 2, s[2])
+        fsa.add_arc(s[1], 3, s[1])
+        fsa.add_arc(s[2], 4, s[3])
+
+        # The fast path builds exactly what the generic constructor builds
+        expected = DFSA(fsa.determinize())
+        actual = fsa.compile()
+        assert actual.Q == expected.Q
+        assert actual.Sigma == expected.Sigma
+        assert actual.initial_state == expected.initial_state
+        assert actual.final_state == expected.final_state
+        assert all(actual.delta[q] == expected.delta[q] for q in expected.Q)
+
+    def test_nondeterministic(self):
+        # Accepts "1 1* 2 3"
+        fsa = FSA()
+        s = [State(i) for i in range(4)]
+        fsa.add_states(s)
+        fsa.set_I(s[0])
+        fsa.set_F(s[3])
+        fsa.add_arc(s[0], 1, s[1])
+        fsa.add_arc(s[1], 1, s[1])
+        fsa.add_arc(s[1], 1, s[2])
+        fsa.add_arc(s[1], 2, s[3])
+        fsa.add_arc(s[2], 2, s[3])
+        assert not fsa.deterministic
+
+        # The subsets are {0}, {1}, {1, 2} and {3}
+        dfsa = fsa.compile()
+        assert dfsa.num_states == 4
+        assert dfsa.accept([1, 2])
+        assert dfsa.accept([1, 1, 2])
+        assert dfsa.accept([1, 1, 1, 2])
+        assert not dfsa.accept([])
+        assert not dfsa.accept([1])
+        assert not dfsa.accept([2])
+        assert not dfsa.accept([1, 2, 2])
+
+
+class TestMinimize(unittest.TestCase):
+    def test_minimize(self):
+        # Accepts "1 (2|3) 4" through two equivalent branches, plus a dead state
+        fsa = FSA()
+        s = [State(i) for i in range(6)]
+        fsa.add_states(s)
+        fsa.set_I(s[0])
+        fsa.set_F(s[4])
+        fsa.add_arc(s[0], 1, s[1])
+        fsa.add_arc(s[1], 2, s[2])
+        fsa.add_arc(s[1], 3, s[3])
+        fsa.add_arc(s[2], 4, s[4])
+        fsa.add_arc(s[3], 4, s[4])
+        fsa.add_arc(s[1], 5, s[5])
+        dfsa = DFSA.from_boolean_fsa(fsa)
+        assert dfsa.num_states == 6
+
+        minimized = dfsa.minimize()
+        assert minimized.num_states == 4
+        assert minimized.Q == {0, 1, 2, 3}
+        for tokens in [[1, 2, 4], [1, 3, 4], [1, 4], [1, 5], [1, 2], []]:
+            assert minimized.accept(tokens) == dfsa.accept(tokens)
+        assert fsa.compile(minimize=True).num_states == 4
+
+    def test_minimize_without_arcs(self):
+        dfsa = DFSA.from_transitions(3, 0, 2, {}, set())
+        minimized = dfsa.minimize()
+        assert minimized.num_states == 2
+        assert not minimized.accept([])
+
+        dfsa = DFSA.from_transitions(2, 0, 0, {}, set())
+        minimized = dfsa.minimize()
+        assert minimized.num_states == 1
+        assert minimized.accept([])
+        assert not minimized.accept([1])
+
+    def test_trim(self):
+        # Accepts "1 2 3"; state 4 is a dead end and state 5 is unreachable
+        fsa = FSA()
+        s = [State(i) for i in range(6)]
+        fsa.add_states(s)
+        fsa.set_I(s[0])
+        fsa.set_F(s[3])
+        fsa.add_arc(s[0], 1, s[1])
+        fsa.add_arc(s[1], 2, s[2])
+        fsa.add_arc(s[2], 3, s[3])
+        fsa.add_arc(s[1], 4, s[4])
+        fsa.add_arc(s[5], 1, s[0])
+        assert fsa.accessible() == set(s[:5])
+        assert fsa.coaccessible() == set(s[:4]) | {s[5]}
+        assert fsa.trim().Q == set(s[:4])
+
+        dfsa = DFSA.from_boolean_fsa(fsa)
+        trimmed = dfsa.trim()
+        assert trimmed.num_states == 4
+        assert trimmed.trim() is trimmed
+        start = trimmed.get_start()
+        assert trimmed.get_valid_actions(trimmed.step(start, 0, 1)[0], 0) == [2]
+        for tokens in [[1, 2, 3], [1, 4], [1, 2], [5, 1, 2, 3]]:
+            assert trimmed.accept(tokens) == dfsa.accept(tokens)
+        assert fsa.compile().num_states == 4
+
+    def test_hopcroft_fast(self):
+        # Two functions on Z_6: x -> x + 2 and x -> x + 4 (mod 6). The coarsest
+        # stable refinement of {0, 1} | {2, 3, 4, 5} pairs up consecutive states
+        Q = set(range(6))
+        f = {q: (q + 2) % 6 for q in Q}
+        g = {q: (q + 4) % 6 for q in Q}
+        P = [frozenset([0, 1]), frozenset([2, 3, 4, 5])]
+        P = PartitionRefinement([f, g], Q).hopcroft_fast(P)
+        assert P == frozenset([frozenset([0, 1]), frozenset([2, 3]), frozenset([4, 5])])
+
+        P = [frozenset([0, 1, 2, 3, 4, 5])]
+        assert PartitionRefinement(f, Q).hopcroft_fast(P) == frozenset(P)
+
+
+class TestDenseDFSA(unittest.TestCase):
+    def setUp(self):
+        # Build an FSA that accepts "1 2 3" and "1 2 4"
+        fsa = FSA()
+        s = [State(i) for i in range(4)]
+        fsa.add_states(s)
+        fsa.set_I(s[0])
+        fsa.set_F(s[3])
+        fsa.add_arc(s[0], 1, s[1])
+        fsa.add_arc(s[1], 2, s[2])
+        fsa.add_arc(s[2], 3, s[3])
+        fsa.add_arc(s[2], 4, s[3])
+        self.dfsa = fsa.compile()
+        self.dense = self.dfsa.dense()
+
+    def test_table(self):
+        dense = self.dense
+        assert dense.delta.dtype == np.int32
+        assert dense.delta.shape == (4, 4)
+        assert dense.symbols.tolist() == [1, 2, 3, 4]
+        assert dense.valid_mask.sum() == 4
+        assert self.dfsa.dense() is dense
+
+    def test_accepts(self):
+        dense = self.dense
+        assert dense.accept([1, 2, 3])
+        assert dense.accept([1, 2, 4])
+        assert not dense.accept([1, 2])
+        assert not dense.accept([1, 2, 5])
+        assert not dense.accept([])
+
+    def test_step(self):
+        dfsa, dense = self.dfsa, self.dense
+        state = dense.get_start()
+        for action in [1, 2, 3]:
+            assert dense.get_valid_actions(state, 0) == sorted(dfsa.get_valid_actions(state, 0))
+            next_state, _ = dense.step(state, 0, action)
+            assert next_state == dfsa.step(state, 0, action)[0]
+            state = next_state
+        assert dense.get_valid_actions(state, 0) == []
+        assert state == dense.final_state
+
+    def test_step_batch(self):
+        dense = self.dense
+        start = dense.get_start()
+        states = np.array([start, start, start], dtype=np.int64)
+        stacks = np.zeros(3, dtype=np.int64)
+        # The last action has no arc (and 5 is not even in the alphabet), so those states do not change
+        states, stacks = dense.step_batch(states, stacks, np.array([1, 1, 5]))
+        assert states.tolist() == [dense.step(start, 0, 1)[0]] * 2 + [start]
+        one = dense.step(start, 0, 1)[0]
+        valid = dense.is_valid_batch(states, stacks, np.array([2, 3, 2]))
+        assert valid.tolist() == [2 in dense.get_valid_actions(one, 0), 3 in dense.get_valid_actions(one, 0), False]
+        states, _ = dense.step_batch(states, stacks, np.array([2, 3, 2]))
+        assert states.tolist() == [dense.step(one, 0, 2)[0], one, start]
+
+        table = dense.get_transition_table(6)
+        assert table.shape == (4, 6)
+        assert table[start, 1] == dense.step(start, 0, 1)[0]
+        assert table[start, 2] == DenseDFSA.NO_STATE
+
+    def test_valid_actions_mask(self):
+        mask = self.dense.get_valid_actions_mask(6)
+        assert mask.shape == (4, 6)
+        for state in range(4):
+            assert np.flatnonzero(mask[state]).tolist() == self.dense.get_valid_actions(state, 0)
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.dense.save(tmp_dir)
+            loaded = DenseDFSA.load(tmp_dir)
+            assert np.array_equal(loaded.delta, self.dense.delta)
+            assert np.array_equal(loaded.symbols, self.dense.symbols)
+
+            dfsa = DFSA.from_dense(loaded)
+            assert all(dfsa.delta[q] == self.dfsa.delta[q] for q in self.dfsa.Q)
+            assert dfsa.accept([1, 2, 3])
+            assert not dfsa.accept([1, 2])
@@ -1,9 +1,11 @@
+import numpy as np
+import random
 import torch
 import unittest
 from allennlp.common.util import END_SYMBOL, START_SYMBOL
 
 from rayuela.fsa.fsa import FSA
-from rayuela.fsa.pda import PDA
+from rayuela.fsa.pda import BUCKET_ALLOWED, NUM_PDA_STATES, PDA
 from rayuela.fsa.state import State
 
 
@@ -115,7 +117,10 @@ class TestPDA(unittest.TestCase):
         assert not fsa.accept([bos, a, a, b, c, c, eos])
 
         isect = self.pda.intersect(fsa)
-        
+        # The FSA is a new component instead of being multiplied out
+        assert len(isect.automata) == 2
+        assert isect.automata[0] is self.pda.automata[0]
+
         assert isect.accept([bos, a, b, c, eos])
         assert isect.accept([bos, a, c, eos])
         assert not isect.accept([bos, eos])
@@ -125,3 +130,120 @@ class TestPDA(unittest.TestCase):
         assert not isect.accept([bos, c, eos])
         assert not isect.accept([bos, a, a, b, c, c, eos])
         assert not isect.accept([bos, a, a, b, c, a, b, eos])
+
+    def test_token_classes(self):
+        from rayuela.fsa.pda import CLOSE, END, OPEN, OTHER, START
+        classes = self.pda.token_classes
+        assert classes[self.bos] == START
+        assert classes[self.eos] == END
+        assert classes[self.a] == OPEN
+        assert classes[self.b] == OTHER
+        assert classes[self.c] == CLOSE
+
+        # The valid actions are computed once per state
+        state, stack = self.pda.step(self.pda.get_start(), 0, self.bos)
+        actions = self.pda.get_valid_actions(state, stack)
+        assert self.pda.get_valid_actions(state, stack) is actions
+
+    def test_step_batch(self):
+        bos, eos = self.bos, self.eos
+        a, b, c = self.a, self.b, self.c
+        pda = self.pda
+        for tokens in [[bos, a, b, c, eos], [bos, a, a, b, c, c, eos], [bos, a, a, a, c, c, c, eos]]:
+            state, stack = pda.get_start(), 0
+            states = np.array([state], dtype=np.int64)
+            stacks = np.array([stack], dtype=np.int64)
+            for token in tokens:
+                valid = pda.is_valid_batch(states, stacks, np.array([token]))
+                assert valid.tolist() == [token in pda.get_valid_actions(state, stack)]
+                state, stack = pda.step(state, stack, token)
+                states, stacks = pda.step_batch(states, stacks, np.array([token]))
+                assert (states.tolist(), stacks.tolist()) == ([state], [stack])
+
+    def test_no_components(self):
+        bos, eos = self.bos, self.eos
+        a, b, c = self.a, self.b, self.c
+        pda = PDA(self.token_to_key)
+        assert pda.automata == []
+        assert pda.accept([bos, a, b, a, c, c, eos])
+        assert not pda.accept([bos, a, c, c, eos])
+
+        state, stack = pda.step(pda.get_start(), 0, bos)
+        # Key 0 is not in the vocabulary
+        assert pda.get_valid_actions(state, stack) == [a]
+        state, stack = pda.step(state, stack, a)
+        assert pda.get_valid_actions(state, stack) == [a, b, c]
+
+    def test_length_bound(self):
+        bos, eos = self.bos, self.eos
+        a, b, c = self.a, self.b, self.c
+        pda = PDA(self.token_to_key, max_length=6)
+        assert pda.accept([bos, a, a, b, c, c, eos])
+        assert pda.accept([bos, a, a, b, b, c, c, eos])
+        assert not pda.accept([bos, a, a, b, b, b, c, c, eos])
+
+        state, stack = pda.step(pda.get_start(), 0, bos)
+        for token in [a, a, b]:
+            state, stack = pda.step(state, stack, token)
+        # Two closing parentheses are still needed, so there is only room for one more terminal
+        assert pda.get_valid_actions(state, stack) == [b, c]
+        state, stack = pda.step(state, stack, b)
+        assert pda.get_valid_actions(state, stack) == [c]
+
+        # Every path of valid actions ends within the bound
+        random.seed(0)
+        for _ in range(100):
+            state, stack = pda.get_start(), 0
+            tokens = []
+            while True:
+                actions = pda.get_valid_actions(state, stack)
+                assert len(actions) > 0
+                token = random.choice(actions)
+                states, stacks = pda.step_batch(np.array([state]), np.array([stack]), np.array([token]))
+                state, stack = pda.step(state, stack, token)
+                assert (states.tolist(), stacks.tolist()) == ([state], [stack])
+                tokens.append(token)
+                if token == eos:
+                    break
+            assert pda.accept(tokens)
+            assert pda.get_valid_actions(state, stack) == []
+        # The valid actions do not depend on the length beyond its bucket
+        assert len(pda._valid_actions) <= NUM_PDA_STATES * len(BUCKET_ALLOWED)
+
+    def test_depth_bound(self):
+        bos, eos = self.bos, self.eos
+        a, b, c = self.a, self.b, self.c
+        pda = PDA(self.token_to_key, max_depth=2)
+        assert pda.accept([bos, a, a, b, c, c, eos])
+        assert not pda.accept([bos, a, a, a, b, c, c, c, eos])
+
+        state, stack = pda.step(pda.get_start(), 0, bos)
+        state, stack = pda.step(state, stack, a)
+        assert pda.get_valid_actions(state, stack) == [a, b, c]
+        state, stack = pda.step(state, stack, a)
+        assert pda.get_valid_actions(state, stack) == [b, c]
+        assert pda.is_valid_batch(np.array([state]), np.array([stack]), np.array([a, b])).tolist() == [False, True]
+
+    def test_intersection_keeps_depth_bound(self):
+        bos, eos = self.bos, self.eos
+        a, b, c = self.a, self.b, self.c
+        pda = PDA(self.token_to_key, max_depth=1, max_length=20)
+        deep = [bos, a, a, b, c, c, eos]
+        assert not pda.accept(deep)
+
+        # Any symbol but the end can be read any number of times
+        fsa = FSA()
+        q0, q1 = State(0), State(1)
+        fsa.set_I(q0)
+        fsa.set_F(q1)
+        for token in [bos, a, b, c]:
+            fsa.add_arc(q0, token, q0)
+        fsa.add_arc(q0, eos, q1)
+        dfsa = fsa.compile()
+
+        for other in [PDA(self.token_to_key, max_length=30), dfsa]:
+            for intersection in [pda.intersect(other), other.intersect(pda)]:
+                assert intersection.max_depth == 1
+                assert intersection.max_length == 20
+                assert not intersection.accept(deep)
+                assert intersection.accept([bos, a, b, c, eos])
@@ -0,0 +1,83 @@
+import numpy as np
+import unittest
+
+from rayuela.fsa.fsa import FSA
+from rayuela.fsa.product import ProductAutomaton
+from rayuela.fsa.state import State
+
+
+class TestProductAutomaton(unittest.TestCase):
+    def setUp(self):
+        # Accepts "1 (2|3)* 4"
+        fsa1 = FSA()
+        s = [State(i) for i in range(3)]
+        fsa1.add_states(s)
+        fsa1.set_I(s[0])
+        fsa1.set_F(s[2])
+        fsa1.add_arc(s[0], 1, s[1])
+        fsa1.add_arc(s[1], 2, s[1])
+        fsa1.add_arc(s[1], 3, s[1])
+        fsa1.add_arc(s[1], 4, s[2])
+        self.dfsa1 = fsa1.compile()
+
+        # Accepts strings with exactly one 3
+        fsa2 = FSA()
+        fsa2.add_states(s)
+        fsa2.set_I(s[0])
+        fsa2.set_F(s[1])
+        for a in [1, 2, 4]:
+            fsa2.add_arc(s[0], a, s[0])
+            fsa2.add_arc(s[1], a, s[1])
+        fsa2.add_arc(s[0], 3, s[1])
+        self.dfsa2 = fsa2.compile()
+
+        self.product = ProductAutomaton([self.dfsa1, self.dfsa2])
+
+    def test_accepts(self):
+        product = self.product
+        assert product.accept([1, 3, 4])
+        assert product.accept([1, 2, 3, 2, 4])
+        assert not product.accept([1, 2, 4])
+        assert not product.accept([1, 3, 3, 4])
+        assert not product.accept([3, 1, 4])
+
+    def test_step(self):
+        product = self.product
+        state = product.get_start()
+        assert product.num_states == 1
+        assert sorted(product.get_valid_actions(state, 0)) == [1]
+        state, _ = product.step(state, 0, 1)
+        assert sorted(product.get_valid_actions(state, 0)) == [2, 3, 4]
+        state, _ = product.step(state, 0, 3)
+        assert sorted(product.get_valid_actions(state, 0)) == [2, 4]
+        state, _ = product.step(state, 0, 4)
+        assert product.get_valid_actions(state, 0) == []
+        # Only the states on the path were expanded
+        assert product.num_states == 4
+
+    def test_memo_is_bounded(self):
+        product = ProductAutomaton([self.dfsa1, self.dfsa2], max_memo_size=1)
+        state, _ = product.step(product.get_start(), 0, 1)
+        for action in [2, 3, 2]:
+            product.get_valid_actions(state, 0)
+            state, _ = product.step(state, 0, action)
+        assert len(product._valid_actions) <= 1
+        assert len(product._transitions) <= 1
+        assert state == product.step(product.step(product.get_start(), 0, 1)[0], 0, 3)[0]
+
+    def test_nested(self):
+        nested = ProductAutomaton([self.product, self.dfsa1])
+        assert len(nested.automata) == 3
+        assert nested.accept([1, 3, 4])
+
+    def test_step_batch(self):
+        product = self.product
+        start = product.get_start()
+        states = np.array([start, start, start], dtype=np.int64)
+        stacks = np.zeros(3, dtype=np.int64)
+        states, stacks = product.step_batch(states, stacks, np.array([1, 1, 1]))
+        states, stacks = product.step_batch(states, stacks, np.array([2, 3, 4]))
+        for state, action in zip(states.tolist(), [2, 3, 4]):
+            expected, _ = product.step(product.step(start, 0, 1)[0], 0, action)
+            assert state == expected
+        assert stacks.tolist() == [0, 0, 0]
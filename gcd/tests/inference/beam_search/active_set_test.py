@@ -0,0 +1,154 @@
+import torch
+import unittest
+from allennlp.common.util import START_SYMBOL, END_SYMBOL
+from allennlp.data import Vocabulary
+
+from gcd.inference.beam_search.active_set import ActiveSetBeamSearch
+from gcd.inference.constraints import ConstraintSet
+from gcd.inference.constraints.parsing import BalancedParenthesesConstraint, NonEmptyPhraseConstraint, \
+    NumTokensConstraint
+from rayuela.base import profiling
+
+
+class TestActiveSetBeamSearch(unittest.TestCase):
+    def setUp(self):
+        self.vocab = Vocabulary()
+        for token in [START_SYMBOL, END_SYMBOL, '(S', '(NP', '(VP', 'XX', ')']:
+            self.vocab.add_token_to_namespace(token, 'nonterminals')
+        vocab_size = self.vocab.get_vocab_size('nonterminals')
+
+        # A small random RNN to decode with
+        torch.manual_seed(0)
+        self.embeddings = torch.randn(vocab_size, 16)
+        self.hidden_weights = torch.randn(16, 16) / 4
+        self.output_weights = torch.randn(16, vocab_size)
+        self.num_steps = 0
+        self.end_index = self.vocab.get_token_index(END_SYMBOL, 'nonterminals')
+
+        constraints = [NumTokensConstraint(), NonEmptyPhraseConstraint(), BalancedParenthesesConstraint(30)]
+        self.constraint_set = ConstraintSet(constraints, self.vocab, 'nonterminals')
+
+    def _step(self, last_predictions, state):
+        self.num_steps += 1
+        hidden = torch.tanh(state['hidden'].mm(self.hidden_weights) + self.embeddings[last_predictions])
+        output_state = dict(state, hidden=hidden)
+        if 'bias' in state:
+            # The bias is not copied to every beam if it is a static key
+            bias = state['bias']
+            self.bias_sizes.add(bias.size(0))
+            num_beams = hidden.size(0) // bias.size(0)
+            hidden = hidden + bias.unsqueeze(1).expand(-1, num_beams, -1).reshape(hidden.size())
+        scores = hidden.mm(self.output_weights)
+        if 'mask' in state:
+            # Normalize over the valid actions of the rows which have any
+            mask = state['mask']
+            self.mask_sizes.append(tuple(mask.size()))
+            is_valid = mask == 0
+            num_valid = is_valid.long().sum(dim=1)
+            self.num_forced_to_end += int(((num_valid == 1) & is_valid[:, self.end_index]).long().sum())
+            scores = scores + mask.masked_fill((num_valid == 0).unsqueeze(1), 0.)
+        return torch.log_softmax(scores, dim=1), output_state
+
+    def _search(self,
+                resume: bool,
+                early_violation_detection: bool = False,
+                static_state_keys=None,
+                valid_actions_mask_key=None,
+                skip_forced_steps=True):
+        beam_search = ActiveSetBeamSearch(self.vocab, 4, 'nonterminals', max_steps=40, resume=resume,
+                                          early_violation_detection=early_violation_detection)
+        beam_search.skip_forced_steps = skip_forced_steps
+        constraint_sets = []
+        for num_tokens in [2, 3, 4]:
+            constraint_set = self.constraint_set.spawn()
+            constraint_set.setup(torch.zeros(1, num_tokens + 2, dtype=torch.long))
+            constraint_sets.append(constraint_set)
+        start_index = self.vocab.get_token_index(START_SYMBOL, 'nonterminals')
+        start_predictions = torch.full((3,), start_index, dtype=torch.long)
+        start_state = {'hidden': torch.zeros(3, 16), 'bias': torch.randn(3, 16, generator=torch.Generator().manual_seed(1))}
+
+        self.num_steps = 0
+        self.bias_sizes = set()
+        self.mask_sizes = []
+        self.num_forced_to_end = 0
+        predictions, log_probs, working_sets, _ = \
+            beam_search.search(start_predictions, start_state, self._step, constraint_sets, static_state_keys,
+                               valid_actions_mask_key)
+        self.num_early_violations = beam_search.num_early_violations
+        return predictions, log_probs, working_sets, beam_search.num_saved_steps, self.num_steps
+
+    def test_resume_matches_restart(self):
+        predictions, log_probs, working_sets, saved_steps, num_steps = self._search(resume=False)
+        resumed_predictions, resumed_log_probs, resumed_working_sets, resumed_saved_steps, resumed_num_steps = \
+            self._search(resume=True)
+
+        assert predictions == resumed_predictions
+        assert torch.equal(log_probs, resumed_log_probs)
+        assert working_sets == resumed_working_sets
+        assert saved_steps == 0
+        assert resumed_saved_steps > 0
+        assert resumed_num_steps == num_steps - resumed_saved_steps
+
+    def test_early_violation_detection(self):
+        _, _, _, _, num_steps = self._search(resume=False)
+        # The search asserts that the predictions satisfy all of the constraints
+        _, _, working_sets, _, early_num_steps = self._search(resume=False, early_violation_detection=True)
+        assert self.num_early_violations > 0
+        assert early_num_steps < num_steps
+        assert all(len(working_set) > 0 for working_set in working_sets)
+
+    def test_profiling(self):
+        profiling.enable()
+        try:
+            before = profiling.snapshot()
+            _, _, working_sets, _, num_steps = self._search(resume=False)
+            profile = profiling.difference(before, profiling.snapshot())
+        finally:
+            profiling.disable()
+
+        assert profile['decoder_step.calls'] == num_steps
+        assert profile['apply_constraints.calls'] == num_steps
+        assert profile['topk.seconds'] > 0
+        num_additions = sum(len(working_set) for working_set in working_sets)
+        assert profile['working_set_additions'] == num_additions
+        assert profile['active_set_restarts'] == num_additions
+        assert profile['active_set_passes'] > 1
+
+        # Nothing is recorded while profiling is disabled
+        before = profiling.snapshot()
+        self._search(resume=False)
+        assert profiling.difference(before, profiling.snapshot()) == {}
+
+    def test_static_state_keys(self):
+        for resume in [False, True]:
+            predictions, log_probs, working_sets, _, _ = self._search(resume)
+            assert max(self.bias_sizes) == 12
+            static_predictions, static_log_probs, static_working_sets, _, _ = \
+                self._search(resume, static_state_keys=['bias'])
+            assert max(self.bias_sizes) == 3
+            assert predictions == static_predictions
+            assert torch.allclose(log_probs, static_log_probs)
+            assert working_sets == static_working_sets
+
+    def test_valid_actions_mask(self):
+        self._search(resume=False)
+        assert self.mask_sizes == []
+        predictions, log_probs, working_sets, saved_steps, mask_num_steps = \
+            self._search(resume=True, valid_actions_mask_key='mask', skip_forced_steps=False)
+        # The outputs of the previous passes are not replayed
+        assert saved_steps == 0
+        assert self.num_forced_to_end > 0
+
+        # There are no masks in the first pass, where every working set is empty
+        vocab_size = self.vocab.get_vocab_size('nonterminals')
+        assert 0 < len(self.mask_sizes) < mask_num_steps
+        num_instances = self.mask_sizes[0][0]
+        assert self.mask_sizes[:2] == [(num_instances, vocab_size), (num_instances * 4, vocab_size)]
+
+        # The steps where every beam can only end are skipped, with the same results
+        skipped_predictions, skipped_log_probs, skipped_working_sets, _, skipped_num_steps = \
+            self._search(resume=True, valid_actions_mask_key='mask')
+        assert skipped_predictions == predictions
+        assert torch.allclose(skipped_log_probs, log_probs)
+        assert skipped_working_sets == working_sets
+        assert skipped_num_steps < mask_num_steps
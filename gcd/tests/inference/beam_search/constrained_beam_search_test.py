@@ -0,0 +1,86 @@
+import random
+import torch
+import unittest
+from allennlp.common.util import START_SYMBOL, END_SYMBOL
+from allennlp.data import Vocabulary
+
+from gcd.inference.beam_search.full_intersection import FullIntersectionBeamSearch
+from gcd.inference.constraints import ConstraintSet
+from gcd.inference.constraints.parsing import BalancedParenthesesConstraint, NonEmptyPhraseConstraint
+
+
+class TestConstrainedBeamSearch(unittest.TestCase):
+    def setUp(self):
+        self.vocab = Vocabulary()
+        for token in [START_SYMBOL, END_SYMBOL, '(S', '(NP', 'XX', ')']:
+            self.vocab.add_token_to_namespace(token, 'nonterminals')
+        self.beam_search = FullIntersectionBeamSearch(self.vocab, beam_size=4, namespace='nonterminals')
+
+        constraints = [BalancedParenthesesConstraint(8), NonEmptyPhraseConstraint()]
+        self.constraint_set = ConstraintSet(constraints, self.vocab, 'nonterminals')
+        self.constraint_set.setup(None)
+        self.constraint_set.force_full_intersection()
+
+    def _random_walk(self, num_steps: int):
+        constraint_set = self.constraint_set
+        state, stack = constraint_set.get_start(), 0
+        for _ in range(num_steps):
+            actions = constraint_set.get_valid_actions(state, stack)
+            if len(actions) == 0:
+                break
+            state, stack = constraint_set.step(state, stack, random.choice(actions))
+        return state, stack
+
+    def test_apply_constraints_matches_reference(self):
+        random.seed(0)
+        beam_size = 4
+        vocab_size = self.vocab.get_vocab_size('nonterminals')
+        for num_steps in range(10):
+            states, stacks = zip(*[self._random_walk(num_steps) for _ in range(beam_size)])
+            states, stacks = torch.tensor([states]), torch.tensor([stacks])
+
+            log_probs = torch.log_softmax(torch.randn(1, beam_size, vocab_size), dim=-1)
+            expected = log_probs.clone()
+            self.beam_search._apply_constraints_reference([self.constraint_set], expected, states, stacks)
+            actual = log_probs.clone()
+            self.beam_search._apply_constraints([self.constraint_set], actual, states, stacks)
+
+            finite = torch.isfinite(expected)
+            assert torch.equal(finite, torch.isfinite(actual))
+            assert torch.equal(expected[finite], actual[finite])
+
+    def test_is_forced_to_end(self):
+        vocab_size = self.vocab.get_vocab_size('nonterminals')
+        end_index = self.vocab.get_token_index(END_SYMBOL, 'nonterminals')
+        other_index = self.vocab.get_token_index('XX', 'nonterminals')
+        only_end = torch.full((vocab_size,), float('-inf'))
+        only_end[end_index] = 0.
+        end_or_other = only_end.clone()
+        end_or_other[other_index] = 0.
+        nothing = torch.full((vocab_size,), float('-inf'))
+
+        masks = torch.stack([only_end, nothing, end_or_other])
+        # The last beam can still go on, unless it has already ended
+        assert not self.beam_search._is_forced_to_end(masks, torch.tensor([other_index, other_index, other_index]))
+        assert self.beam_search._is_forced_to_end(masks, torch.tensor([other_index, other_index, end_index]))
+        assert not self.beam_search._is_forced_to_end(masks, torch.tensor([end_index, end_index, other_index]))
+
+    def test_update_states_and_stacks_matches_step(self):
+        random.seed(0)
+        beam_size = 4
+        end_index = self.vocab.get_token_index(END_SYMBOL, 'nonterminals')
+        for num_steps in range(10):
+            states, stacks = zip(*[self._random_walk(num_steps) for _ in range(beam_size)])
+            actions = []
+            for state, stack in zip(states, stacks):
+                valid_actions = self.constraint_set.get_valid_actions(state, stack)
+                actions.append(random.choice(valid_actions) if len(valid_actions) > 0 else end_index)
+
+            next_states, next_stacks = self.beam_search._update_states_and_stacks(
+                [self.constraint_set], torch.tensor([actions]), torch.tensor([states]), torch.tensor([stacks]))
+            for beam, (state, stack, action) in enumerate(zip(states, stacks, actions)):
+                if action == end_index:
+                    expected = (state, stack)
+                else:
+                    expected = self.constraint_set.step(state, stack, action)
+                assert (next_states[0, beam].item(), next_stacks[0, beam].item()) == expected
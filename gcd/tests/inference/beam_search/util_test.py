@@ -0,0 +1,24 @@
+import random
+import torch
+import unittest
+
+from gcd.inference.beam_search import util
+
+
+class TestUtil(unittest.TestCase):
+    def test_ensure_one_end_index_batch_matches_reference(self):
+        random.seed(0)
+        end_index = 3
+        predictions = torch.tensor([[random.randint(0, 5) for _ in range(8)] for _ in range(50)])
+        predictions[0] = 1  # no end index at all
+        predictions[1, 0] = end_index
+        predictions[2, -1] = end_index
+
+        expected = [util.ensure_one_end_index(row, end_index) for row in predictions.tolist()]
+        assert util.ensure_one_end_index_batch(predictions, end_index) == expected
+
+        tokens, lengths = util.truncate_at_end_index(predictions, end_index)
+        assert tokens.size() == (50, 9)
+        assert lengths.tolist() == [len(row) for row in expected]
+        assert lengths[0].item() == 9
+        assert lengths[1].item() == 1
@@ -0,0 +1,113 @@
+import logging
+import torch
+import unittest
+from collections import OrderedDict
+from allennlp.common.util import START_SYMBOL, END_SYMBOL
+from allennlp.data import Vocabulary
+
+from gcd.inference.constraints import ConstraintSet
+from gcd.inference.constraints.parsing import MaxLengthConstraint, NonEmptyPhraseConstraint
+from rayuela.base import events
+
+
+class TestConstraintSet(unittest.TestCase):
+    def setUp(self):
+        vocab = Vocabulary()
+        for token in [START_SYMBOL, END_SYMBOL, '(NT', 'XX', ')']:
+            vocab.add_token_to_namespace(token, 'nonterminals')
+        constraints = [MaxLengthConstraint(5), NonEmptyPhraseConstraint()]
+        self.constraint_set = ConstraintSet(constraints, vocab, 'nonterminals')
+
+    def test_spawn(self):
+        first = self.constraint_set.spawn()
+        second = self.constraint_set.spawn()
+        first.setup(None)
+        second.setup(None)
+
+        first.add_contraint_to_working_set(1)
+        assert first.get_working_set() == ['non-empty-phrase']
+        assert second.get_working_set() == []
+        assert second.constraint_automaton is None
+        assert first.token_to_key is second.token_to_key
+        assert self.constraint_set.automata == []
+
+    def test_intersection_cache(self):
+        first = self.constraint_set.spawn()
+        second = self.constraint_set.spawn()
+        first.setup(None)
+        second.setup(None)
+
+        first.add_contraint_to_working_set(0)
+        first.add_contraint_to_working_set(1)
+        # The same working set added in a different order reuses the product
+        second.add_contraint_to_working_set(1)
+        second.add_contraint_to_working_set(0)
+        assert first.constraint_automaton is second.constraint_automaton
+
+    def test_intersection_cache_is_bounded(self):
+        old_cache, old_size = ConstraintSet.intersection_cache, ConstraintSet.max_intersection_cache_size
+        ConstraintSet.intersection_cache, ConstraintSet.max_intersection_cache_size = OrderedDict(), 2
+        try:
+            constraint_sets = []
+            for max_length in [5, 6, 7]:
+                # Every constraint set has its own length automaton, so nothing is shared
+                constraint_set = ConstraintSet([MaxLengthConstraint(max_length), NonEmptyPhraseConstraint()],
+                                               self.constraint_set.vocab, 'nonterminals')
+                constraint_set.setup(None)
+                constraint_set.force_full_intersection()
+                constraint_sets.append(constraint_set)
+            assert len(ConstraintSet.intersection_cache) == 2
+            # The least recently used product was evicted
+            cached = [automaton for _, automaton in ConstraintSet.intersection_cache.values()]
+            assert constraint_sets[0].constraint_automaton not in cached
+            assert constraint_sets[2].constraint_automaton in cached
+        finally:
+            ConstraintSet.intersection_cache, ConstraintSet.max_intersection_cache_size = old_cache, old_size
+
+    def test_events(self):
+        first = self.constraint_set.spawn()
+        second = self.constraint_set.spawn()
+        first.setup(None)
+        second.setup(None)
+        first.add_contraint_to_working_set(0)
+        first.add_contraint_to_working_set(1)
+        assert first.events[events.WORKING_SET_ADDITION] == 2
+        assert second.events[events.WORKING_SET_ADDITION] == 0
+
+        # END_SYMBOL cannot be read first, so the step is stuck
+        end_index = first.token_to_key[END_SYMBOL]
+        first.step(first.get_start(), 0, end_index)
+        assert first.events[events.STUCK_STEP] > 0
+        assert events.STUCK_STEP not in second.events
+
+    def test_step_batch_counts_stuck_steps(self):
+        for lazy_intersection in [False, True]:
+            # A dense DFSA is stepped on the device, a lazy product through numpy
+            constraint_set = ConstraintSet(self.constraint_set.constraints, self.constraint_set.vocab, 'nonterminals',
+                                           lazy_intersection=lazy_intersection)
+            constraint_set.setup(None)
+            constraint_set.force_full_intersection()
+            start_index = constraint_set.token_to_key[START_SYMBOL]
+            end_index = constraint_set.token_to_key[END_SYMBOL]
+
+            # END_SYMBOL cannot be read first, but the second beam is not live
+            states = torch.full((3,), constraint_set.get_start(), dtype=torch.long)
+            stacks = torch.zeros(3, dtype=torch.long)
+            actions = torch.tensor([end_index, end_index, start_index])
+            live = torch.tensor([0, 1, 0]) == 0
+            next_states, _ = constraint_set.step_batch(states, stacks, actions, live)
+            assert constraint_set.events[events.STUCK_STEP] == 1
+            assert next_states[:2].tolist() == states[:2].tolist()
+            assert next_states[2].item() == constraint_set.step(states[2].item(), 0, start_index)[0]
+
+    def test_event_logging_is_rate_limited(self):
+        events.set_log_limit(2)
+        try:
+            with self.assertLogs(events.logger, logging.DEBUG) as logs:
+                for _ in range(5):
+                    events.record(events.STUCK_STEP, 'Step stuck')
+        finally:
+            events.set_log_limit(10)
+        # Only the first two are logged, and then the suppression
+        assert len(logs.output) == 3
+        assert 'Suppressing' in logs.output[-1]
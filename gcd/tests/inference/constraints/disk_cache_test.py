@@ -0,0 +1,65 @@
+import numpy as np
+import os
+import tempfile
+import unittest
+from allennlp.common.util import START_SYMBOL, END_SYMBOL
+
+from gcd.inference.constraints import disk_cache
+from gcd.inference.constraints.parsing import BalancedParenthesesConstraint, NonEmptyPhraseConstraint
+from rayuela.fsa.pda import PDA
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_cache_dir = os.environ.get(disk_cache.CACHE_DIR_ENV)
+        os.environ[disk_cache.CACHE_DIR_ENV] = self.tmp_dir.name
+        self.token_to_key = {
+            START_SYMBOL: 1,
+            END_SYMBOL: 2,
+            '(NT': 3,
+            'XX': 4,
+            ')': 5
+        }
+
+    def tearDown(self):
+        if self.old_cache_dir is None:
+            del os.environ[disk_cache.CACHE_DIR_ENV]
+        else:
+            os.environ[disk_cache.CACHE_DIR_ENV] = self.old_cache_dir
+        self.tmp_dir.cleanup()
+
+    def test_dfsa_round_trip(self):
+        key = disk_cache.get_key('non-empty-phrase', {}, 'vocab')
+        assert disk_cache.load(key) is None
+
+        dfsa = NonEmptyPhraseConstraint().build(None, self.token_to_key, 'vocab')
+        disk_cache.save(key, dfsa)
+        loaded = disk_cache.load(key)
+        # The memory-mapped machine is decoded as is
+        assert isinstance(loaded.dense().delta, np.memmap)
+        assert loaded.num_states == dfsa.num_states
+        assert 'delta' not in loaded.__dict__
+        assert all(loaded.delta[q] == dfsa.delta[q] for q in dfsa.Q)
+        assert loaded.accept([1, 3, 4, 5, 2])
+        assert not loaded.accept([1, 3, 5, 2])
+
+    def test_pdas_are_not_saved(self):
+        dfsa = NonEmptyPhraseConstraint().build(None, self.token_to_key, 'vocab')
+        key = disk_cache.get_key('pda', {}, 'other-vocab')
+        disk_cache.save(key, PDA(self.token_to_key, dfsa))
+        assert disk_cache.load(key) is None
+
+    def test_counters_are_not_saved(self):
+        # The counters are built from the vocabulary alone, so there is nothing to cache
+        constraint = BalancedParenthesesConstraint(6)
+        key = disk_cache.get_key(constraint.get_name(), {'max_length': 6}, 'vocab')
+        disk_cache.save(key, constraint.build(None, self.token_to_key, 'vocab'))
+        assert disk_cache.load(key) is None
+
+    def test_disabled(self):
+        os.environ[disk_cache.CACHE_DIR_ENV] = ''
+        key = disk_cache.get_key('non-empty-phrase', {}, 'vocab')
+        disk_cache.save(key, NonEmptyPhraseConstraint().build(None, self.token_to_key, 'vocab'))
+        assert disk_cache.load(key) is None
+        assert os.listdir(self.tmp_dir.name) == []
@@ -31,3 +31,19 @@ class TestBalancedParenthesesConstraint(unittest.TestCase):
         assert not automaton.accept([start, nt, end])
         # Balanced but too long
         assert not automaton.accept([start, nt, nt, nt, nt, xx, close, close, close, close, end])
+
+    def test_max_depth(self):
+        start, end = 1, 2
+        nt, xx, close = 3, 4, 5
+        token_to_key = {
+            START_SYMBOL: 1,
+            END_SYMBOL: 2,
+            '(NT': 3,
+            'XX': 4,
+            ')': 5
+        }
+        deep = [start, nt, nt, xx, close, close, end]
+        assert BalancedParenthesesConstraint(8).build(None, token_to_key).accept(deep)
+        automaton = BalancedParenthesesConstraint(8, max_depth=1).build(None, token_to_key)
+        assert automaton.accept([start, nt, xx, close, end])
+        assert not automaton.accept(deep)
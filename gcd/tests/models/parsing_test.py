@@ -0,0 +1,107 @@
+import torch
+import unittest
+from allennlp.common.util import START_SYMBOL, END_SYMBOL
+from allennlp.data import Vocabulary
+from allennlp.modules.text_field_embedders import BasicTextFieldEmbedder
+from allennlp.modules.token_embedders import Embedding
+
+from gcd.inference.constraints import ConstraintSet
+from gcd.inference.constraints.parsing import BalancedParenthesesConstraint
+from gcd.models.parsing import ParsingModel, VALID_ACTIONS_MASK_KEY
+from gcd.modules.matrix_attention.mlp import MLPAttention
+
+
+class TestInferenceStep(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.vocab = Vocabulary()
+        for token in ['the', 'dog', 'barks']:
+            self.vocab.add_token_to_namespace(token, 'tokens')
+        for nonterminal in [START_SYMBOL, END_SYMBOL, '(S', '(NP', '(VP', 'XX', ')']:
+            self.vocab.add_token_to_namespace(nonterminal, 'nonterminals')
+        self.vocab_size = self.vocab.get_vocab_size('nonterminals')
+
+        hidden_size = 8
+        token_embedder = BasicTextFieldEmbedder({
+            'tokens': Embedding(self.vocab.get_vocab_size('tokens'), 5)
+        })
+        nonterminal_embedder = Embedding(self.vocab_size, 6)
+        attention = MLPAttention(hidden_size, hidden_size, 7)
+        constraint_set = ConstraintSet([BalancedParenthesesConstraint(10)], self.vocab, 'nonterminals')
+        self.model = ParsingModel(self.vocab, token_embedder, nonterminal_embedder, 1, attention,
+                                  constraint_set, None, hidden_size=hidden_size, dropout=0.0)
+
+        # 2 sentences with 3 beams each, the second sentence has 3 tokens out of 5
+        batch_size, beam_size, num_tokens = 2, 3, 5
+        self.group_size = batch_size * beam_size
+        tokens_encoding = torch.randn(batch_size, num_tokens, hidden_size)
+        tokens_mask = torch.ones(batch_size, num_tokens)
+        tokens_mask[1, 3:] = 0
+        self.state = {
+            'tokens_encoding': tokens_encoding,
+            'tokens_mask': tokens_mask,
+            'hidden': torch.randn(self.group_size, hidden_size),
+            'memory': torch.randn(self.group_size, hidden_size),
+        }
+        self.nonterminals = torch.randint(0, self.vocab_size, (self.group_size,))
+
+    def _run_steps(self, state):
+        # Without dropout, the general path of the training mode computes the same step
+        self.model.eval()
+        log_probs, output_state = self.model._decoder_step(self.nonterminals, state)
+        assert 'gates' in self.model._inference_buffers
+        self.model.train()
+        expected_log_probs, expected_state = self.model._decoder_step(self.nonterminals, state)
+        self.model.eval()
+
+        assert torch.allclose(output_state['hidden'], expected_state['hidden'], atol=1e-6)
+        assert torch.allclose(output_state['memory'], expected_state['memory'], atol=1e-6)
+        return log_probs, expected_log_probs.detach()
+
+    def _assert_log_probs_equal(self, log_probs, expected_log_probs):
+        is_finite = torch.isfinite(expected_log_probs)
+        assert torch.equal(torch.isfinite(log_probs), is_finite)
+        assert torch.allclose(log_probs[is_finite], expected_log_probs[is_finite], atol=1e-5)
+
+    def _with_projection(self, state):
+        state = dict(state)
+        state['tokens_projection'] = self.model._attention.project_encoder(state['tokens_encoding'])
+        return state
+
+    def test_unrestricted(self):
+        for state in [self.state, self._with_projection(self.state)]:
+            log_probs, expected_log_probs = self._run_steps(state)
+            self._assert_log_probs_equal(log_probs, expected_log_probs)
+
+    def test_restricted(self):
+        valid_actions_mask = torch.full((self.group_size, self.vocab_size), float('-inf'))
+        valid_actions_mask[0, [2, 3]] = 0
+        valid_actions_mask[1, 4] = 0
+        valid_actions_mask[2, :] = 0
+        valid_actions_mask[3, 5] = 0
+        valid_actions_mask[4, [1, 2, 3]] = 0
+        # The last row has no valid actions
+        state = dict(self.state)
+        state[VALID_ACTIONS_MASK_KEY] = valid_actions_mask
+
+        for state in [state, self._with_projection(state)]:
+            log_probs, expected_log_probs = self._run_steps(state)
+            self._assert_log_probs_equal(log_probs[:-1], expected_log_probs[:-1])
+            assert torch.allclose(log_probs[:-1].exp().sum(dim=1), torch.ones(self.group_size - 1))
+            # The beam search masks the row without valid actions, it only must not be NaN
+            assert not torch.isnan(log_probs[-1]).any()
+            assert not torch.isnan(expected_log_probs[-1]).any()
+
+    def test_single_valid_action(self):
+        valid_actions_mask = torch.full((self.group_size, self.vocab_size), float('-inf'))
+        valid_actions_mask[torch.arange(self.group_size),
+                           torch.randint(0, self.vocab_size, (self.group_size,))] = 0
+        state = dict(self.state)
+        state[VALID_ACTIONS_MASK_KEY] = valid_actions_mask
+
+        log_probs, expected_log_probs = self._run_steps(state)
+        assert torch.equal(log_probs, valid_actions_mask)
+        self._assert_log_probs_equal(log_probs, expected_log_probs)
+        # The mask of the state is not returned itself
+        log_probs.fill_(0.)
+        assert torch.isinf(valid_actions_mask).any()
@@ -0,0 +1,32 @@
+import torch
+import unittest
+
+from gcd.modules.matrix_attention.mlp import MLPAttention
+
+
+class TestMLPAttention(unittest.TestCase):
+    def _concat_affinities(self, attention: MLPAttention, decoder_outputs, encoder_outputs):
+        # W applied to the concatenation of the decoder and encoder outputs
+        num_decoder_tokens = decoder_outputs.size(1)
+        num_encoder_tokens = encoder_outputs.size(1)
+        decoder_outputs = decoder_outputs.unsqueeze(2).expand(-1, -1, num_encoder_tokens, -1)
+        encoder_outputs = encoder_outputs.unsqueeze(1).expand(-1, num_decoder_tokens, -1, -1)
+        concat = torch.cat([decoder_outputs, encoder_outputs], dim=-1)
+        return attention.v(torch.tanh(attention.W(concat))).squeeze(-1)
+
+    def test_split_projections_match_concat(self):
+        torch.manual_seed(0)
+        # Equal sizes would not catch swapped halves by their shapes alone
+        for encoder_dim, decoder_dim in [(6, 4), (5, 5)]:
+            attention = MLPAttention(encoder_dim, decoder_dim, 7)
+            decoder_outputs = torch.randn(2, 3, decoder_dim)
+            encoder_outputs = torch.randn(2, 4, encoder_dim)
+
+            expected = self._concat_affinities(attention, decoder_outputs, encoder_outputs)
+            affinities = attention(decoder_outputs, encoder_outputs)
+            assert affinities.size() == (2, 3, 4)
+            assert torch.allclose(affinities, expected, atol=1e-6)
+
+            encoder_projection = attention.project_encoder(encoder_outputs)
+            affinities = attention(decoder_outputs, encoder_outputs, encoder_projection)
+            assert torch.allclose(affinities, expected, atol=1e-6)
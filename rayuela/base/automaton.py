@@ -1,4 +1,5 @@
 from typing import Tuple
+import numpy as np
 
 class Automaton:
     def accept(self, tokens: list) -> bool:
@@ -18,3 +19,21 @@ class Automaton:
     def step(self, state: int, stack: int, action) -> Tuple[int, int]:  # returns to state, to stack
         raise NotImplemented
 
+    def get_valid_actions_row(self, state: int, stack: int, num_actions: int) -> np.ndarray:
+        """ the (num_actions,) boolean mask of the valid actions. Automata with few distinct masks should precompute them """
+        row = np.zeros(num_actions, dtype=bool)
+        row[self.get_valid_actions(state, stack)] = True
+        return row
+
+    def step_batch(self, states: np.ndarray, stacks: np.ndarray, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ steps every (state, stack) pair with the matching action. Automata with array-backed transitions should override this loop """
+        next_states = np.empty_like(states)
+        next_stacks = np.empty_like(stacks)
+        for i, (state, stack, action) in enumerate(zip(states.tolist(), stacks.tolist(), actions.tolist())):
+            next_states[i], next_stacks[i] = self.step(state, stack, action)
+        return next_states, next_stacks
+
+    def is_valid_batch(self, states: np.ndarray, stacks: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        """ returns whether each action is valid from its (state, stack) pair. Like `step_batch`, this loop should be overridden """
+        return np.array([action in self.get_valid_actions(state, stack)
+                         for state, stack, action in zip(states.tolist(), stacks.tolist(), actions.tolist())], dtype=bool)
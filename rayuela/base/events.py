@@ -0,0 +1,80 @@
+import logging
+from collections import Counter
+from typing import Dict, List
+
+
+# Counts of notable events (stuck steps, compiles, working set additions, ...)
+# which used to be printed to stdout. Every event is always counted, and it is
+# logged to the 'rayuela.base.events' logger at the given level. Only the first
+# `log_limit` events of every name are logged, so that an event on the
+# per-token path cannot flood the output. Nothing is written by default, since
+# the events are logged at DEBUG or INFO.
+#
+# The counts are global, and they are also added to every counter pushed with
+# `scope`, which is how a `ConstraintSet` gets the counts of its own sentence.
+
+STUCK_STEP = 'stuck_step'
+COMPILE = 'compile'
+INTERSECT = 'intersect'
+DETERMINIZE = 'determinize'
+NORMALIZE = 'normalize'
+MINIMIZE = 'minimize'
+WORKING_SET_ADDITION = 'working_set_addition'
+
+logger = logging.getLogger(__name__)
+
+_counts: Counter = Counter()
+_scopes: List[Counter] = []
+# The number of times every event has been logged
+_logged: Counter = Counter()
+_log_limit = 10
+
+
+def set_log_limit(log_limit: int) -> None:
+    """ logs at most `log_limit` events of every name (and then says so once) """
+    global _log_limit
+    _log_limit = log_limit
+    _logged.clear()
+
+
+def record(name: str, message: str = None, *args, level: int = logging.DEBUG, n: int = 1) -> None:
+    """
+    Adds `n` to the count of the event `name`, and logs `message % args` if
+    the logger is enabled for `level` and the event has not reached the limit.
+    """
+    _counts[name] += n
+    for counts in _scopes:
+        counts[name] += n
+    if message is None or not logger.isEnabledFor(level):
+        return
+    num_logged = _logged[name]
+    if num_logged < _log_limit:
+        _logged[name] += 1
+        logger.log(level, message, *args)
+    elif num_logged == _log_limit:
+        _logged[name] += 1
+        logger.log(level, 'Suppressing further %s events', name)
+
+
+def counts() -> Dict[str, int]:
+    return dict(_counts)
+
+
+def reset() -> None:
+    _counts.clear()
+    _logged.clear()
+
+
+class scope:
+    """ a context manager which also adds the events recorded in it to `counts` """
+    __slots__ = ['counts']
+
+    def __init__(self, counts: Counter) -> None:
+        self.counts = counts
+
+    def __enter__(self) -> Counter:
+        _scopes.append(self.counts)
+        return self.counts
+
+    def __exit__(self, *args) -> None:
+        _scopes.pop()
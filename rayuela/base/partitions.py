@@ -6,8 +6,12 @@ from itertools import product
 class PartitionRefinement:
 
 	def __init__(self, f, Q):
-	
-		self.f = f
+
+		# `f` is either a single function from Q to Q (as a dict) or a list of
+		# such functions, e.g., one per symbol of a complete DFSA. Only
+		# `hopcroft_fast` refines with respect to several functions.
+		self.fs = f if isinstance(f, list) else [f]
+		self.f = self.fs[0]
 		self.Q = Q
 
 		# compute the pre-image of f
@@ -100,8 +104,70 @@ class PartitionRefinement:
 		return frozenset(P)
 
 	def hopcroft_fast(self, P):
+		"""
+		Hopcroft's algorithm in O(|fs|·|Q|·log|Q|) time. States and blocks are
+		integer-indexed, and a splitter only visits the pre-images of its own
+		members through the inverse-transition index, instead of rescanning
+		every block.
+		"""
+
+		states = list(self.Q)
+		index = {q: n for n, q in enumerate(states)}
+
+		# finvs[k][n] lists the states m with f_k(m) = n
+		finvs = []
+		for f in self.fs:
+			finv = [[] for _ in states]
+			for q in states:
+				finv[index[f[q]]].append(index[q])
+			finvs.append(finv)
+
+		blocks = [set(index[q] for q in B) for B in P if len(B) > 0]
+		block_of = [0] * len(states)
+		for b, B in enumerate(blocks):
+			for n in B:
+				block_of[n] = b
+
+		# The (block, function) splitters. All blocks but the largest are needed.
+		largest = max(range(len(blocks)), key=lambda b: len(blocks[b]))
+		waiting = set((b, k) for b in range(len(blocks)) for k in range(len(self.fs)) if b != largest)
+		stack = list(waiting)
+
+		while stack:
+			b, k = stack.pop()
+			if (b, k) not in waiting:
+				continue
+			waiting.remove((b, k))
+
+			# the pre-image of the splitter, grouped by the block it falls in
+			touched = dd(list)
+			finv = finvs[k]
+			for n in blocks[b]:
+				for m in finv[n]:
+					touched[block_of[m]].append(m)
+
+			for c, X in touched.items():
+				if len(X) == len(blocks[c]):
+					continue
+
+				# X becomes a new block and c keeps the rest
+				new = len(blocks)
+				blocks.append(set(X))
+				blocks[c].difference_update(X)
+				for n in X:
+					block_of[n] = new
+
+				for j in range(len(self.fs)):
+					if (c, j) in waiting:
+						splitter = (new, j)
+					elif len(blocks[new]) <= len(blocks[c]):
+						splitter = (new, j)
+					else:
+						splitter = (c, j)
+					waiting.add(splitter)
+					stack.append(splitter)
 
-		raise NotImplementedError
+		return frozenset(frozenset(states[n] for n in B) for B in blocks)
 
 	def moore(self, P):
 
@@ -0,0 +1,140 @@
+import atexit
+import functools
+import os
+import time
+from collections import defaultdict
+from typing import Dict
+
+
+# Named timers and counters for the hot paths of constraint compilation and
+# decoding. Profiling is enabled by setting the GCD_PROFILE environment
+# variable (or by calling `enable`). When it is disabled, `timer` returns a
+# shared no-op context manager and `count` returns immediately, so the hooks
+# can stay in the code.
+#
+# The totals are printed as a summary when the process exits. `snapshot` and
+# `difference` can be used to get the totals of one region, e.g. one batch.
+
+_enabled = bool(os.environ.get('GCD_PROFILE'))
+
+# The total seconds and the number of calls of every timer
+_seconds: Dict[str, float] = defaultdict(float)
+_calls: Dict[str, int] = defaultdict(int)
+# The total of every counter
+_counts: Dict[str, int] = defaultdict(int)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def reset() -> None:
+    _seconds.clear()
+    _calls.clear()
+    _counts.clear()
+
+
+class _Timer:
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> '_Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        _seconds[self.name] += time.perf_counter() - self.start
+        _calls[self.name] += 1
+
+
+class _NullTimer:
+    __slots__ = []
+
+    def __enter__(self) -> '_NullTimer':
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name: str):
+    """ a context manager which adds the time spent in it to the timer `name` """
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def timed(name: str):
+    """ a decorator which adds the time spent in the function to the timer `name` """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, n: int = 1) -> None:
+    """ adds `n` to the counter `name` """
+    if _enabled:
+        _counts[name] += n
+
+
+def snapshot() -> Dict[str, float]:
+    """
+    The current totals, keyed by '<timer>.seconds', '<timer>.calls' and
+    '<counter>'.
+    """
+    totals = {}
+    for name, seconds in _seconds.items():
+        totals[f'{name}.seconds'] = seconds
+        totals[f'{name}.calls'] = _calls[name]
+    totals.update(_counts)
+    return totals
+
+
+def difference(before: Dict[str, float], after: Dict[str, float]) -> Dict[str, float]:
+    """ the totals of the region between two snapshots, without the unchanged entries """
+    return {name: after[name] - before.get(name, 0) for name in sorted(after)
+            if after[name] != before.get(name, 0)}
+
+
+def summary() -> str:
+    lines = []
+    if len(_seconds) > 0:
+        lines.append(f'{"timer":<32} {"calls":>10} {"seconds":>12} {"ms/call":>10}')
+        for name in sorted(_seconds, key=_seconds.get, reverse=True):
+            seconds, calls = _seconds[name], _calls[name]
+            lines.append(f'{name:<32} {calls:>10} {seconds:>12.3f} {1000 * seconds / calls:>10.3f}')
+    if len(_counts) > 0:
+        lines.append(f'{"counter":<32} {"total":>10}')
+        for name in sorted(_counts):
+            lines.append(f'{name:<32} {_counts[name]:>10}')
+    return '\n'.join(lines)
+
+
+def _print_summary() -> None:
+    if _enabled and (len(_seconds) > 0 or len(_counts) > 0):
+        print('Profile summary')
+        print(summary())
+
+
+atexit.register(_print_summary)
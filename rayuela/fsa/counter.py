@@ -0,0 +1,143 @@
+from typing import Dict, List, Tuple
+import numpy as np
+
+from rayuela.base import events
+from rayuela.base.automaton import Automaton
+
+
+# Token classes of a counter automaton
+INVALID, IGNORED, COUNTED, START, END = range(5)
+
+# Control states
+BEFORE_START, COUNTING, ACCEPTED = range(3)
+NUM_CONTROL_STATES = 3
+
+
+# Automaton which reads START, then any number of IGNORED and COUNTED tokens,
+# then END. END can only be read if between `min_count` and `max_count` COUNTED
+# tokens have been read, and no more than `max_count` can be read. INVALID
+# tokens are never accepted.
+#
+# Instead of unrolling one state per count, the state encodes the count and a
+# small control state, so building the machine only classifies the vocabulary.
+class CounterAutomaton(Automaton):
+    def __init__(self, key_to_class: Dict[int, int], min_count: int, max_count: int) -> None:
+        assert 0 <= min_count <= max_count
+        self.key_to_class = key_to_class
+        self.min_count = min_count
+        self.max_count = max_count
+
+        # token_classes[key] is the class of the token with that key
+        self.token_classes = np.full(max(key_to_class.keys(), default=-1) + 1, INVALID, dtype=np.int8)
+        for key, token_class in key_to_class.items():
+            self.token_classes[key] = token_class
+
+        keys_of = {token_class: sorted(k for k, c in key_to_class.items() if c == token_class)
+                   for token_class in [IGNORED, COUNTED, START, END]}
+        self._start_actions = keys_of[START]
+        # The valid actions while counting, keyed by whether more tokens can be
+        # counted and whether END can be read
+        self._counting_actions: Dict[Tuple[bool, bool], List[int]] = {}
+        for can_count in [False, True]:
+            for can_end in [False, True]:
+                actions = list(keys_of[IGNORED])
+                if can_count:
+                    actions += keys_of[COUNTED]
+                if can_end:
+                    actions += keys_of[END]
+                self._counting_actions[can_count, can_end] = sorted(actions)
+        # Boolean masks of the lists above, built on demand by `get_valid_actions_row`
+        self._rows: Dict[Tuple[int, int, bool, bool], np.ndarray] = {}
+
+    def accept(self, tokens) -> bool:
+        """ determines whether a string is in the language """
+        assert isinstance(tokens, list)
+        state = self.get_start()
+        for a in tokens:
+            state = self._next_state(state, a)
+            if state is None:
+                return False
+        return CounterAutomaton.decode_state(state)[1] == ACCEPTED
+
+    def get_start(self) -> int:
+        return CounterAutomaton.encode_state(0, BEFORE_START)
+
+    def get_valid_actions(self, state: int, stack: int) -> list:
+        # The lists are shared, so callers must not modify them
+        count, control = CounterAutomaton.decode_state(state)
+        if control == BEFORE_START:
+            return self._start_actions
+        if control == ACCEPTED:
+            return []
+        return self._counting_actions[count < self.max_count, count >= self.min_count]
+
+    def get_valid_actions_row(self, state: int, stack: int, num_actions: int) -> np.ndarray:
+        count, control = CounterAutomaton.decode_state(state)
+        key = (num_actions, control, count < self.max_count, count >= self.min_count)
+        row = self._rows.get(key)
+        if row is None:
+            row = super().get_valid_actions_row(state, stack, num_actions)
+            self._rows[key] = row
+        return row
+
+    def _next_state(self, state: int, action) -> int:
+        """ the state reached from `state` with `action`, or None if the action is not valid """
+        count, control = CounterAutomaton.decode_state(state)
+        token_class = self.key_to_class.get(action, INVALID)
+        if control == BEFORE_START and token_class == START:
+            return CounterAutomaton.encode_state(0, COUNTING)
+        if control == COUNTING:
+            if token_class == IGNORED:
+                return state
+            if token_class == COUNTED and count < self.max_count:
+                return CounterAutomaton.encode_state(count + 1, COUNTING)
+            if token_class == END and count >= self.min_count:
+                return CounterAutomaton.encode_state(count, ACCEPTED)
+        return None
+
+    def step(self, state: int, stack: int, action) -> Tuple[int, int]:  # returns to state, to stack
+        nxt = self._next_state(state, action)
+        if nxt is None:
+            nxt = state
+            events.record(events.STUCK_STEP, "Counter step stuck")
+        return nxt, stack
+
+    def _get_token_classes(self, actions: np.ndarray) -> np.ndarray:
+        in_range = (actions >= 0) & (actions < len(self.token_classes))
+        return np.where(in_range, self.token_classes[np.where(in_range, actions, 0)], INVALID)
+
+    def is_valid_batch(self, states: np.ndarray, stacks: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        counts, controls = CounterAutomaton.decode_state(states)
+        token_classes = self._get_token_classes(actions)
+        counting = controls == COUNTING
+        return ((controls == BEFORE_START) & (token_classes == START)) | \
+            (counting & (token_classes == IGNORED)) | \
+            (counting & (token_classes == COUNTED) & (counts < self.max_count)) | \
+            (counting & (token_classes == END) & (counts >= self.min_count))
+
+    def step_batch(self, states: np.ndarray, stacks: np.ndarray, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Like `DenseDFSA.step_batch`, an invalid action leaves the state unchanged
+        counts, controls = CounterAutomaton.decode_state(states)
+        token_classes = self._get_token_classes(actions)
+        valid = self.is_valid_batch(states, stacks, actions)
+        num_stuck = np.count_nonzero(~valid)
+        if num_stuck > 0:
+            events.record(events.STUCK_STEP, "Counter step stuck", n=num_stuck)
+
+        next_counts = np.where(token_classes == COUNTED, counts + 1, counts)
+        next_controls = np.where(token_classes == START, COUNTING, controls)
+        next_controls = np.where(token_classes == END, ACCEPTED, next_controls)
+        next_states = CounterAutomaton.encode_state(next_counts, next_controls)
+        return np.where(valid, next_states, states).astype(states.dtype), stacks
+
+    @property
+    def num_states(self):
+        return NUM_CONTROL_STATES * (self.max_count + 1)
+
+    @staticmethod
+    def encode_state(count: int, control: int) -> int:
+        return count * NUM_CONTROL_STATES + control
+
+    @staticmethod
+    def decode_state(state: int) -> Tuple[int, int]:
+        return state // NUM_CONTROL_STATES, state % NUM_CONTROL_STATES
@@ -1,10 +1,11 @@
+from rayuela.base import events, profiling
 from rayuela.base.automaton import Automaton
 from rayuela.base.semiring import Boolean, Semiring
 from collections import defaultdict as dd
 from typing import Tuple
-
-from rayuela.fsa.state import MinimizeState, State
-from tqdm import tqdm
+import logging
+import numpy as np
+import os
 
 
 # Deterministic FSA
@@ -47,6 +48,123 @@ class DFSA(Automaton):
                 if w.score:
                     self.delta[state_map[i]][a.sym] = state_map[j]
 
+        # The array-backed form, built on demand by `dense()`
+        self._dense = None
+
+    @staticmethod
+    def from_transitions(num_states: int, initial_state: int, final_state: int, delta: dict, Sigma: set) -> 'DFSA':
+        """ builds a machine over the states 0, ..., num_states - 1 where delta[i][a] = j """
+        dfsa = DFSA.__new__(DFSA)
+        dfsa.Q = set(range(num_states))
+        dfsa.initial_state = initial_state
+        dfsa.final_state = final_state
+        dfsa.delta = dd(lambda: {})
+        dfsa.delta.update(delta)
+        dfsa.Sigma = Sigma
+        dfsa._dense = None
+        return dfsa
+
+    @staticmethod
+    def from_boolean_fsa(fsa) -> 'DFSA':
+        """
+        Compiles a Boolean FSA without going through `FSA.determinize`. States and
+        symbols are integer-indexed once. If the machine is already deterministic,
+        the DFSA is built directly (with the same state numbering as `DFSA(fsa)`),
+        otherwise an unweighted subset construction over frozensets of ints is run.
+        """
+        assert fsa.R is Boolean
+        states = list(fsa.Q)
+        state_map = {q: i for i, q in enumerate(states)}
+
+        # arcs[i][a] = the list of targets of i labeled a
+        arcs = []
+        deterministic = True
+        for q in states:
+            out = {}
+            for a, T in fsa.δ[q].items():
+                targets = [state_map[j] for j, w in T.items() if w.score]
+                if len(targets) == 0:
+                    continue
+                if len(targets) > 1:
+                    deterministic = False
+                out[a.sym] = targets
+            arcs.append(out)
+
+        initial_states = [state_map[q] for q, w in fsa.I]
+        final_states = {state_map[q] for q, w in fsa.F}
+        Sigma = {a.sym for a in fsa.Sigma}
+
+        if deterministic and len(initial_states) == 1:
+            assert len(final_states) == 1
+            delta = {i: {a: targets[0] for a, targets in out.items()} for i, out in enumerate(arcs) if len(out) > 0}
+            return DFSA.from_transitions(len(states), initial_states[0], final_states.pop(), delta, Sigma)
+
+        # Unweighted subset construction
+        start = frozenset(initial_states)
+        subset_map = {start: 0}
+        stack = [start]
+        delta = {}
+        final_subsets = []
+        while stack:
+            subset = stack.pop()
+            i = subset_map[subset]
+            if not final_states.isdisjoint(subset):
+                final_subsets.append(i)
+
+            symbol_to_targets = dd(set)
+            for p in subset:
+                for a, targets in arcs[p].items():
+                    symbol_to_targets[a].update(targets)
+
+            out = {}
+            for a, targets in symbol_to_targets.items():
+                targets = frozenset(targets)
+                j = subset_map.get(targets)
+                if j is None:
+                    j = len(subset_map)
+                    subset_map[targets] = j
+                    stack.append(targets)
+                out[a] = j
+            if len(out) > 0:
+                delta[i] = out
+
+        assert len(final_subsets) == 1
+        return DFSA.from_transitions(len(subset_map), 0, final_subsets[0], delta, Sigma)
+
+    @staticmethod
+    def from_dense(dense: 'DenseDFSA', lazy: bool = False) -> 'DFSA':
+        """
+        Rebuilds the dict-backed machine from its array-backed form. If `lazy`,
+        the states, arcs and alphabet are only rebuilt when they are first read,
+        so a memory-mapped machine which is only decoded through `dense()` is
+        never read in full.
+        """
+        dfsa = DFSA.__new__(DFSA)
+        dfsa.initial_state = dense.initial_state
+        dfsa.final_state = dense.final_state
+        dfsa._dense = dense
+        if not lazy:
+            dfsa._expand()
+        return dfsa
+
+    def _expand(self) -> None:
+        """ builds `Q`, `delta` and `Sigma` from the array-backed form """
+        dense = self._dense
+        symbols = dense.symbols.tolist()
+        delta = dd(lambda: {})
+        for i, k in zip(*np.nonzero(dense.valid_mask)):
+            delta[int(i)][symbols[k]] = int(dense.delta[i, k])
+        self.Q = set(range(dense.num_states))
+        self.delta = delta
+        self.Sigma = set(symbols)
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, i.e. the ones `from_dense` deferred
+        if name in ('Q', 'delta', 'Sigma') and self.__dict__.get('_dense') is not None:
+            self._expand()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
     def accept(self, tokens) -> bool:
         """ determines whether a string is in the language """
         assert isinstance(tokens, list)
@@ -74,7 +192,7 @@ class DFSA(Automaton):
         nxt = self.delta[state].get(action)
         if nxt is None:
             nxt = state
-            print("DFSA step stuck")
+            events.record(events.STUCK_STEP, "DFSA step stuck")
         #     import dill
         #     dill.dump(self, open('bad_dfsa.dill', 'wb'))
         #     raise ValueError(f'Bad dfsa step with state {state}, stack {stack} and action {action}')
@@ -82,43 +200,116 @@ class DFSA(Automaton):
 
     @property
     def num_states(self):
+        if 'Q' not in self.__dict__:
+            return self._dense.num_states
         return len(self.Q)
 
-    def minimize(self):
-        # Homework 5: Question 3
-        print(f'Minimizing a fsa with {self.num_states} states...')
+    def dense(self) -> 'DenseDFSA':
+        """ returns (and memoizes) the array-backed form of this machine """
+        if self._dense is None:
+            self._dense = DenseDFSA.from_dfsa(self)
+        return self._dense
+
+    def accessible(self) -> set:
+        """ the states which can be reached from the initial state """
+        stack = [self.initial_state]
+        visited = {self.initial_state}
+        while stack:
+            i = stack.pop()
+            for j in self.delta.get(i, {}).values():
+                if j not in visited:
+                    visited.add(j)
+                    stack.append(j)
+        return visited
+
+    def coaccessible(self) -> set:
+        """ the states from which the final state can be reached """
+        reverse = dd(list)
+        for i, arcs in self.delta.items():
+            for j in arcs.values():
+                reverse[j].append(i)
+
+        stack = [self.final_state]
+        visited = {self.final_state}
+        while stack:
+            j = stack.pop()
+            for i in reverse[j]:
+                if i not in visited:
+                    visited.add(i)
+                    stack.append(i)
+        return visited
+
+    def trim(self) -> 'DFSA':
+        """
+        Keeps only the states which are both accessible and co-accessible, so
+        that every valid action can still lead to the final state. The initial
+        and final states are always kept. Returns the machine itself if there
+        is nothing to remove.
+        """
+        keep = (self.accessible() & self.coaccessible()) | {self.initial_state, self.final_state}
+        if len(keep) == self.num_states:
+            return self
+
+        state_map = {q: i for i, q in enumerate(sorted(keep))}
+        delta = dd(lambda: {})
+        for i in keep:
+            for a, j in self.delta.get(i, {}).items():
+                if j in state_map:
+                    delta[state_map[i]][a] = state_map[j]
+
+        return DFSA.from_transitions(len(keep),
+                                     state_map[self.initial_state],
+                                     state_map[self.final_state],
+                                     delta,
+                                     set(self.Sigma))
+
+    @profiling.timed('minimize')
+    def minimize(self) -> 'DFSA':
+        """
+        Minimizes the machine with Hopcroft's algorithm. Missing arcs go to an
+        implicit sink state, so states which cannot reach the final state are
+        merged into the sink and dropped.
+        """
+        if len(self.Sigma) == 0:
+            # There are no arcs to refine with, and only the initial and final
+            # states can be useful
+            return self.trim()
+
+        events.record(events.MINIMIZE, 'Minimizing a DFSA with %d states...', self.num_states, level=logging.INFO)
         from rayuela.base.partitions import PartitionRefinement
 
-        # Assume deterministic and trim
-        final_s = frozenset([self.final_state])
-        non_final_s = frozenset(self.Q - final_s)
-        P_cal = {final_s, non_final_s}
-        for a in tqdm(self.Sigma):
-            f_a = {}
-            Q = set()
-            for q in self.Q:
-                p = self.delta[q].get(a)
-                if p is not None:
-                    f_a[q] = p
-                    Q.add(q)
-                else:
-                    f_a[q] = q
-            P_cal = PartitionRefinement(f_a, Q).hopcroft(P_cal)
-        
-        return self._block_fsa_construction(P_cal)
+        sink = self.num_states
+        Q = set(self.Q) | {sink}
+        fs = []
+        for a in self.Sigma:
+            f = {q: self.delta.get(q, {}).get(a, sink) for q in self.Q}
+            f[sink] = sink
+            fs.append(f)
 
-    def _block_fsa_construction(self, P_cal):
-        # block fsa construction
-        from rayuela.fsa.fsa import FSA
-        mfsa = FSA()
-        μ = {q: State(i) for i, Q in enumerate(P_cal) for q in Q}
-        for i in self.Q:
-            for a, j in self.delta[i].items():
-                mfsa.add_arc(μ[i], a, μ[j])
+        final_s = frozenset([self.final_state])
+        P = [final_s, frozenset(Q - final_s)]
+        P = PartitionRefinement(fs, Q).hopcroft_fast(P)
+
+        # Number the blocks by their smallest state, dropping the sink's block
+        # (unless the language is empty and it holds the initial state)
+        block_of = {q: B for B in P for q in B}
+        blocks = sorted((B for B in P if sink not in B or self.initial_state in B), key=min)
+        block_map = {B: i for i, B in enumerate(blocks)}
+
+        delta = dd(lambda: {})
+        for B in blocks:
+            q = min(B)
+            if q == sink:
+                continue
+            for a, j in self.delta.get(q, {}).items():
+                if block_of[j] in block_map:
+                    delta[block_map[B]][a] = block_map[block_of[j]]
 
-        mfsa.set_I(μ[self.initial_state])
-        mfsa.set_F(μ[self.final_state])
-        return mfsa
+        return DFSA.from_transitions(len(blocks),
+                                     block_map[block_of[self.initial_state]],
+                                     block_map[block_of[self.final_state]],
+                                     delta,
+                                     set(self.Sigma))
 
     def _repr_html_(self):
         """
@@ -285,3 +476,151 @@ class DFSA(Automaton):
         ''')
 
         return ''.join(ret2)
+
+
+# Deterministic FSA backed by numpy arrays
+class DenseDFSA(Automaton):
+    # Marks a missing arc in `delta`
+    NO_STATE = -1
+
+    def __init__(self, symbols: np.ndarray, delta: np.ndarray, initial_state: int, final_state: int):
+        """
+        args:
+            symbols: the sorted (|Sigma|,) int64 alphabet. Column `k` of `delta`
+                holds the arcs labeled with `symbols[k]`.
+            delta: the (num_states, |Sigma|) int32 transition matrix where
+                delta[i, k] = j, or `NO_STATE` if there is no arc.
+        """
+        assert delta.ndim == 2 and delta.shape[1] == len(symbols)
+        self.symbols = symbols
+        self.delta = delta
+        self.initial_state = initial_state
+        self.final_state = final_state
+
+        # symbol -> column of `delta`
+        self.column = {a: k for k, a in enumerate(symbols.tolist())}
+
+        # `valid_mask` and `valid_actions` are built on first use, so that
+        # loading a memory-mapped machine does not read the whole matrix
+        self._valid_mask = None
+        self._valid_actions = None
+        # The (num_states, num_actions) mask of `get_valid_actions_mask`, built
+        # on demand by `get_valid_actions_row`
+        self._mask = None
+
+    @property
+    def valid_mask(self) -> np.ndarray:
+        """ valid_mask[i, k] is True iff there is an arc from i labeled symbols[k] """
+        if self._valid_mask is None:
+            self._valid_mask = self.delta != DenseDFSA.NO_STATE
+        return self._valid_mask
+
+    @property
+    def valid_actions(self) -> list:
+        """ the valid actions of every state, precomputed so `get_valid_actions` does not allocate """
+        if self._valid_actions is None:
+            self._valid_actions = [self.symbols[row].tolist() for row in self.valid_mask]
+        return self._valid_actions
+
+    @staticmethod
+    def from_dfsa(dfsa: DFSA) -> 'DenseDFSA':
+        assert dfsa.Q == set(range(dfsa.num_states)), 'DFSA states must be 0, ..., n - 1'
+        assert all(isinstance(a, (int, np.integer)) for a in dfsa.Sigma), 'DFSA symbols must be integers'
+
+        symbols = np.array(sorted(dfsa.Sigma), dtype=np.int64)
+        column = {a: k for k, a in enumerate(symbols.tolist())}
+        delta = np.full((dfsa.num_states, len(symbols)), DenseDFSA.NO_STATE, dtype=np.int32)
+        for i in dfsa.Q:
+            for a, j in dfsa.delta[i].items():
+                delta[i, column[a]] = j
+        return DenseDFSA(symbols, delta, dfsa.initial_state, dfsa.final_state)
+
+    def save(self, path: str) -> None:
+        """ writes the machine into the directory `path` as raw .npy arrays """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'symbols.npy'), self.symbols)
+        np.save(os.path.join(path, 'delta.npy'), self.delta)
+        np.save(os.path.join(path, 'endpoints.npy'), np.array([self.initial_state, self.final_state], dtype=np.int64))
+
+    @staticmethod
+    def load(path: str, mmap: bool = True) -> 'DenseDFSA':
+        """ reads a machine written by `save`. The transition matrix is memory-mapped if `mmap` is set """
+        mmap_mode = 'r' if mmap else None
+        symbols = np.load(os.path.join(path, 'symbols.npy'))
+        delta = np.load(os.path.join(path, 'delta.npy'), mmap_mode=mmap_mode)
+        initial_state, final_state = np.load(os.path.join(path, 'endpoints.npy')).tolist()
+        return DenseDFSA(symbols, delta, initial_state, final_state)
+
+    def accept(self, tokens) -> bool:
+        """ determines whether a string is in the language """
+        assert isinstance(tokens, list)
+        cur = self.initial_state
+        for a in tokens:
+            k = self.column.get(a)
+            if k is None:
+                return False
+            cur = self.delta[cur, k]
+            if cur == DenseDFSA.NO_STATE:
+                return False
+
+        return cur == self.final_state
+
+    def get_start(self) -> int:
+        return self.initial_state
+
+    def get_valid_actions(self, state: int, stack: int) -> list:
+        # The list is shared, so callers must not modify it
+        return self.valid_actions[state]
+
+    def get_valid_actions_mask(self, num_actions: int) -> np.ndarray:
+        """
+        Returns the (num_states, num_actions) boolean matrix whose [i, a] entry
+        is True iff action `a` is valid in state `i`.
+        """
+        mask = np.zeros((self.num_states, num_actions), dtype=bool)
+        mask[:, self.symbols] = self.valid_mask
+        return mask
+
+    def get_valid_actions_row(self, state: int, stack: int, num_actions: int) -> np.ndarray:
+        if self._mask is None or self._mask.shape[1] != num_actions:
+            self._mask = self.get_valid_actions_mask(num_actions)
+        return self._mask[state]
+
+    def step(self, state: int, stack: int, action) -> Tuple[int, int]:  # returns to state, to stack
+        k = self.column.get(action)
+        nxt = DenseDFSA.NO_STATE if k is None else self.delta[state, k]
+        if nxt == DenseDFSA.NO_STATE:
+            events.record(events.STUCK_STEP, "DFSA step stuck")
+            return state, stack
+        return int(nxt), stack
+
+    def get_transition_table(self, num_actions: int) -> np.ndarray:
+        """
+        Returns the (num_states, num_actions) int64 matrix whose [i, a] entry is
+        the state reached from `i` with action `a`, or `NO_STATE`.
+        """
+        table = np.full((self.num_states, num_actions), DenseDFSA.NO_STATE, dtype=np.int64)
+        table[:, self.symbols] = self.delta
+        return table
+
+    def step_batch(self, states: np.ndarray, stacks: np.ndarray, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Like `step`, a missing arc leaves the state unchanged
+        columns = np.searchsorted(self.symbols, actions)
+        columns = np.minimum(columns, len(self.symbols) - 1)
+        found = self.symbols[columns] == actions
+        next_states = np.where(found, self.delta[states, columns], DenseDFSA.NO_STATE)
+        stuck = next_states == DenseDFSA.NO_STATE
+        num_stuck = np.count_nonzero(stuck)
+        if num_stuck > 0:
+            events.record(events.STUCK_STEP, "DFSA step stuck", n=num_stuck)
+        next_states = np.where(stuck, states, next_states)
+        return next_states.astype(states.dtype), stacks
+
+    def is_valid_batch(self, states: np.ndarray, stacks: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        columns = np.searchsorted(self.symbols, actions)
+        columns = np.minimum(columns, len(self.symbols) - 1)
+        return (self.symbols[columns] == actions) & self.valid_mask[states, columns]
+
+    @property
+    def num_states(self):
+        return self.delta.shape[0]
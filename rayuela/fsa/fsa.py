@@ -1,5 +1,6 @@
 from __future__ import annotations
 import copy
+import logging
 import numpy as np
 from frozendict import frozendict
 from itertools import product
@@ -8,6 +9,7 @@ from collections import Counter
 from collections import defaultdict as dd
 
 from rayuela.base.semiring import Boolean, Real, Semiring, String, ProductSemiring
+from rayuela.base import events, profiling
 from rayuela.base.automaton import Automaton
 from rayuela.base.symbol import Sym, ε
 
@@ -178,7 +180,7 @@ class FSA(Automaton):
 
 	def normalize(self) -> FSA:
 		# Simplify states representations
-		print(f'Normalizing a fsa with {self.num_states} states...')
+		events.record(events.NORMALIZE, 'Normalizing a fsa with %d states...', self.num_states, level=logging.INFO)
 		fsa = self.spawn()
 		sm = {q: State(i) for i, q in enumerate(self.Q)}
 		for i, w in self.I:
@@ -190,10 +192,11 @@ class FSA(Automaton):
 				fsa.add_arc(sm[i], a, sm[j], w)
 		return fsa
 
+	@profiling.timed('determinize')
 	def determinize(self) -> FSA:
 		# Homework 4: Question 4
 		if self.deterministic: return self
-		print(f'Determinizing a fsa with {self.num_states} states...')
+		events.record(events.DETERMINIZE, 'Determinizing a fsa with %d states...', self.num_states, level=logging.INFO)
 		from rayuela.fsa.transformer import Transformer
 		det = self.spawn()
 		QI = PowerState(dict(self.I))
@@ -221,12 +224,15 @@ class FSA(Automaton):
 
 		return det
 
-	def compile(self):
-		dfsa = DFSA(self.determinize())
+	@profiling.timed('compile')
+	def compile(self, minimize=False):
+		# Boolean machines skip `determinize` and its PowerState residuals. States
+		# which cannot reach the final state are dropped, so that every valid
+		# action of the DFSA can still lead to acceptance
+		dfsa = DFSA.from_boolean_fsa(self).trim()
+		if minimize:
+			dfsa = dfsa.minimize()
 		return dfsa
-		mfsa = dfsa.minimize()  # TODO: minimization is too slow for 1k+ states
-		# mfsa = self.determinize().minimize()
-		return DFSA(mfsa.determinize())
 
 	def dfs(self):
 		""" Depth-first search (Cormen et al. 2019; Section 22.3) """
@@ -302,26 +308,50 @@ class FSA(Automaton):
 	def reverse(self) -> FSA:
 		""" computes the reverse of the FSA """
 
-		# Homework 1: Question 3
-		raise NotImplementedError
+		rev = self.spawn()
+		for i in self.Q:
+			for a, j, w in self.arcs(i):
+				rev.add_arc(j, a, i, w)
+		for q, w in self.I:
+			rev.set_F(q, w)
+		for q, w in self.F:
+			rev.set_I(q, w)
+		return rev
 
 	def accessible(self) -> set:
 		""" computes the set of acessible states """
 
-		# Homework 1: Question 3
-		raise NotImplementedError
+		stack = [q for q, _ in self.I]
+		visited = set(stack)
+		while stack:
+			i = stack.pop()
+			for _, j, _ in self.arcs(i):
+				if j not in visited:
+					visited.add(j)
+					stack.append(j)
+		return visited
 
 	def coaccessible(self) -> set:
 		""" computes the set of co-acessible states """
 
-		# Homework 1: Question 3
-		raise NotImplementedError
+		return self.reverse().accessible()
 
 	def trim(self) -> FSA:
 		""" keeps only those states that are both accessible and co-accessible """
 
-		# Homework 1: Question 3
-		raise NotImplementedError
+		A = self.accessible() & self.coaccessible()
+		fsa = self.spawn()
+		for q, w in self.I:
+			if q in A:
+				fsa.set_I(q, w)
+		for q, w in self.F:
+			if q in A:
+				fsa.set_F(q, w)
+		for i in A:
+			for a, j, w in self.arcs(i):
+				if j in A:
+					fsa.add_arc(i, a, j, w)
+		return fsa
 
 	def union(self, fsa) -> FSA:
 		""" construct the union of the two FSAs """
@@ -1,35 +1,126 @@
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
+import numpy as np
 from allennlp.common.util import START_SYMBOL, END_SYMBOL
 
+from rayuela.base import events
 from rayuela.base.automaton import Automaton
 from rayuela.base.misc import is_token_open_paren, is_token_close_paren
-from rayuela.fsa.state import State
+
+
+# Token classes, precomputed per key so that the PDA never looks at strings
+# while decoding
+OTHER, OPEN, CLOSE, START, END = range(5)
+
+# ALLOWED[pda_state][token_class] says whether a token class can be read in
+# the given PDA state
+ALLOWED = np.array([
+    [False, False, False, True, False],  # 0: expecting START_SYMBOL
+    [False, True, False, False, False],  # 1: expecting the opening parenthesis
+    [True, True, True, False, False],    # 2: anything but START_SYMBOL and END_SYMBOL
+    [False, False, False, False, True],  # 3: expecting END_SYMBOL
+    [False, False, False, False, False], # 4: accepted
+])
+NUM_PDA_STATES = len(ALLOWED)
+
+# Depth buckets, which say how much room is left under the length and depth
+# bounds: enough to close the open phrases only, to also read a terminal, or
+# to also open a new phrase
+NO_ROOM, ROOM_FOR_OTHER, ROOM_FOR_OPEN = range(3)
+
+# BUCKET_ALLOWED[bucket][token_class] says whether a token class fits in the bucket
+BUCKET_ALLOWED = np.array([
+    [False, False, True, True, True],  # NO_ROOM
+    [True, False, True, True, True],   # ROOM_FOR_OTHER
+    [True, True, True, True, True],    # ROOM_FOR_OPEN
+])
+
+
+def get_token_class(token: str) -> int:
+    if token == START_SYMBOL:
+        return START
+    if token == END_SYMBOL:
+        return END
+    if is_token_open_paren(token):
+        return OPEN
+    if is_token_close_paren(token):
+        return CLOSE
+    return OTHER
 
 
 # Push down automaton for parenthesis matching
 # accepts: s ( xx ( xx () ) ) e, s () e, ...
 # not accepts: s e, s () () e, s ( xx () e, ...
 class PDA(Automaton):
-    def __init__(self, token_to_key: Dict[str, int], dfsa=None, max_length=float('inf')) -> 'PDA':
-        from rayuela.fsa.fsa import FSA
+    def __init__(self,
+                 token_to_key: Dict[str, int],
+                 automata=None,
+                 max_length=float('inf'),
+                 max_depth=float('inf')) -> 'PDA':
+        """
+        args:
+            automata: the stack-free automata (usually DFSAs) whose languages the
+                PDA is intersected with, either a list or a single automaton. They
+                are kept as separate components and stepped jointly instead of
+                being intersected into a product machine. None for no components.
+            max_length: the maximum number of tokens between START_SYMBOL and
+                END_SYMBOL. The length read so far is part of the state, and an
+                action is only valid if there is still room to close every open
+                phrase afterwards, so a bounded PDA never reaches a dead end.
+            max_depth: the maximum number of nested open phrases
+        """
         from rayuela.fsa.dfsa import DFSA
+        from rayuela.fsa.product import ProductAutomaton
         assert(isinstance(token_to_key, dict))
         self.token_to_key = token_to_key
         self.key_to_token = {k: t for t, k in token_to_key.items()}
         self.max_length = max_length
-        if isinstance(dfsa, DFSA):
-            self.dfsa = dfsa
-        elif dfsa is None: # a dfsa that accepts all languages
-            fsa = FSA()
-            q = State(0)
-            fsa.add_state(q)
-            fsa.set_I(q)
-            fsa.set_F(q)
-            for a in token_to_key.values():
-                fsa.add_arc(q, a, q)
-            self.dfsa = fsa.compile()
+        self.max_depth = max_depth
+        # The length is only part of the state if it is bounded
+        self._length_radix = int(max_length) + 1 if max_length != float('inf') else 1
+
+        # token_classes[key] is the class of the token with that key
+        self.token_classes = np.full(max(token_to_key.values(), default=-1) + 1, OTHER, dtype=np.int8)
+        for token, key in token_to_key.items():
+            self.token_classes[key] = get_token_class(token)
+        # allowed_masks[bucket][pda_state][key] says whether the token with that
+        # key can be read in the given depth bucket and PDA state. Keys which
+        # are not in the vocabulary never can
+        known = np.zeros(len(self.token_classes), dtype=bool)
+        known[list(token_to_key.values())] = True
+        allowed = BUCKET_ALLOWED[:, np.newaxis, :] & ALLOWED[np.newaxis, :, :]
+        self._allowed_masks = allowed[:, :, self.token_classes] & known
+        # Valid actions for every (component state, PDA state, depth bucket)
+        # seen so far. The length only matters through the bucket. Otherwise they
+        # do not depend on the stack because a closing parenthesis is only ever
+        # read in PDA state 2, where the stack is never empty
+        self._valid_actions: Dict[Tuple[int, int, int], List[int]] = {}
+
+        if automata is None:
+            automata = []
+        elif not isinstance(automata, list):
+            automata = [automata]
+        self.automata: List[Automaton] = []
+        for automaton in automata:
+            if isinstance(automaton, PDA) or not isinstance(automaton, Automaton):
+                raise TypeError(f'Unknown automaton type {type(automaton)}')
+            if isinstance(automaton, ProductAutomaton):
+                self.automata.extend(automaton.automata)
+            elif isinstance(automaton, DFSA):
+                # Drop the states from which the DFSA cannot accept anymore
+                self.automata.append(automaton.trim())
+            else:
+                self.automata.append(automaton)
+
+        # The components are stepped jointly through a lazy product, which
+        # assigns the ids of the joint states. `dfsa` is None without components
+        if len(self.automata) == 0:
+            self.dfsa = None
+        elif len(self.automata) == 1:
+            self.dfsa = self.automata[0]
         else:
-            raise TypeError(f'Unknown automaton type {type(dfsa)}')
+            self.dfsa = ProductAutomaton(self.automata)
+        # The array-backed form is much faster to step through
+        self._dfsa = self.dfsa.dense() if isinstance(self.dfsa, DFSA) else self.dfsa
 
     def pda_accept(tokens: list) -> bool:
         state = 0
@@ -70,45 +161,66 @@ class PDA(Automaton):
         return state == 4
 
     def accept(self, keys) -> bool:
-        if len(keys) > self.max_length: return False
-        return PDA.pda_accept([self.key_to_token[k] for k in keys]) and self.dfsa.accept(keys)
+        tokens = [self.key_to_token[k] for k in keys]
+        if sum(1 for token in tokens if token not in [START_SYMBOL, END_SYMBOL]) > self.max_length:
+            return False
+        depth = max_depth = 0
+        for token in tokens:
+            if is_token_open_paren(token):
+                depth += 1
+                max_depth = max(max_depth, depth)
+            elif is_token_close_paren(token):
+                depth -= 1
+        if max_depth > self.max_depth:
+            return False
+        return PDA.pda_accept(tokens) and all(automaton.accept(keys) for automaton in self.automata)
     
     def get_start(self) -> int:
-        return PDA.encode_state(self.dfsa.get_start(), 0)
+        fsa_start = 0 if self._dfsa is None else self._dfsa.get_start()
+        return self.encode_state(fsa_start, 0)
+
+    def get_buckets(self, lengths, stacks):
+        """ the depth buckets of the (arrays of) lengths and stack depths """
+        # Every open phrase still needs its closing parenthesis
+        room = np.clip(self.max_length - lengths - stacks, NO_ROOM, ROOM_FOR_OPEN).astype(np.int64)
+        return np.where(stacks >= self.max_depth, np.minimum(room, ROOM_FOR_OTHER), room)
 
     def get_valid_actions(self, state: int, stack: int) -> list:
-        fsa_state, pda_state = PDA.decode_state(state)
-        fsa_actions = self.dfsa.get_valid_actions(fsa_state, stack)
-        if pda_state == 0:
-            return [a for a in fsa_actions if self.key_to_token[a] == START_SYMBOL]
-        elif pda_state == 1:
-            return [a for a in fsa_actions if is_token_open_paren(self.key_to_token[a])]
-        elif pda_state == 2:
-            return [a for a in fsa_actions if self.key_to_token[a] not in [START_SYMBOL, END_SYMBOL]]
-        elif pda_state == 3:
-            return [a for a in fsa_actions if self.key_to_token[a] == END_SYMBOL]
-        else:  # pda_state == 4
-            return []
-    
+        fsa_state, pda_state, length = self.decode_state(state)
+        bucket = int(self.get_buckets(length, stack))
+        key = (fsa_state, pda_state, bucket)
+        actions = self._valid_actions.get(key)
+        if actions is None:
+            # The intersection of the masks of the PDA and of every component
+            allowed = self._allowed_masks[bucket, pda_state]
+            if self._dfsa is not None:
+                allowed = allowed & self._dfsa.get_valid_actions_row(fsa_state, stack, len(allowed))
+            actions = np.flatnonzero(allowed).tolist()
+            self._valid_actions[key] = actions
+        return actions
+
     def step(self, state: int, stack: int, action) -> Tuple[int, int]:  # returns to state, to stack
-        fsa_state, pda_state = PDA.decode_state(state)
-        fsa_to_state, _ = self.dfsa.step(fsa_state, stack, action)
-        action = self.key_to_token[action]
+        fsa_state, pda_state, length = self.decode_state(state)
+        if self._dfsa is None:
+            fsa_to_state = fsa_state
+        else:
+            fsa_to_state, _ = self._dfsa.step(fsa_state, stack, action)
+        token_class = self.token_classes[action]
         # assert(pda_state <= 3)
         if pda_state == 0:
-            assert(action == START_SYMBOL)
+            assert(token_class == START)
             pda_to_state = 1
             to_stack = 0
         elif pda_state == 1:
-            assert(is_token_open_paren(action))
+            assert(token_class == OPEN)
             pda_to_state = 2
             to_stack = 1
         elif pda_state == 2:
-            # assert(action not in [START_SYMBOL, END_SYMBOL])
-            if is_token_open_paren(action):
+            # assert(token_class not in [START, END])
+            if token_class == OPEN:
                 pda_to_state = 2
                 to_stack = stack + 1
-            elif is_token_close_paren(action):
+            elif token_class == CLOSE:
                 assert(stack >= 1)
                 if stack >= 2:
                     pda_to_state = 2
@@ -120,17 +232,53 @@ class PDA(Automaton):
                 pda_to_state = 2
                 to_stack = stack
         else:  # pda_state == 3
-            if action != END_SYMBOL:
-                print("PDA step stuck")
+            if token_class != END:
+                events.record(events.STUCK_STEP, "PDA step stuck")
                 # import dill
                 # dill.dump(self, open('bad_pda.dill', 'wb'))
                 # raise ValueError(f'Bad dfsa step with state {state}, stack {stack} and action {action}')
             pda_to_state = 4
             to_stack = 0
-        return PDA.encode_state(fsa_to_state, pda_to_state), to_stack
+        if pda_state in [1, 2]:
+            length = min(length + 1, self._length_radix - 1)
+        return self.encode_state(fsa_to_state, pda_to_state, length), to_stack
+
+    def step_batch(self, states: np.ndarray, stacks: np.ndarray, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # The vectorized version of `step`
+        fsa_states, pda_states, lengths = self.decode_state(states)
+        if self._dfsa is None:
+            fsa_to_states = fsa_states
+        else:
+            fsa_to_states, _ = self._dfsa.step_batch(fsa_states, stacks, actions)
+        token_classes = self.token_classes[actions]
+
+        in_phrase = pda_states == 2
+        opens = in_phrase & (token_classes == OPEN)
+        closes = in_phrase & (token_classes == CLOSE)
+        num_stuck = np.count_nonzero((pda_states == 3) & (token_classes != END))
+        if num_stuck > 0:
+            events.record(events.STUCK_STEP, "PDA step stuck", n=num_stuck)
+
+        pda_to_states = np.where(pda_states <= 1, pda_states + 1, 4)
+        pda_to_states = np.where(in_phrase, np.where(closes & (stacks == 1), 3, 2), pda_to_states)
+        to_stacks = np.where(pda_states == 1, 1, 0)
+        to_stacks = np.where(in_phrase, stacks + opens - closes, to_stacks)
+        # The length saturates at the bound, so it never overflows into the other fields
+        to_lengths = np.minimum(lengths + (pda_states == 1) + in_phrase, self._length_radix - 1)
+        return self.encode_state(fsa_to_states, pda_to_states, to_lengths), to_stacks.astype(stacks.dtype)
+
+    def is_valid_batch(self, states: np.ndarray, stacks: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        # The vectorized version of `get_valid_actions`, for one action per row
+        fsa_states, pda_states, lengths = self.decode_state(states)
+        allowed = self._allowed_masks[self.get_buckets(lengths, stacks), pda_states, actions]
+        if self._dfsa is None:
+            return allowed
+        return allowed & self._dfsa.is_valid_batch(fsa_states, stacks, actions)
 
-    def encode_state(fsa_state: int, pda_state: int) -> int:
-        return fsa_state * 5 + pda_state
+    def encode_state(self, fsa_state: int, pda_state: int, length: int = 0) -> int:
+        return (fsa_state * self._length_radix + length) * NUM_PDA_STATES + pda_state
     
-    def decode_state(state: int) -> Tuple[int, int]:
-        return state // 5, state % 5
+    def decode_state(self, state: int) -> Tuple[int, int, int]:
+        """ returns the component state, the PDA state and the length """
+        rest, pda_state = state // NUM_PDA_STATES, state % NUM_PDA_STATES
+        return rest // self._length_radix, pda_state, rest % self._length_radix
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+import numpy as np
+
+from rayuela.base import events
+from rayuela.base.automaton import Automaton
+from rayuela.fsa.dfsa import DFSA
+
+
+# Intersection of stack-free automata which is expanded lazily. Instead of
+# exploring the whole reachable product state space up front, a product state
+# (a tuple of component states) only gets an id once decoding reaches it.
+class ProductAutomaton(Automaton):
+    def __init__(self, automata: List[Automaton], max_memo_size: int = 100000) -> None:
+        components = []
+        for automaton in automata:
+            if isinstance(automaton, ProductAutomaton):
+                components.extend(automaton.automata)
+            else:
+                components.append(automaton)
+        assert len(components) > 0
+        self.automata = components
+
+        # The array-backed forms are much faster to step through
+        self._components = [a.dense() if isinstance(a, DFSA) else a for a in components]
+
+        # Product state ids. These are never evicted because the beam search
+        # holds on to them
+        self.state_to_id: Dict[Tuple[int, ...], int] = {}
+        self.id_to_state: List[Tuple[int, ...]] = []
+
+        # Bounded LRU memo tables for the valid actions and the transitions
+        self.max_memo_size = max_memo_size
+        self._valid_actions: OrderedDict = OrderedDict()
+        self._transitions: OrderedDict = OrderedDict()
+
+    def _get_id(self, states: Tuple[int, ...]) -> int:
+        state = self.state_to_id.get(states)
+        if state is None:
+            state = len(self.id_to_state)
+            self.state_to_id[states] = state
+            self.id_to_state.append(states)
+        return state
+
+    def _memoize(self, memo: OrderedDict, key, value) -> None:
+        memo[key] = value
+        if len(memo) > self.max_memo_size:
+            memo.popitem(last=False)
+
+    def accept(self, tokens) -> bool:
+        """ determines whether a string is in the language """
+        return all(automaton.accept(tokens) for automaton in self.automata)
+
+    def get_start(self) -> int:
+        return self._get_id(tuple(automaton.get_start() for automaton in self._components))
+
+    def get_valid_actions(self, state: int, stack: int) -> list:
+        actions = self._valid_actions.get(state)
+        if actions is not None:
+            self._valid_actions.move_to_end(state)
+            return actions
+
+        states = self.id_to_state[state]
+        component_actions = [automaton.get_valid_actions(q, stack) for automaton, q in zip(self._components, states)]
+        component_actions.sort(key=len)
+        others = [set(actions) for actions in component_actions[1:]]
+        actions = [a for a in component_actions[0] if all(a in other for other in others)]
+
+        self._memoize(self._valid_actions, state, actions)
+        return actions
+
+    def get_valid_actions_row(self, state: int, stack: int, num_actions: int) -> np.ndarray:
+        # The bitwise AND of the masks of the components
+        states = self.id_to_state[state]
+        row = np.ones(num_actions, dtype=bool)
+        for automaton, q in zip(self._components, states):
+            row &= automaton.get_valid_actions_row(q, stack, num_actions)
+        return row
+
+    def step(self, state: int, stack: int, action) -> Tuple[int, int]:  # returns to state, to stack
+        key = (state, action)
+        next_state = self._transitions.get(key)
+        if next_state is not None:
+            self._transitions.move_to_end(key)
+            return next_state, stack
+
+        states = self.id_to_state[state]
+        next_states = tuple(automaton.step(q, stack, action)[0] for automaton, q in zip(self._components, states))
+        next_state = self._get_id(next_states)
+
+        self._memoize(self._transitions, key, next_state)
+        return next_state, stack
+
+    def step_batch(self, states: np.ndarray, stacks: np.ndarray, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Step every component with all of the valid rows at once, then look up
+        # (or assign) the ids of the resulting product states. Like the
+        # components, an invalid action leaves the state unchanged, and it is
+        # counted once no matter how many components it is invalid for
+        valid = self.is_valid_batch(states, stacks, actions)
+        num_stuck = np.count_nonzero(~valid)
+        if num_stuck > 0:
+            events.record(events.STUCK_STEP, "Product step stuck", n=num_stuck)
+        next_states = states.copy()
+        if num_stuck == len(states):
+            return next_states, stacks
+
+        rows = np.flatnonzero(valid)
+        component_states = np.array([self.id_to_state[state] for state in states[rows].tolist()], dtype=np.int64)
+        component_states = component_states.reshape(len(rows), len(self._components))
+        next_component_states = [automaton.step_batch(component_states[:, i], stacks[rows], actions[rows])[0]
+                                 for i, automaton in enumerate(self._components)]
+        next_component_states = np.stack(next_component_states, axis=1).tolist()
+        next_states[rows] = [self._get_id(tuple(q)) for q in next_component_states]
+        return next_states, stacks
+
+    def is_valid_batch(self, states: np.ndarray, stacks: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        component_states = np.array([self.id_to_state[state] for state in states.tolist()], dtype=np.int64)
+        component_states = component_states.reshape(len(states), len(self._components))
+        valid = np.ones(len(states), dtype=bool)
+        for i, automaton in enumerate(self._components):
+            valid &= automaton.is_valid_batch(component_states[:, i], stacks, actions)
+        return valid
+
+    @property
+    def num_states(self):
+        """ the number of product states expanded so far """
+        return len(self.id_to_state)
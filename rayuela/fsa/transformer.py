@@ -1,14 +1,18 @@
+import logging
 from collections import defaultdict as dd
 from itertools import chain, product
 from sys import float_repr_style
 from frozendict import frozendict
 
+from rayuela.base import events
 from rayuela.base.automaton import Automaton
 from rayuela.base.misc import epsilon_filter
 from rayuela.base.symbol import ε, ε_1, ε_2
+from rayuela.fsa.counter import CounterAutomaton
 from rayuela.fsa.fsa import FSA
 from rayuela.fsa.dfsa import DFSA
 from rayuela.fsa.pda import PDA
+from rayuela.fsa.product import ProductAutomaton
 from rayuela.fsa.state import PairState, PowerState, State
 from rayuela.fsa.pathsum import Pathsum, Strategy
 
@@ -97,6 +101,19 @@ class Transformer:
 
     def intersect(a1: Automaton, a2: Automaton) -> Automaton:
         """Router for intersecting two automata"""
+        # A PDA keeps the stack-free automata it is intersected with as components
+        if isinstance(a2, PDA): a1, a2 = a2, a1
+        if isinstance(a1, PDA):
+            if isinstance(a2, PDA):
+                return Transformer._pda_pda_intersect(a1, a2)
+            if isinstance(a2, FSA): a2 = a2.compile()
+            return Transformer._pda_dfsa_intersect(a1, a2)
+
+        # Counters and lazy products stay factored, since expanding them
+        # multiplies the state counts
+        if Transformer._is_factored(a1) or Transformer._is_factored(a2):
+            return Transformer.lazy_intersect(a1, a2)
+
         if isinstance(a1, FSA) and isinstance(a2, FSA):
             return Transformer._fsa_fsa_intersect(a1, a2)
 
@@ -106,17 +123,27 @@ class Transformer:
             return Transformer._dfsa_dfsa_intersect(a1, a2.compile())
         if isinstance(a1, FSA) and isinstance(a2, DFSA):
             return Transformer._dfsa_dfsa_intersect(a1.compile(), a2)
+        raise TypeError(f"Unkown automaton types {type(a1)} and {type(a2)}")
+
+    def _is_factored(a: Automaton) -> bool:
+        return isinstance(a, (ProductAutomaton, CounterAutomaton))
+
+    def lazy_intersect(a1: Automaton, a2: Automaton) -> Automaton:
+        """
+        Intersects two automata without building the product machine. The
+        product states are expanded on demand by a `ProductAutomaton`.
+        """
+        if isinstance(a1, FSA): a1 = a1.compile()
+        if isinstance(a2, FSA): a2 = a2.compile()
 
         if isinstance(a2, PDA): a1, a2 = a2, a1
-        assert(isinstance(a1, PDA)), f"Unkown automaton type {type(a1)}"
+        if not isinstance(a1, PDA):
+            return ProductAutomaton([a1, a2])
 
         if isinstance(a2, PDA):
             return Transformer._pda_pda_intersect(a1, a2)
-        if isinstance(a2, DFSA):
-            return Transformer._pda_dfsa_intersect(a1, a2)
-        assert(isinstance(a2, FSA)), f"Unkown automaton type {type(a2)}"
-        return Transformer._pda_dfsa_intersect(a1, a2.compile())
-    
+        return Transformer._pda_dfsa_intersect(a1, a2)
+
     def _fsa_fsa_intersect(f1: FSA, f2: FSA) -> FSA:
         # the two machines need to be in the same semiring
         assert f1.R == f2.R
@@ -163,7 +190,8 @@ class Transformer:
         return product_fsa
     
     def _dfsa_dfsa_intersect(d1: DFSA, d2: DFSA) -> DFSA:
-        print(f"Intersecting a DFSA with {d1.num_states} and a DFSA with {d2.num_states} ...")
+        events.record(events.INTERSECT, "Intersecting a DFSA with %d and a DFSA with %d states...",
+                      d1.num_states, d2.num_states, level=logging.INFO)
         product_fsa = FSA()
         product_fsa.set_I(PairState(d1.initial_state, d2.initial_state)) 
 
@@ -199,12 +227,15 @@ class Transformer:
             if i1 == d1.final_state and i2 == d2.final_state:
                 product_fsa.set_F(PairState(i1, i2))
         
-        return product_fsa.compile()
+        # Products have many redundant states, so they are minimized before decoding
+        return product_fsa.compile(minimize=True)
 
 
-    def _pda_dfsa_intersect(pda: PDA, dfsa: DFSA) -> PDA:
-        return PDA(pda.token_to_key, Transformer._dfsa_dfsa_intersect(pda.dfsa, dfsa))
+    def _pda_dfsa_intersect(pda: PDA, dfsa: Automaton) -> PDA:
+        # The DFSA (or any stack-free automaton) becomes one more component
+        return PDA(pda.token_to_key, pda.automata + [dfsa], pda.max_length, pda.max_depth)
     
     def _pda_pda_intersect(p1: PDA, p2: PDA) -> PDA:
         assert(p1.token_to_key == p2.token_to_key)
-        return PDA(p1.token_to_key, Transformer._dfsa_dfsa_intersect(p1.dfsa, p2.dfsa))
+        return PDA(p1.token_to_key, p1.automata + p2.automata,
+                   min(p1.max_length, p2.max_length), min(p1.max_depth, p2.max_depth))